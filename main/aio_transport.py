@@ -0,0 +1,262 @@
+"""
+asyncio datagram transport: every node is one DatagramProtocol, any number of nodes and concurrent
+transfers share one event loop instead of a thread blocked in recvfrom per socket.
+a node is receiver and sender at the same time, sack frames arriving on its socket are routed to the
+transfer they acknowledge by (router address, message id).
+"""
+import asyncio
+import inspect
+import json
+import time
+from codec import CONTROL_FLAGS, OPTION_SOURCE_ROUTE, PacketView, new_message_id
+from sack import AckCoalescer
+from reassembly import Reassembler
+from pmtu import chunk_size_for
+from compression import SENSOR_DICTIONARY
+from transfer import Transfer
+from protocol import HANDOVER_INTERVAL, HANDOVER_ROUNDS, MAX_IDLE_ROUNDS, answer_inquiry, answer_probe, \
+    create_ll_inquiry, message_packets, send_ack
+from streaming import MessageSource
+import socket_pool
+
+
+class NodeProtocol(asyncio.DatagramProtocol):
+    """
+    One node of the network.
+    on_message(message, packet_view, address) is called with every reassembled message,
+    on_path(path_info, packet_view, address) with every path packet (path_info is None for binary
+    source routed ones, see codec.OPTION_SOURCE_ROUTE) and locate() answers
+    latitude/longitude inquiries with a (lat, lon) tuple; callbacks may be coroutine functions.
+    forwarding (forwarding.ForwardingTable) relays the chunks of cut-through routed flows,
+    keys (encryption.KeyManager) opens sealed messages.
+    """
+    def __init__(self, server_addr, on_message=None, on_path=None, locate=None, reassembler=None,
+                 ack_every=2, ack_delay=0.02, suppress_log=True, forwarding=None, keys=None):
+        self.server_addr = tuple(server_addr)
+        self.on_message = on_message
+        self.on_path = on_path
+        self.locate = locate
+        self.reassembler = reassembler if reassembler is not None else Reassembler()
+        self.ack_every = ack_every
+        self.ack_delay = ack_delay
+        self.suppress_log = suppress_log
+        self.forwarding = forwarding
+        self.keys = keys
+        self.transport = None
+        self.coalescer = None
+        self.transfers = {}  # (router address, message id) -> asyncio.Queue of sack frames
+        self.inquiries = {}  # satellite address -> future of the (lat, lon) answer
+        self._flush_handle = None
+        self._poll_handle = None
+        self._tasks = set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        # the transport has the sendto() of a socket, acks are sent through it directly
+        self.coalescer = AckCoalescer(self.server_addr, transport, ack_every=self.ack_every,
+                                      ack_delay=self.ack_delay)
+
+    def connection_lost(self, exc):
+        for handle in (self._flush_handle, self._poll_handle):
+            if handle is not None:
+                handle.cancel()
+        self._flush_handle = self._poll_handle = None
+
+    def error_received(self, exc):
+        # e.g. ICMP port unreachable of a previous datagram, the timers deal with the loss
+        pass
+
+    def datagram_received(self, data, address):
+        packet_view = PacketView(data)
+        control_flag = packet_view.control_flag
+        if control_flag == CONTROL_FLAGS['sack']:
+            acks = self.transfers.get((address, packet_view.message_id))
+            if acks is not None:
+                acks.put_nowait((packet_view, time.time()))
+            elif self.forwarding is not None:
+                self.forwarding.on_ack(address, packet_view)
+                self.poll_forwarding()
+        elif control_flag in (CONTROL_FLAGS['data'], CONTROL_FLAGS['repair']):
+            message = send_ack(self.server_addr, address, self.transport, packet_view, self.reassembler,
+                               suppress_log=self.suppress_log, coalescer=self.coalescer,
+                               forwarding=self.forwarding, keys=self.keys)
+            self._schedule_flush()
+            if self.forwarding is not None:
+                self.poll_forwarding()
+            if message is not None and self.on_message is not None:
+                self._call(self.on_message, message, packet_view, address)
+        elif control_flag == CONTROL_FLAGS['ack']:
+            # answer to a latitude/longitude inquiry
+            future = self.inquiries.pop(address, None)
+            if future is not None and not future.done() and packet_view.verify():
+                ll_info = json.loads(bytes(packet_view.payload))
+                future.set_result((ll_info['lat'], ll_info['lon']))
+        elif control_flag == CONTROL_FLAGS['inquiry'] and packet_view.verify():
+            # give a out of range latitude(it should be from -90 to 90) to imply error
+            lat, lon = self.locate() if self.locate is not None else (-800, -800)
+            answer_inquiry(self.server_addr, address, self.transport, lat, lon)
+        elif control_flag == CONTROL_FLAGS['path'] and packet_view.verify():
+            if self.on_path is not None:
+                path_info = None if packet_view.options & OPTION_SOURCE_ROUTE \
+                    else json.loads(bytes(packet_view.payload))
+                self._call(self.on_path, path_info, packet_view, address)
+        elif control_flag == CONTROL_FLAGS['probe']:
+            answer_probe(self.server_addr, address, self.transport, packet_view)
+
+    def _call(self, callback, *args):
+        res = callback(*args)
+        if inspect.isawaitable(res):
+            # keep a reference, the loop only holds weak ones to its tasks
+            task = asyncio.ensure_future(res)
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    def _schedule_flush(self):
+        # one timer for the earliest delayed ack
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        timeout = self.coalescer.next_timeout()
+        if timeout is not None:
+            self._flush_handle = asyncio.get_running_loop().call_later(timeout, self._flush)
+
+    def _flush(self):
+        self._flush_handle = None
+        self.coalescer.flush()
+        self._schedule_flush()
+
+    def poll_forwarding(self):
+        """
+        Let the relay transfers send, then sleep until the earliest of their timers.
+        """
+        if self._poll_handle is not None:
+            self._poll_handle.cancel()
+            self._poll_handle = None
+        self.forwarding.poll(self.transport.sendto)
+        timeout = self.forwarding.next_timeout()
+        if timeout is not None:
+            self._poll_handle = asyncio.get_running_loop().call_later(timeout, self.poll_forwarding)
+
+    def sendto(self, packet, address):
+        self.transport.sendto(packet, tuple(address))
+
+    async def inquire(self, satellite_addr, timeout=2.):
+        """
+        Ask a satellite node for its latitude/longitude.
+        :return: (lat, lon), None on timeout.
+        """
+        satellite_addr = tuple(satellite_addr)
+        future = asyncio.get_running_loop().create_future()
+        self.inquiries[satellite_addr] = future
+        self.transport.sendto(create_ll_inquiry(self.server_addr, satellite_addr), satellite_addr)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            print("Satellite inquiry timed out.")
+            return None
+        finally:
+            if self.inquiries.get(satellite_addr) is future:
+                del self.inquiries[satellite_addr]
+
+    async def send_message(self, src_addr, des_addr, router_addr, message, timeout=1, chunk_size=None,
+                           debug_interval=0, suppress_log=False, window_size=8, congestion='aimd',
+                           message_id=None, fec=None, fec_block=8, fec_repair=None,
+                           compression=None, compression_dict=SENSOR_DICTIONARY, options=0, handover=None,
+                           max_idle_rounds=MAX_IDLE_ROUNDS, encryption=None, packet_encryption=False, restart=None):
+        """
+        Send message to router_addr from this node's socket, the arguments are those of
+        protocol.send_packets. debug_interval defaults to 0 here, pacing is left to the congestion controller;
+        handover may also be a coroutine function.
+        :return: the finished transfer.Transfer.
+        """
+        src_ip, src_port = src_addr
+        des_ip, des_port = des_addr
+        # sack frames are matched by the address they come from, a host name would never match
+        router_addr = socket_pool.peer_addr(*router_addr)
+        if message_id is None:
+            message_id = new_message_id()
+        auto_chunk = chunk_size is None
+        if auto_chunk:
+            # probing uses its own blocking socket
+            chunk_size = await asyncio.get_running_loop().run_in_executor(None, chunk_size_for, router_addr, timeout)
+
+        # packets are built from memoryview chunks of the message when sent (see streaming.py)
+        source = MessageSource(message)
+        packets = message_packets(src_ip, src_port, des_ip, des_port, source.data, chunk_size=chunk_size,
+                                  message_id=message_id, compression=compression, compression_dict=compression_dict,
+                                  options=options, encryption=encryption, packet_encryption=packet_encryption)
+        transfer = Transfer(src_addr, des_addr, router_addr, packets, message_id, chunk_size, timeout=timeout,
+                            debug_interval=debug_interval, window_size=window_size, congestion=congestion,
+                            fec=fec, fec_block=fec_block, fec_repair=fec_repair, options=packets.options,
+                            auto_chunk=auto_chunk, payload_bytes=len(packets.data))
+
+        def send(packet):
+            self.transport.sendto(packet, transfer.router_addr)
+
+        key = (router_addr, message_id)
+        acks = asyncio.Queue()
+        self.transfers[key] = acks
+        next_handover_check = time.time() + HANDOVER_INTERVAL
+        try:
+            while not transfer.done:
+                if handover is not None and (transfer.idle_rounds >= HANDOVER_ROUNDS
+                                             or time.time() >= next_handover_check):
+                    next_handover_check = time.time() + HANDOVER_INTERVAL
+                    new_router = handover(transfer.router_addr, transfer.idle_rounds >= HANDOVER_ROUNDS)
+                    if inspect.isawaitable(new_router):
+                        new_router = await new_router
+                    if new_router is not None:
+                        new_router = socket_pool.peer_addr(*new_router)
+                    if new_router is not None and new_router != transfer.router_addr:
+                        transfer.migrate(new_router)
+                        # the sack frames now come from the new router
+                        del self.transfers[key]
+                        key = (new_router, message_id)
+                        self.transfers[key] = acks
+                if max_idle_rounds is not None and transfer.idle_rounds >= max_idle_rounds:
+                    raise TimeoutError(f"message {message_id}: no ack from {transfer.router_addr[0]}:"
+                                       f"{transfer.router_addr[1]} in {transfer.idle_rounds} timer rounds")
+                transfer.refill(send)
+                # wait for acknowledgements until the earliest timer expires, then take what else arrived
+                try:
+                    ack = await asyncio.wait_for(acks.get(), max(transfer.wake_time() - time.time(), 0.001))
+                except asyncio.TimeoutError:
+                    ack = None
+                while ack is not None:
+                    transfer.on_ack(*ack)
+                    ack = acks.get_nowait() if not acks.empty() else None
+                if transfer.resend_lost(send):
+                    # large datagrams seem to vanish on this route, start over with smaller chunks
+                    # under a new id, never sealing other chunks with the nonces of the old one
+                    del self.transfers[key]
+                    message_id = new_message_id()
+                    if restart is not None:
+                        restart(message_id)
+                    return await self.send_message(src_addr, des_addr, transfer.router_addr, source.data,
+                                                   timeout=timeout, debug_interval=debug_interval,
+                                                   suppress_log=suppress_log, window_size=window_size,
+                                                   congestion=congestion, message_id=message_id, fec=fec,
+                                                   fec_block=fec_block, fec_repair=fec_repair,
+                                                   compression=compression, compression_dict=compression_dict,
+                                                   options=options, handover=handover,
+                                                   max_idle_rounds=max_idle_rounds, encryption=encryption,
+                                                   packet_encryption=packet_encryption, restart=restart)
+        finally:
+            if self.transfers.get(key) is acks:
+                del self.transfers[key]
+            source.close()
+        transfer.finish()
+        if not suppress_log:
+            transfer.print_stats()
+        return transfer
+
+
+async def open_node(server_addr, **kwargs):
+    """
+    Bind a node to server_addr on the running loop, kwargs are those of NodeProtocol.
+    :return: the NodeProtocol, its transport is closed with node.transport.close().
+    """
+    loop = asyncio.get_running_loop()
+    _, node = await loop.create_datagram_endpoint(lambda: NodeProtocol(server_addr, **kwargs),
+                                                  local_addr=tuple(server_addr))
+    return node
@@ -0,0 +1,45 @@
+"""
+packet codec microbenchmark: protocol.create_udp_packet/decode_packet against codec.encode_packet/PacketView
+run from the main directory: python3 bench_codec.py
+"""
+import time
+from protocol import create_udp_packet, decode_packet, verify_checksum
+from codec import encode_packet, PacketView
+
+
+def packets_per_second(func, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func()
+    return rounds / (time.perf_counter() - start)
+
+
+def run(rounds=50000, chunk_size=32):
+    payload = b'x' * chunk_size
+    src, des = ('localhost', 50099), ('localhost', 50021)
+    packet = create_udp_packet(src[0], src[1], des[0], des[1], payload, 3, 10)
+    assert packet == encode_packet(src[0], src[1], des[0], des[1], payload, 3, 10), "codec wire format mismatch"
+
+    def old_encode():
+        create_udp_packet(src[0], src[1], des[0], des[1], payload, 3, 10)
+
+    def new_encode():
+        encode_packet(src[0], src[1], des[0], des[1], payload, 3, 10)
+
+    def old_decode():
+        res = decode_packet(packet)
+        verify_checksum(res['payload'], res['checksum'])
+
+    def new_decode():
+        PacketView(packet).verify()
+
+    print(f"{rounds} packets, {chunk_size} byte payload")
+    for name, old, new in (("encode", old_encode, new_encode), ("decode+verify", old_decode, new_decode)):
+        old_pps = packets_per_second(old, rounds)
+        new_pps = packets_per_second(new, rounds)
+        print(f"{name:>14}: protocol {old_pps:12.0f} pkt/s, codec {new_pps:12.0f} pkt/s, speedup {new_pps / old_pps:.2f}x")
+
+
+if __name__ == "__main__":
+    run()
+    run(chunk_size=1024)
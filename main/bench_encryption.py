@@ -0,0 +1,110 @@
+"""
+encryption microbenchmark: aes_encrypt/aes_decrypt (aes-cfb + base64, key decoded every call and, on the
+old receiving path, read from its file for every message) against encryption.KeyManager (aes-gcm, bytes),
+as a whole, streamed in CHUNK_SIZE byte pieces (streaming.SealedView) and in CHUNK_SIZE byte chunks sealed
+on their own (codec.OPTION_CHUNK_ENCRYPTED); then the cost of a key: pbkdf2 (the master key), an hkdf
+session subkey and a session subkey found in the lru of KeyManager
+run from the main directory: python3 bench_encryption.py
+"""
+import os
+import time
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from encryption import KeyManager, aes_decrypt, aes_encrypt, read_key_and_salt
+from generate_aes_key import PBKDF2_ITERATIONS
+from streaming import SealedView
+
+KEY_FILE = "aes_key_salt.txt"
+CHUNK_SIZE = 1400
+SRC_IP = DES_IP = bytes(4)
+SRC_ADDR, DES_ADDR = ("0.0.0.0", 1), ("0.0.0.0", 2)
+
+
+def seconds_per_call(func, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func()
+    return (time.perf_counter() - start) / rounds
+
+
+def run(size, rounds):
+    key, _ = read_key_and_salt(KEY_FILE)
+    keys = KeyManager(KEY_FILE)
+    session = keys.session(SRC_ADDR, DES_ADDR)
+    # ascii text like the sensor records, aes_encrypt takes a str
+    text = os.urandom(size // 2).hex()
+    data = text.encode()
+    old_sealed = aes_encrypt(text, key)
+    new_sealed = session.encrypt(data)
+    assert aes_decrypt(old_sealed, key) == text and session.decrypt(new_sealed) == data
+
+    chunks = [data[offset:offset + CHUNK_SIZE] for offset in range(0, size, CHUNK_SIZE)]
+    # the per-chunk nonce and associated data: source ip, ports, flag, packet number, total, message id
+    headers = [(SRC_IP, 1, DES_IP, 2, 0, number, len(chunks), 7) for number in range(len(chunks))]
+    sealed_chunks = [session.seal_chunk(chunk, *header) for chunk, header in zip(chunks, headers)]
+
+    def stream_encrypt():
+        view = SealedView(data, session.encryptor())
+        for offset in range(0, len(view), CHUNK_SIZE):
+            view[offset:offset + CHUNK_SIZE]
+
+    def stream_decrypt():
+        decryptor = session.decryptor()
+        for offset in range(0, len(new_sealed), CHUNK_SIZE):
+            decryptor.update(new_sealed[offset:offset + CHUNK_SIZE])
+        decryptor.finalize()
+
+    def seal_chunks():
+        for chunk, header in zip(chunks, headers):
+            session.seal_chunk(chunk, *header)
+
+    def open_chunks():
+        for chunk, header in zip(sealed_chunks, headers):
+            session.open_chunk(chunk, *header)
+
+    def old_receive():
+        aes_decrypt(old_sealed, read_key_and_salt(KEY_FILE)[0])
+
+    cases = (
+        ("cfb+base64 encrypt", lambda: aes_encrypt(text, key)),
+        ("cfb+base64 decrypt", lambda: aes_decrypt(old_sealed, key)),
+        ("  + key file read", old_receive),
+        ("gcm encrypt", lambda: session.encrypt(data)),
+        ("gcm decrypt", lambda: session.decrypt(new_sealed)),
+        ("gcm stream encrypt", stream_encrypt),
+        ("gcm stream decrypt", stream_decrypt),
+        ("gcm seal chunks", seal_chunks),
+        ("gcm open chunks", open_chunks),
+    )
+    print(f"{size} byte messages, {rounds} rounds: on the wire cfb+base64 {len(old_sealed)} bytes, "
+          f"gcm {len(new_sealed)} bytes")
+    for name, func in cases:
+        seconds = seconds_per_call(func, rounds)
+        print(f"{name:>20}: {seconds * 1e6:10.1f} us/message {size / seconds / 1e6:10.1f} MB/s")
+
+
+def run_keys(rounds):
+    keys = KeyManager(KEY_FILE, max_sessions=rounds)
+    epochs = iter(range(10 * rounds))
+
+    def pbkdf2():
+        PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=bytes(16),
+                   iterations=PBKDF2_ITERATIONS).derive(b"password")
+
+    pair = (SRC_IP, 1, DES_IP, 2)
+    cases = (
+        ("pbkdf2 master key", pbkdf2, 5),
+        # a new epoch every call, so every call derives
+        ("hkdf session key", lambda: keys.session_key(pair, next(epochs)), rounds),
+        ("cached session key", lambda: keys.session_key(pair, 0), rounds),
+        ("session of a message", lambda: keys.session(SRC_ADDR, DES_ADDR).encryptor(), rounds),
+    )
+    print("keys:")
+    for name, func, count in cases:
+        print(f"{name:>20}: {seconds_per_call(func, count) * 1e6:10.1f} us")
+
+
+if __name__ == "__main__":
+    for size, rounds in ((256, 20000), (4096, 10000), (65536, 1000), (1024 * 1024, 50)):
+        run(size, rounds)
+    run_keys(10000)
@@ -0,0 +1,128 @@
+"""
+satellite node host benchmark: probe datagrams per second answered by N satellite nodes,
+one selector loop (node_host.NodeHost) against one asyncio loop and a thread per node, all pinned to one
+core in a child process, and against the sharded constellation.Constellation with a worker per core.
+the load generators keep a fixed number of probes in flight, spread round-robin over all nodes.
+run from the main directory: python3 bench_node_host.py
+"""
+import asyncio
+import multiprocessing
+import os
+import socket
+import threading
+import time
+from collections import deque
+import metrics
+from constellation import Constellation
+from codec import CONTROL_FLAGS, PacketView, encode_packet
+
+BASE_PORT = 52000
+GENERATOR_ADDR = ('127.0.0.1', 51999)
+
+
+def run_nodes(mode, node_count, ready):
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, {min(os.sched_getaffinity(0))})
+    metrics.set_log_level("warning")
+    import satellite_server_modified as satellite_server
+    receiver_ports = {f"sat{i + 1}": BASE_PORT + i for i in range(node_count)}
+    global_dequeue = [deque(maxlen=10) for _ in range(node_count)]
+    if mode == "threads":
+        for node_id, (node_name, port) in enumerate(receiver_ports.items()):
+            threading.Thread(target=satellite_server.server, args=(global_dequeue, port, receiver_ports, 2048,
+                                                                   node_name, node_id, False), daemon=True).start()
+        ready.set()
+        threading.Event().wait()
+    elif mode == "asyncio":
+        async def nodes():
+            for node_id, (node_name, port) in enumerate(receiver_ports.items()):
+                await satellite_server.async_server(global_dequeue, port, receiver_ports, node_name, node_id,
+                                                    encryption=False)
+            ready.set()
+            await asyncio.Event().wait()
+        asyncio.run(nodes())
+    else:
+        host = satellite_server.NodeHost(2048)
+        for node_id, (node_name, port) in enumerate(receiver_ports.items()):
+            host.add(satellite_server.SatelliteNode(global_dequeue, port, receiver_ports, node_name, node_id,
+                                                    encryption=False))
+        ready.set()
+        host.run()
+
+
+def generate(ports, generator_port, duration, in_flight, results):
+    # load generator: keep in_flight probes spread over ports in flight, report the answers per second
+    probes = [encode_packet(GENERATOR_ADDR[0], generator_port, '127.0.0.1', port, b'', packet_number=0,
+                            flag='probe', message_id=i + 1) for i, port in enumerate(ports)]
+    answered = 0
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as generator:
+        generator.bind((GENERATOR_ADDR[0], generator_port))
+        generator.settimeout(0.2)
+        next_node = 0
+
+        def send(count):
+            nonlocal next_node
+            for _ in range(count):
+                generator.sendto(probes[next_node], ('127.0.0.1', ports[next_node]))
+                next_node = (next_node + 1) % len(ports)
+
+        send(in_flight)
+        start = time.perf_counter()
+        while time.perf_counter() - start < duration:
+            try:
+                reply, _ = generator.recvfrom(2048)
+            except socket.timeout:
+                # a probe got lost, put another one in flight
+                send(1)
+                continue
+            if PacketView(reply).control_flag == CONTROL_FLAGS['probe_ack']:
+                answered += 1
+                send(1)
+        results.put(answered / (time.perf_counter() - start))
+
+
+def packets_per_second(mode, node_count, duration=2., in_flight=256, generators=1):
+    if mode == "processes":
+        # the workers are pinned by nobody, one per core
+        receiver_ports = {f"sat{i + 1}": BASE_PORT + i for i in range(node_count)}
+        constellation = Constellation(receiver_ports, node_count, encryption=False)
+        constellation.wait_ready()
+        stop = constellation.stop
+    else:
+        ready = multiprocessing.Event()
+        process = multiprocessing.Process(target=run_nodes, args=(mode, node_count, ready), daemon=True)
+        process.start()
+        ready.wait()
+
+        def stop():
+            process.terminate()
+            process.join()
+    time.sleep(0.2)
+    ports = [BASE_PORT + i for i in range(node_count)]
+    results = multiprocessing.Queue()
+    loads = [multiprocessing.Process(target=generate, args=(ports[i::generators], GENERATOR_ADDR[1] - i, duration,
+                                                            max(in_flight // generators, 1), results))
+             for i in range(min(generators, node_count))]
+    for load in loads:
+        load.start()
+    pps = sum(results.get() for _ in loads)
+    for load in loads:
+        load.join()
+    stop()
+    return pps
+
+
+def run(node_counts=(5, 50, 100, 500), modes=("selectors", "asyncio", "threads", "processes"), generators=None):
+    # one load generator per spare core, the same for every host
+    generators = generators or max((os.cpu_count() or 1) // 2, 1)
+    print(f"{os.cpu_count()} cores, {generators} load generator(s)")
+    print(f"{'nodes':>6} " + " ".join(f"{mode + ' pkt/s':>16}" for mode in modes))
+    for node_count in node_counts:
+        results = [packets_per_second(mode, node_count, generators=generators) for mode in modes]
+        print(f"{node_count:>6} " + " ".join(f"{pps:16.0f}" for pps in results))
+
+
+if __name__ == "__main__":
+    # workers fork with this level
+    metrics.set_log_level("warning")
+    run()
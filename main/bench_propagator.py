@@ -0,0 +1,53 @@
+"""
+constellation movement benchmark: one tick of N satellites with satellites_move, one call per satellite as
+keep_moving used to (rotation matrix rebuilt and inverted every call), against movement_simulation.Propagator,
+every satellite in one numpy call, on one orbit and spread over 72 orbits.
+run from the main directory: python3 bench_propagator.py
+"""
+import time
+import numpy as np
+from movement_simulation import Propagator, init_satellites, rotation_matrix_with_angle, xyz_to_ll, ll_to_xyz
+
+ORBIT_Z_AXIS = (5, 90)
+VELOCITY = 27000 / 111.3 / (60 * 60)
+ORBITS = 72
+
+
+def seconds_per_call(func, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func()
+    return (time.perf_counter() - start) / rounds
+
+
+def move_one(sat_ll, orbit_z_axis, velocity, t):
+    # satellites_move as it was: the matrix built and inverted for every satellite
+    x1, y1, z1 = ll_to_xyz(*sat_ll)
+    rotation = rotation_matrix_with_angle(*orbit_z_axis)
+    lat, lon = xyz_to_ll(*rotation.dot(np.array([x1, y1, z1])))
+    x2, y2, z2 = ll_to_xyz(lat, lon + velocity * t)
+    return xyz_to_ll(*np.linalg.inv(rotation).dot(np.array([x2, y2, z2])))
+
+
+def run(num_sats, rounds):
+    sat_ll = init_satellites(ORBIT_Z_AXIS, num_sats)
+    one_orbit = Propagator(sat_ll, ORBIT_Z_AXIS, VELOCITY)
+    # a walker-like shell: orbits spread in longitude, 53 degrees inclined
+    orbit_axes = [(53, -180 + 360 * k / ORBITS) for k in range(ORBITS)]
+    orbit_ids = np.arange(num_sats) % ORBITS
+    shell_ll = [init_satellites(orbit_axes[k], 1)[0] for k in orbit_ids]
+    shell = Propagator(shell_ll, orbit_axes, VELOCITY, orbit_ids=orbit_ids)
+    cases = [("propagator, 1 orbit", lambda: one_orbit.step(1.).lat_lon(), rounds),
+             (f"propagator, {ORBITS} orbits", lambda: shell.step(1.).lat_lon(), rounds)]
+    if num_sats <= 10000:
+        cases.insert(0, ("per satellite", lambda: [move_one(ll, ORBIT_Z_AXIS, VELOCITY, 1.) for ll in sat_ll],
+                         max(rounds // 100, 1)))
+    print(f"{num_sats} satellites:")
+    for name, func, count in cases:
+        seconds = seconds_per_call(func, count)
+        print(f"{name:>22}: {seconds * 1000:10.3f} ms/tick {seconds / num_sats * 1e9:10.1f} ns/satellite")
+
+
+if __name__ == "__main__":
+    for num_sats, rounds in ((5, 2000), (100, 1000), (1000, 200), (10000, 100), (100000, 20)):
+        run(num_sats, rounds)
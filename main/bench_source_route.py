@@ -0,0 +1,72 @@
+"""
+per-hop processing time of a path packet at a relay: json path payload (decode, pop the next hop,
+encode, build a new packet) against the binary source route (advance the hop index in place).
+run from the main directory: python3 bench_source_route.py
+"""
+import json
+import time
+import metrics
+from codec import PacketView, advance_route, encode_packet
+from forwarding import ForwardingTable
+from satellite_server_modified import handle_path, handle_route, path_packet
+
+
+def microseconds_per_hop(func, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func()
+    return (time.perf_counter() - start) / rounds * 1e6
+
+
+def run(rounds=50000, hops=8):
+    receiver_ports = {f"sat{i + 1}": 50011 + 2 * i for i in range(hops)}
+    node_addrs = [('127.0.0.1', port) for port in receiver_ports.values()]
+    path = list(receiver_ports)
+    src, des = ('127.0.0.1', 50099), ('127.0.0.1', 50021)
+    json_packet = encode_packet(src[0], src[1], des[0], des[1],
+                                json.dumps({"sender": path[0], "data": f"Hello from {path[0]}!",
+                                            "path": path[1:]}).encode('utf-8'), flag='path', message_id=1)
+    route_packet = encode_packet(src[0], src[1], des[0], des[1], b'', flag='path', message_id=1,
+                                 route=list(range(hops)))
+    print(f"{rounds} path packets, {hops} hop route: json {len(json_packet)} bytes, "
+          f"source route {len(route_packet)} bytes")
+
+    def json_hop():
+        packet_view = PacketView(json_packet)
+        packet_view.verify()
+        path_info = json.loads(bytes(packet_view.payload))
+        path_info["path"].pop(0)
+        path_packet(path_info, packet_view)
+
+    def route_hop():
+        packet = bytearray(route_packet)
+        PacketView(packet).verify()
+        advance_route(packet)
+
+    forwarding = ForwardingTable("bench", max_flows=rounds)
+
+    def sendto(packet, address):
+        pass
+
+    def json_handler():
+        packet_view = PacketView(json_packet)
+        packet_view.verify()
+        handle_path(forwarding, json.loads(bytes(packet_view.payload)), packet_view, receiver_ports, "bench",
+                    sendto)
+
+    def route_handler():
+        packet = bytearray(route_packet)
+        PacketView(packet).verify()
+        handle_route(forwarding, packet, node_addrs, "bench", sendto)
+
+    for name, old, new in (("header", json_hop, route_hop), ("relay handler", json_handler, route_handler)):
+        old_us = microseconds_per_hop(old, rounds)
+        new_us = microseconds_per_hop(new, rounds)
+        print(f"{name:>14}: json {old_us:8.2f} us/hop, source route {new_us:8.2f} us/hop, "
+              f"speedup {old_us / new_us:.2f}x")
+
+
+if __name__ == "__main__":
+    metrics.set_log_level("warning")
+    run()
+    run(hops=32)
@@ -0,0 +1,179 @@
+"""
+precompiled struct packet codec with zero-copy packet views
+
+options of a message:
+a message is compressed (OPTION_COMPRESSED) and then sealed with aes-gcm (OPTION_ENCRYPTED) as a whole before
+it is chunked. with OPTION_CHUNK_ENCRYPTED every chunk is sealed on its own instead, so every hop with the key
+verifies each datagram on arrival: a forged or altered one is neither stored, acknowledged nor relayed, and
+the destination decrypts the chunks as they arrive. a message sealed as a whole is decrypted as far as its
+chunks arrived in order (encryption.OpenedStream). the keys are session subkeys of the header source and
+destination (encryption.KeyManager.session).
+the receiver (protocol.send_ack) stores the chunks under (header source address, message id) and returns the
+whole message as bytes, a stripe of a multipath message (OPTION_STRIPE) raw for its forwarding table to join,
+and a sealed message it has no keys for as ciphertext.
+"""
+import itertools
+import random
+import socket
+import struct
+import zlib
+
+# same wire layout as described in protocol.py:
+# source_ip(4) source_port(2) destination_ip(4) destination_port(2)
+# control flag(1) ttl(1) packet number(4) total packet number(4)
+# checksum(4) total data length(4) message id(4)
+HEADER = struct.Struct('!4sH4sHBBIIIII')
+HEADER_SIZE = HEADER.size
+
+# global dictionary for control flag
+CONTROL_FLAGS = {
+    "data": 0,
+    "ack": 1,
+    "inquiry": 2,
+    "path": 3,
+    "sack": 4,
+    "probe": 5,
+    "probe_ack": 6,
+    "repair": 7,
+}
+# the control flag byte carries the flag in its low three bits and option bits above
+FLAG_MASK = 0x07
+# every data chunk is sealed with aes-gcm on its own (see encryption.KeyManager.seal_chunk): its payload is
+# ciphertext + tag, the nonce is derived from source ip, message id and packet number and the header fields
+# no relay changes are authenticated, so every hop with the key can verify a datagram on arrival
+OPTION_CHUNK_ENCRYPTED = 0x08
+# the message payload is zlib compressed (see compression.py)
+OPTION_COMPRESSED = 0x10
+# a source route follows the header, ahead of the payload and not covered by its checksum:
+# hop count(1) hop index(1) node id(2) per hop. the hop index is the position of the node the packet
+# is on its way to, relays advance it in place (advance_route) and pass the packet on unchanged otherwise
+OPTION_SOURCE_ROUTE = 0x20
+# the message is one stripe of a message sent over several paths (see multipath.py)
+OPTION_STRIPE = 0x40
+# the message is sealed with aes-gcm as a whole, after compression (see encryption.KeyManager)
+OPTION_ENCRYPTED = 0x80
+ROUTE = struct.Struct('!BB')
+ROUTE_HOP = struct.Struct('!H')
+
+# message ids of this process, starting at a random point so restarted senders do not reuse them
+_message_ids = itertools.count(random.getrandbits(31))
+
+# resolved addresses, hostname -> packed ipv4 and packed ipv4 -> dotted string
+_aton_cache = {}
+_ntoa_cache = {}
+
+
+def resolve(host):
+    """
+    Resolve a hostname to its packed 4-byte ipv4 address, cached per hostname.
+    """
+    packed = _aton_cache.get(host)
+    if packed is None:
+        packed = socket.inet_aton(socket.gethostbyname(host))
+        _aton_cache[host] = packed
+    return packed
+
+
+def ntoa(packed):
+    """
+    Convert a packed 4-byte ipv4 address back to its dotted string, cached.
+    """
+    ip = _ntoa_cache.get(packed)
+    if ip is None:
+        ip = socket.inet_ntoa(packed)
+        _ntoa_cache[packed] = ip
+    return ip
+
+
+def new_message_id():
+    """
+    Next 32-bit message id of this process.
+    """
+    return next(_message_ids) & 0xFFFFFFFF
+
+
+def encode_route(hops, hop_index=0):
+    """
+    Source route extension of the node ids hops (at most 255, each below 65536).
+    """
+    return ROUTE.pack(len(hops), hop_index) + struct.pack(f'!{len(hops)}H', *hops)
+
+
+def encode_packet(src_ip, src_port, des_ip, des_port, payload,
+                  packet_number=0, total_packets=0, flag='data', ttl=64, message_id=0, options=0, route=None):
+    """
+    Build a packet with the same arguments and wire format as protocol.create_udp_packet.
+    options are OPTION_* bits or-ed into the control flag byte,
+    route a list of node ids to source route the packet along (sets OPTION_SOURCE_ROUTE).
+    :return: packet bytes.
+    """
+    extension = b''
+    if route is not None:
+        extension = encode_route(route)
+        options |= OPTION_SOURCE_ROUTE
+    header = HEADER.pack(resolve(src_ip), src_port, resolve(des_ip), des_port,
+                         CONTROL_FLAGS[flag] | options, ttl, packet_number, total_packets,
+                         zlib.crc32(payload), len(payload) + len(extension) + HEADER_SIZE, message_id)
+    return header + extension + payload
+
+
+def advance_route(packet):
+    """
+    Move the hop index of a source routed packet to the next hop, in place.
+    :param packet: bytearray (or writable memoryview) of the received packet.
+    :return: node id of the next hop, None if the packet arrived at the last hop of its route.
+    """
+    hop_count, hop_index = ROUTE.unpack_from(packet, HEADER_SIZE)
+    hop_index += 1
+    if hop_index >= hop_count:
+        return None
+    packet[HEADER_SIZE + 1] = hop_index
+    return ROUTE_HOP.unpack_from(packet, HEADER_SIZE + ROUTE.size + ROUTE_HOP.size * hop_index)[0]
+
+
+class PacketView:
+    """
+    Read-only view over a received datagram.
+    The header is unpacked once, the payload stays a memoryview slice of the datagram.
+    """
+    __slots__ = ('packet', '_src', 'src_port', '_des', 'des_port', 'control_flag', 'options', 'ttl',
+                 'packet_num', 'total_packet', 'checksum', 'packet_length', 'message_id', 'payload_offset')
+
+    def __init__(self, packet):
+        self.packet = memoryview(packet)
+        (self._src, self.src_port, self._des, self.des_port, self.control_flag, self.ttl,
+         self.packet_num, self.total_packet, self.checksum, self.packet_length,
+         self.message_id) = HEADER.unpack_from(packet)
+        self.options = self.control_flag & ~FLAG_MASK
+        self.control_flag &= FLAG_MASK
+        self.payload_offset = HEADER_SIZE
+        if self.options & OPTION_SOURCE_ROUTE:
+            self.payload_offset += ROUTE.size + ROUTE_HOP.size * packet[HEADER_SIZE]
+
+    @property
+    def src_addr(self):
+        return ntoa(self._src), self.src_port
+
+    @property
+    def des_addr(self):
+        return ntoa(self._des), self.des_port
+
+    @property
+    def payload(self):
+        return self.packet[self.payload_offset:]
+
+    @property
+    def route(self):
+        """
+        (node ids, hop index) of a source routed packet, None without OPTION_SOURCE_ROUTE.
+        """
+        if not self.options & OPTION_SOURCE_ROUTE:
+            return None
+        hop_count, hop_index = ROUTE.unpack_from(self.packet, HEADER_SIZE)
+        return struct.unpack_from(f'!{hop_count}H', self.packet, HEADER_SIZE + ROUTE.size), hop_index
+
+    def verify(self):
+        """
+        Verify the payload checksum without copying the payload.
+        """
+        return zlib.crc32(self.packet[self.payload_offset:]) == self.checksum
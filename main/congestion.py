@@ -0,0 +1,160 @@
+"""
+congestion control and token-bucket pacing for the udp transport
+"""
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Token bucket pacing datagrams: rate tokens per second, at most burst tokens saved up.
+    A rate of None disables pacing.
+    """
+    def __init__(self, rate=None, burst=4):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def set_rate(self, rate):
+        with self.lock:
+            self._refill()
+            self.rate = rate
+
+    def reserve(self):
+        """
+        Take one token.
+        :return: 0 if the datagram may be sent now, otherwise seconds to wait for the next token.
+        """
+        with self.lock:
+            if self.rate is None:
+                return 0
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def _refill(self):
+        now = time.time()
+        if self.rate is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+
+class CongestionController:
+    """
+    Base class of the pluggable congestion controllers.
+    Every ack feeds on_ack with its rtt sample, so delay-based algorithms only need to override on_ack/on_loss.
+    The window is counted in packets.
+    """
+    # pacing sends pacing_gain * cwnd packets per smoothed rtt
+    pacing_gain = 2.
+
+    def __init__(self, initial_window=2, min_window=1, max_window=256):
+        self.cwnd = initial_window
+        self.min_window = min_window
+        self.max_window = max_window
+        self.pacer = TokenBucket()
+        self.lock = threading.Lock()
+
+    def window(self):
+        with self.lock:
+            return max(int(self.cwnd), self.min_window)
+
+    def on_ack(self, rtt, srtt=None):
+        """
+        One packet acknowledged. rtt is the raw sample in seconds (None for an ambiguous retransmission),
+        srtt the smoothed rtt of the destination.
+        """
+        self.update_pacing(srtt)
+
+    def on_loss(self, sent_time):
+        """
+        A packet sent at sent_time was considered lost.
+        """
+        pass
+
+    def update_pacing(self, srtt):
+        if srtt:
+            with self.lock:
+                rate = self.pacing_gain * self.cwnd / srtt
+            self.pacer.set_rate(rate)
+
+    def state(self):
+        with self.lock:
+            return {"algorithm": type(self).__name__, "cwnd": self.cwnd, "pacing_rate": self.pacer.rate}
+
+
+class AimdController(CongestionController):
+    """
+    Additive increase multiplicative decrease with slow start.
+    At most one decrease per round trip: losses of packets sent before the last decrease are ignored.
+    """
+    def __init__(self, initial_window=2, min_window=1, max_window=256, decrease_factor=0.5):
+        super().__init__(initial_window, min_window, max_window)
+        self.decrease_factor = decrease_factor
+        self.ssthresh = max_window
+        self.last_decrease = 0
+
+    def on_ack(self, rtt, srtt=None):
+        with self.lock:
+            if self.cwnd < self.ssthresh:
+                # slow start
+                self.cwnd += 1
+            else:
+                # congestion avoidance, +1 packet per window of acks
+                self.cwnd += 1 / self.cwnd
+            self.cwnd = min(self.cwnd, self.max_window)
+        self.update_pacing(srtt)
+
+    def on_loss(self, sent_time):
+        with self.lock:
+            if sent_time < self.last_decrease:
+                return
+            self.ssthresh = max(self.cwnd * self.decrease_factor, self.min_window)
+            self.cwnd = self.ssthresh
+            self.last_decrease = time.time()
+
+    def state(self):
+        res = super().state()
+        res["ssthresh"] = self.ssthresh
+        return res
+
+
+# available algorithms, register delay-based ones here
+CONTROLLERS = {
+    "aimd": AimdController,
+}
+
+
+def register_controller(name, controller_class):
+    CONTROLLERS[name] = controller_class
+
+
+# controllers survive across send_packets calls, keyed by router address
+_controllers = {}
+_controllers_lock = threading.Lock()
+
+
+def get_controller(router_addr, algorithm="aimd"):
+    """
+    Return the congestion controller of router_addr, creating one of the given algorithm on first use.
+    """
+    key = tuple(router_addr)
+    with _controllers_lock:
+        controller = _controllers.get(key)
+        if controller is None:
+            controller = CONTROLLERS[algorithm]()
+            _controllers[key] = controller
+        return controller
+
+
+def controller_states():
+    """
+    Inspect the state of every known destination: {router_addr: state dict}.
+    """
+    with _controllers_lock:
+        controllers = dict(_controllers)
+    return {addr: controller.state() for addr, controller in controllers.items()}
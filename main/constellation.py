@@ -0,0 +1,147 @@
+"""
+multi-process constellation runner: the satellite nodes of receiver_ports are split into shards, every
+worker process hosts one shard in a node_host.NodeHost, so an emulation uses as many cores as workers.
+nodes of different shards talk over their udp sockets as before, the only shared state are the satellite
+positions, kept in one shared memory array instead of the per-thread deques of global_dequeue.
+"""
+import os
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+import metrics
+
+# float64 slots per satellite: sequence number, latitude, longitude
+_SLOT = 3
+
+
+class SharedPosition:
+    """
+    One satellite's slot of SharedPositions with the append()/pop() of the deques it replaces,
+    pop() returns the latest position and keeps it, IndexError until the first append().
+    A single writer (the movement simulation) is assumed; readers never see a half written position,
+    the sequence number is odd while it is written (a seqlock).
+    """
+    __slots__ = ('slot',)
+
+    def __init__(self, slot):
+        self.slot = slot
+
+    def append(self, lat_lon):
+        slot = self.slot
+        slot[0] += 1
+        slot[1], slot[2] = lat_lon
+        slot[0] += 1
+
+    def pop(self):
+        slot = self.slot
+        while True:
+            sequence = slot[0]
+            if sequence == 0:
+                raise IndexError("no position yet")
+            lat, lon = slot[1], slot[2]
+            if sequence % 2 == 0 and slot[0] == sequence:
+                return float(lat), float(lon)
+
+
+class SharedPositions:
+    """
+    Positions of num_sats satellites in shared memory, indexable like the global_dequeue list.
+    Create it in the launcher, attach to it by name in the workers.
+    """
+    def __init__(self, num_sats, name=None):
+        self.num_sats = num_sats
+        create = name is None
+        self.shm = shared_memory.SharedMemory(name=name, create=create, size=num_sats * _SLOT * 8)
+        self.array = np.ndarray((num_sats, _SLOT), dtype=np.float64, buffer=self.shm.buf)
+        if create:
+            self.array[:] = 0
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def __len__(self):
+        return self.num_sats
+
+    def __getitem__(self, index):
+        return SharedPosition(self.array[index])
+
+    def close(self):
+        # the numpy view holds the buffer, release it before the mapping
+        self.array = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+def shard(receiver_ports, workers):
+    """
+    Split the nodes into at most workers contiguous shards.
+    :return: lists of (node id, node name, port), node ids are the positions in receiver_ports.
+    """
+    nodes = [(node_id, node_name, port) for node_id, (node_name, port) in enumerate(receiver_ports.items())]
+    workers = max(min(workers, len(nodes)), 1)
+    size, extra = divmod(len(nodes), workers)
+    shards = []
+    start = 0
+    for worker in range(workers):
+        end = start + size + (1 if worker < extra else 0)
+        shards.append(nodes[start:end])
+        start = end
+    return shards
+
+
+def _worker(positions_name, num_sats, nodes, receiver_ports, buffer_size, encryption, metrics_port, ready):
+    # imported here, the launcher itself does not need the node code
+    from node_host import NodeHost
+    from satellite_server_modified import SatelliteNode
+    positions = SharedPositions(num_sats, name=positions_name)
+    if metrics_port is not None:
+        metrics.serve(metrics_port)
+    host = NodeHost(buffer_size)
+    try:
+        for node_id, node_name, port in nodes:
+            host.add(SatelliteNode(positions, port, receiver_ports, node_name, node_id, encryption))
+        ready.set()
+        host.run()
+    finally:
+        host.close()
+        positions.close()
+
+
+class Constellation:
+    """
+    The worker processes of one sharded emulation.
+    positions (SharedPositions) is what the movement simulation appends to, e.g.
+    threading.Thread(target=keep_moving, args=(constellation.positions, ...)).
+    With metrics_port given worker i serves its own metrics on metrics_port + i.
+    """
+    def __init__(self, receiver_ports, num_sats, workers=None, buffer_size=2048, encryption=True, metrics_port=None):
+        self.positions = SharedPositions(num_sats)
+        self.processes = []
+        self.shards = shard(receiver_ports, workers or os.cpu_count() or 1)
+        for worker, nodes in enumerate(self.shards):
+            ready = multiprocessing.Event()
+            process = multiprocessing.Process(
+                target=_worker, daemon=True, name=f"constellation-{worker}",
+                args=(self.positions.name, num_sats, nodes, receiver_ports, buffer_size, encryption,
+                      None if metrics_port is None else metrics_port + worker, ready))
+            process.start()
+            self.processes.append((process, ready))
+
+    def wait_ready(self, timeout=None):
+        """
+        Block until every worker has bound its sockets.
+        :return: False on timeout.
+        """
+        return all(ready.wait(timeout) for _, ready in self.processes)
+
+    def stop(self):
+        for process, _ in self.processes:
+            process.terminate()
+        for process, _ in self.processes:
+            process.join()
+        self.processes = []
+        self.positions.close()
+        self.positions.unlink()
@@ -0,0 +1,123 @@
+"""
+sending a message from an earth station through the satellites, shared by the earth clients:
+one source routed path packet per route (codec.OPTION_SOURCE_ROUTE), sent ahead of the data with cut-through
+or after it otherwise, striping over several satellites (multipath.py), handover of a single route to another
+satellite and the path of a route sent again when its transfer restarts under a new message id.
+the clients only differ in how they predict the latency of a satellite.
+"""
+import time
+import numpy as np
+from protocol import send_packets, send_path
+from codec import PacketView, encode_packet, new_message_id
+from multipath import path_weights, send_striped
+from s2s import calulate_routing_path
+
+
+def send_over_satellites(routing_manager, receiver_ports, satellite_positions, active_satellites, predictions,
+                         predict_latencies, message, earth1_addr, earth2_addr, destination='earth2', keys=None,
+                         compression=None, cut_through=True, multipath=1, packet_encryption=False, **kwargs):
+    """
+    Send message from earth1_addr to earth2_addr over the multipath satellites with the lowest predicted latency.
+    :param satellite_positions: node name -> (latitude, longitude) of the satellites and the destination.
+    :param active_satellites: the routing table of routing_manager, predictions are the latencies in its order.
+    :param predict_latencies: predict_latencies(routing table) -> predicted latencies, to pick a handover satellite.
+    :param keys: encryption.KeyManager, None sends the message in the clear.
+    :param kwargs: timeout, chunk_size, buffer_size and debug_interval of protocol.send_packets.
+    """
+    # the message is striped over the multipath satellites with the lowest predicted latency, best first;
+    # every stripe is a message of its own with its own path
+    sat_ids = list(active_satellites.keys())
+    chosen = np.argsort(predictions, kind='stable')[:max(multipath, 1)]
+    routes = []  # (satellite id, router address, message id, next hop, path packet) per stripe
+    # binary source routes are lists of node ids, their position in receiver_ports
+    node_ids = {node_name: node_id for node_id, node_name in enumerate(receiver_ports)}
+    for index in chosen:
+        satellite_id = f"sat{sat_ids[index]}"
+        # calculate routing path
+        path = calulate_routing_path(satellite_positions, satellite_id, destination)
+        # this server address should be decided by the rounting manager
+        server_addr = ['127.0.0.1',
+                       active_satellites[sat_ids[index]]['address']]  # current receiver satellite(router) address
+        # the satellites join the path and the data of the message by its id
+        message_id = new_message_id()
+        # Handle sending packets for A* (or use Dijkstra if desired)
+        if path and len(path) > 1:
+            # every satellite on the path advances its hop index in place and passes the same packet on
+            packet = encode_packet(earth1_addr[0], earth1_addr[1], earth2_addr[0], earth2_addr[1], b'',
+                                   flag='path', message_id=message_id, route=[node_ids[hop] for hop in path])
+            routes.append((satellite_id, server_addr, message_id, path[0], packet))
+        else:
+            print(f"No valid A* path to {destination} from {satellite_id}")
+            routes.append((satellite_id, server_addr, message_id, None, None))
+
+    def send_paths():
+        for satellite_id, _, _, next_hop, packet in routes:
+            if packet is not None:
+                send_path(satellite_id, next_hop, receiver_ports[next_hop], packet)
+        print("----Earth finish sending path-----------")
+
+    current_satellite = [sat_ids[chosen[0]]]
+
+    def handover(router_addr, stalled):
+        # the satellite in use left range (its inquiries time out) or the transfer stalled on it: continue
+        # through the best other satellite in range, the new path keeps the message id, so the destination
+        # joins what arrived over both routes
+        if not stalled and routing_manager.in_range(current_satellite[0]):
+            return None
+        candidates = {sat_id: info for sat_id, info in dict(routing_manager.get_active_satellites()).items()
+                      if sat_id != current_satellite[0] and routing_manager.in_range(sat_id)}
+        if not candidates:
+            return None
+        latencies = predict_latencies(candidates)
+        sat_id = list(candidates)[int(np.argmin(latencies))]
+        path = calulate_routing_path(satellite_positions, f"sat{sat_id}", destination)
+        if not path or len(path) < 2:
+            return None
+        packet = encode_packet(earth1_addr[0], earth1_addr[1], earth2_addr[0], earth2_addr[1], b'',
+                               flag='path', message_id=routes[0][2], route=[node_ids[hop] for hop in path])
+        send_path(f"sat{sat_id}", path[0], receiver_ports[path[0]], packet)
+        print(f"Handover from satellite {current_satellite[0]} to {sat_id}")
+        current_satellite[0] = sat_id
+        server_addr = ['127.0.0.1', candidates[sat_id]['address']]
+        routes[0] = (f"sat{sat_id}", server_addr, routes[0][2], path[0], packet)
+        return server_addr
+
+    def restart(index, message_id):
+        # the transfer over route index starts over with smaller chunks under a new message id,
+        # the satellites of the route need its path packet again with that id
+        satellite_id, server_addr, _, next_hop, packet = routes[index]
+        if packet is not None:
+            hops, _ = PacketView(packet).route
+            packet = encode_packet(earth1_addr[0], earth1_addr[1], earth2_addr[0], earth2_addr[1], b'',
+                                   flag='path', message_id=message_id, route=list(hops))
+            if cut_through:
+                send_path(satellite_id, next_hop, receiver_ports[next_hop], packet)
+        routes[index] = (satellite_id, server_addr, message_id, next_hop, packet)
+
+    # cut-through: the paths go first, so every satellite can relay the chunks as they arrive;
+    # otherwise the paths follow the whole message
+    if cut_through:
+        send_paths()
+    start_time = time.time()
+    try:
+        if len(routes) == 1:
+            # a single route is handed over when its satellite leaves range, stripes are not; only with
+            # cut-through, a satellite holding part of a message for its path would never complete it
+            send_packets(earth1_addr, earth2_addr, routes[0][1], message, compression=compression,
+                         message_id=routes[0][2],
+                         handover=handover if cut_through and routes[0][4] is not None else None,
+                         encryption=keys, packet_encryption=packet_encryption,
+                         restart=lambda message_id: restart(0, message_id), **kwargs)
+        else:
+            router_addrs = [route[1] for route in routes]
+            send_striped(earth1_addr, earth2_addr, router_addrs, message,
+                         weights=path_weights(router_addrs, [predictions[index] for index in chosen]),
+                         message_ids=[route[2] for route in routes], compression=compression,
+                         encryption=keys, packet_encryption=packet_encryption, restart=restart, **kwargs)
+    except TimeoutError as e:
+        print(f"Failed to send the message: {e}")
+        return
+    print(f"----Earth finish sending data in {time.time() - start_time:.2f} s-----------")
+    if not cut_through:
+        time.sleep(1)
+        send_paths()
@@ -2,9 +2,41 @@
 aes encryption and decryption: Sanjiv
 """
 import socket
+import struct
+import threading
+import time
+from collections import OrderedDict
+from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.exceptions import InvalidTag
 import os
 import base64
+import metrics
+from codec import CONTROL_FLAGS, OPTION_CHUNK_ENCRYPTED, OPTION_COMPRESSED, OPTION_ENCRYPTED, resolve
+from compression import decompress
+
+# aes-gcm nonce and tag sizes, a sealed message is nonce + ciphertext + tag
+NONCE_SIZE = 12
+TAG_SIZE = 16
+# seconds between two looks at the key file for a new key
+RELOAD_INTERVAL = 1.
+# seconds a session subkey is used for, and the number of subkeys kept
+EPOCH_LENGTH = 60.
+MAX_SESSIONS = 1024
+# hkdf info of a session subkey: SESSION_INFO + source ip(4) port(2) destination ip(4) port(2) epoch(4)
+SESSION_INFO = b'satellite session key'
+SESSION = struct.Struct('!4sH4sHI')
+# the epoch heads the nonce of a message sealed as a whole under a session subkey
+EPOCH = struct.Struct('!I')
+# a chunk sealed on its own (codec.OPTION_CHUNK_ENCRYPTED) authenticates the header fields no relay changes:
+# source ip(4) port(2) destination ip(4) port(2) control flag(1) packet number(4) total packet number(4)
+# message id(4), the same bytes as header[0:13] + header[14:22] + header[30:34]
+CHUNK_AAD = struct.Struct('!4sH4sHBIII')
+# and its nonce is source ip(4) message id(4) packet number(4), unique as long as a source does not
+# reuse a message id in one epoch (see Session)
+CHUNK_NONCE = struct.Struct('!4sII')
 
 def read_key_and_salt(file_path="aes_key_salt.txt"):
     """
@@ -63,4 +95,398 @@ def aes_decrypt(encrypted_data, key):
         return decrypted_data.decode('utf-8')
     except Exception as e:
         print(f"Error during decryption: {e}")
-        raise
\ No newline at end of file
+        raise
+
+
+class KeyManager:
+    """
+    The AES key of key_file, read and decoded once, read again when the file changes (looked at at most
+    every reload_interval seconds), and its AES-GCM context.
+    encrypt()/decrypt() take and return bytes: nonce(12) + ciphertext + tag(16) on the wire, 28 bytes
+    more than the plaintext instead of the third base64 adds with aes_encrypt().
+    The key is the master key (the PBKDF2 output of generate_aes_key.py), messages are sealed with the
+    session subkeys derived from it (session()), at most max_sessions of them are kept.
+    """
+    def __init__(self, key_file="aes_key_salt.txt", reload_interval=RELOAD_INTERVAL, epoch_length=EPOCH_LENGTH,
+                 max_sessions=MAX_SESSIONS):
+        self.key_file = key_file
+        self.reload_interval = reload_interval
+        self.epoch_length = epoch_length
+        self.max_sessions = max_sessions
+        self.lock = threading.Lock()
+        self.key = None
+        self.salt = None
+        self.aesgcm = None
+        self._sessions = OrderedDict()  # (pair, epoch) -> (key, AESGCM), least recently used first
+        self.chunk_epochs = {}  # pair -> epoch that last opened one of its chunks
+        self._file_state = None
+        self._checked = time.monotonic()
+        self.reloads = metrics.counter('key_reloads')
+        self.derived = metrics.counter('session_keys_derived')
+        self._load()
+
+    def _load(self):
+        stat = os.stat(self.key_file)
+        aes_key, salt = read_key_and_salt(self.key_file)
+        key = base64.urlsafe_b64decode(pad_base64(aes_key.strip()))
+        # swapped as one, a concurrent caller sees the old context or the new one
+        self.key, self.salt, self.aesgcm = key, salt.encode('utf-8'), AESGCM(key)
+        # subkeys of the old master key
+        self._sessions = OrderedDict()
+        self.chunk_epochs = {}
+        self._file_state = (stat.st_mtime_ns, stat.st_size)
+
+    def refresh(self):
+        """
+        Load the key again if its file changed.
+        """
+        now = time.monotonic()
+        if now - self._checked < self.reload_interval:
+            return
+        self._checked = now
+        try:
+            stat = os.stat(self.key_file)
+        except OSError:
+            # keep the key we have while the file is being replaced
+            return
+        if (stat.st_mtime_ns, stat.st_size) != self._file_state:
+            with self.lock:
+                self._load()
+            self.reloads.inc()
+            if metrics.LOG_INFO:
+                print(f"Reloaded AES key from {self.key_file}")
+
+    def encrypt(self, data, associated_data=None):
+        """
+        Seal data (bytes-like) with AES-GCM under a random nonce.
+        """
+        self.refresh()
+        nonce = os.urandom(NONCE_SIZE)
+        return nonce + self.aesgcm.encrypt(nonce, data, associated_data)
+
+    def decrypt(self, data, associated_data=None):
+        """
+        Open what encrypt() sealed.
+        :raises cryptography.exceptions.InvalidTag: data was not sealed with this key or was altered.
+        """
+        self.refresh()
+        data = memoryview(data)
+        return self.aesgcm.decrypt(data[:NONCE_SIZE], data[NONCE_SIZE:], associated_data)
+
+    def epoch(self):
+        """
+        Number of the current session epoch, epoch_length seconds each.
+        """
+        return int(time.time() // self.epoch_length) & 0xFFFFFFFF
+
+    def session(self, src_addr, des_addr):
+        """
+        The Session of the messages from src_addr to des_addr, (host, port) each.
+        """
+        self.refresh()
+        return Session(self, src_addr, des_addr)
+
+    def session_key(self, pair, epoch):
+        """
+        (key, AESGCM context) of a source -> destination pair (packed ip, port, packed ip, port) in epoch:
+        derived from the master key with HKDF-SHA256 on first use, then kept in a bounded LRU.
+        """
+        cache_key = (pair, epoch)
+        with self.lock:
+            entry = self._sessions.get(cache_key)
+            if entry is not None:
+                self._sessions.move_to_end(cache_key)
+                return entry
+            master, salt, sessions = self.key, self.salt, self._sessions
+        key = HKDF(algorithm=hashes.SHA256(), length=len(master), salt=salt,
+                   info=SESSION_INFO + SESSION.pack(*pair, epoch)).derive(master)
+        entry = (key, AESGCM(key))
+        with self.lock:
+            sessions[cache_key] = entry
+            while len(sessions) > self.max_sessions:
+                sessions.popitem(last=False)
+        self.derived.inc()
+        return entry
+
+
+class Session:
+    """
+    Keys of the messages from one source to one destination, see KeyManager.session(): one subkey per
+    epoch, so keys change every epoch_length seconds without a new master key or a look at the key file.
+    Same interface as KeyManager plus the streaming and chunk sealing, a message is sealed in the epoch the
+    session was opened in. A message sealed as a whole names its epoch in the first 4 bytes of its nonce,
+    a chunk sealed on its own does not: it is opened in the epoch that last opened a chunk of the pair,
+    else in the current, the previous or the next one.
+    """
+    def __init__(self, manager, src_addr, des_addr):
+        self.manager = manager
+        self.pair = (resolve(src_addr[0]), src_addr[1], resolve(des_addr[0]), des_addr[1])
+        self.epoch = manager.epoch()
+        self._contexts = {}  # epoch -> AESGCM, looked up in the manager once per session
+
+    def _aesgcm(self, epoch):
+        aesgcm = self._contexts.get(epoch)
+        if aesgcm is None:
+            aesgcm = self._contexts[epoch] = self.manager.session_key(self.pair, epoch)[1]
+        return aesgcm
+
+    def _nonce(self):
+        return EPOCH.pack(self.epoch) + os.urandom(NONCE_SIZE - EPOCH.size)
+
+    def _key_of_nonce(self, nonce):
+        return self.manager.session_key(self.pair, EPOCH.unpack_from(nonce)[0])[0]
+
+    def encrypt(self, data, associated_data=None):
+        nonce = self._nonce()
+        return nonce + self._aesgcm(self.epoch).encrypt(nonce, data, associated_data)
+
+    def decrypt(self, data, associated_data=None):
+        """
+        :raises cryptography.exceptions.InvalidTag: see KeyManager.decrypt().
+        """
+        data = memoryview(data)
+        if len(data) < NONCE_SIZE + TAG_SIZE:
+            raise InvalidTag()
+        return self._aesgcm(EPOCH.unpack_from(data)[0]).decrypt(data[:NONCE_SIZE], data[NONCE_SIZE:], associated_data)
+
+    def encryptor(self):
+        """
+        A StreamEncryptor for a message sealed as a whole piece by piece.
+        """
+        return StreamEncryptor(self.manager.session_key(self.pair, self.epoch)[0], self._nonce())
+
+    def decryptor(self):
+        return StreamDecryptor(self._key_of_nonce)
+
+    def seal_chunk(self, chunk, src_ip, src_port, des_ip, des_port, flag, packet_number, total_packets, message_id):
+        """
+        Seal one data chunk of a message sent with codec.OPTION_CHUNK_ENCRYPTED: ciphertext + tag(16).
+        src_ip and des_ip are packed, flag is the whole control flag byte (options included).
+        """
+        aad = CHUNK_AAD.pack(src_ip, src_port, des_ip, des_port, flag, packet_number, total_packets, message_id)
+        return self._aesgcm(self.epoch).encrypt(CHUNK_NONCE.pack(src_ip, message_id, packet_number), chunk, aad)
+
+    def open_chunk(self, chunk, src_ip, src_port, des_ip, des_port, flag, packet_number, total_packets, message_id):
+        """
+        Open what seal_chunk() sealed, the arguments are the same.
+        :raises cryptography.exceptions.InvalidTag: the chunk or its header was altered or sealed with another key.
+        """
+        aad = CHUNK_AAD.pack(src_ip, src_port, des_ip, des_port, flag, packet_number, total_packets, message_id)
+        nonce = CHUNK_NONCE.pack(src_ip, message_id, packet_number)
+        manager = self.manager
+        # the sessions of a manager are shared by the sender threads of a striped message
+        with manager.lock:
+            last = manager.chunk_epochs.get(self.pair)
+        if last is not None:
+            try:
+                return self._aesgcm(last).decrypt(nonce, chunk, aad)
+            except InvalidTag:
+                pass
+        now = manager.epoch()
+        for epoch in (now, now - 1, now + 1):
+            if epoch == last:
+                continue
+            try:
+                plaintext = self._aesgcm(epoch).decrypt(nonce, chunk, aad)
+            except InvalidTag:
+                continue
+            with manager.lock:
+                if len(manager.chunk_epochs) >= manager.max_sessions:
+                    manager.chunk_epochs.clear()
+                manager.chunk_epochs[self.pair] = epoch
+            return plaintext
+        raise InvalidTag()
+
+    def open_packet(self, packet_view):
+        """
+        Open the chunk of a received data packet (codec.PacketView) sealed with codec.OPTION_CHUNK_ENCRYPTED.
+        :raises cryptography.exceptions.InvalidTag: see open_chunk().
+        """
+        return self.open_chunk(packet_view.payload, packet_view._src, packet_view.src_port, packet_view._des,
+                               packet_view.des_port, packet_view.control_flag | packet_view.options,
+                               packet_view.packet_num, packet_view.total_packet, packet_view.message_id)
+
+
+class StreamEncryptor:
+    """
+    AES-GCM over a message handed in piece by piece: update() returns the ciphertext of each piece,
+    finalize() the tag. nonce + ciphertext + tag is what KeyManager.encrypt() would have sealed
+    (Session.encryptor() passes the nonce naming its epoch).
+    """
+    def __init__(self, key, nonce=None):
+        self.key = key
+        self.nonce = nonce if nonce is not None else os.urandom(NONCE_SIZE)
+        self._encryptor = Cipher(algorithms.AES(key), modes.GCM(self.nonce)).encryptor()
+        self.tag = None
+
+    def update(self, data):
+        return self._encryptor.update(data)
+
+    def finalize(self):
+        self._encryptor.finalize()
+        self.tag = self._encryptor.tag
+        return self.tag
+
+    def encrypt_at(self, offset, data):
+        """
+        Ciphertext of data found at offset of the plaintext, again, e.g. for a retransmission:
+        gcm encrypts in counter mode, 16 byte block i with the counter nonce + (2 + i).
+        """
+        counter = self.nonce + (2 + offset // 16).to_bytes(4, 'big')
+        encryptor = Cipher(algorithms.AES(self.key), modes.CTR(counter)).encryptor()
+        encryptor.update(bytes(offset % 16))
+        return encryptor.update(data)
+
+
+class StreamDecryptor:
+    """
+    Open what StreamEncryptor or KeyManager.encrypt() sealed, handed in piece by piece:
+    update() returns the plaintext of what can be decrypted so far, finalize() the rest after checking
+    the tag (the last TAG_SIZE bytes). Nothing is authentic before finalize() returned.
+    key is the AES key, or a function of the nonce returning it.
+    """
+    def __init__(self, key):
+        self.key = key
+        self._decryptor = None
+        self._pending = b''  # the nonce while it is incomplete, then the last TAG_SIZE bytes seen
+
+    def update(self, data):
+        data = self._pending + bytes(data)
+        if self._decryptor is None:
+            if len(data) < NONCE_SIZE:
+                self._pending = data
+                return b''
+            nonce = data[:NONCE_SIZE]
+            key = self.key(nonce) if callable(self.key) else self.key
+            self._decryptor = Cipher(algorithms.AES(key), modes.GCM(nonce)).decryptor()
+            data = data[NONCE_SIZE:]
+        self._pending = data[-TAG_SIZE:]
+        return self._decryptor.update(data[:-TAG_SIZE])
+
+    def finalize(self):
+        """
+        :raises cryptography.exceptions.InvalidTag: the message was altered, cut short or sealed with another key.
+        """
+        if self._decryptor is None or len(self._pending) < TAG_SIZE:
+            raise InvalidTag()
+        return self._decryptor.finalize_with_tag(self._pending)
+
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+
+def get_key_manager(key_file="aes_key_salt.txt"):
+    """
+    The KeyManager of key_file, shared by every node and sender of the process.
+    """
+    with _managers_lock:
+        manager = _managers.get(key_file)
+        if manager is None:
+            manager = _managers[key_file] = KeyManager(key_file)
+        return manager
+
+
+class OpenedChunks:
+    """
+    Plaintext of one message sealed chunk by chunk (codec.OPTION_CHUNK_ENCRYPTED), written as its chunks
+    are opened on arrival. Like reassembly.PartialMessage, all chunks but the last have the same size.
+    """
+    __slots__ = ('total_packet', 'chunk_size', 'buffer', 'tail', 'opened')
+
+    def __init__(self, total_packet):
+        self.total_packet = total_packet
+        self.chunk_size = None
+        self.buffer = None
+        self.tail = b''
+        self.opened = set()  # packet numbers written
+
+    def add(self, packet_number, plaintext):
+        if packet_number == self.total_packet - 1:
+            self.tail = plaintext
+        else:
+            if self.buffer is None:
+                self.chunk_size = len(plaintext)
+                self.buffer = bytearray(self.chunk_size * (self.total_packet - 1))
+            elif len(plaintext) != self.chunk_size:
+                # opened again from the reassembled ciphertext in open_chunks()
+                return
+            offset = packet_number * self.chunk_size
+            self.buffer[offset:offset + self.chunk_size] = plaintext
+        self.opened.add(packet_number)
+
+
+class OpenedStream:
+    """
+    Plaintext of one message sealed as a whole (codec.OPTION_ENCRYPTED), decrypted while it arrives:
+    its chunks go through a StreamDecryptor as soon as all chunks before them are there.
+    """
+    __slots__ = ('decryptor', 'fed', 'plaintext')
+
+    def __init__(self, session):
+        self.decryptor = session.decryptor()
+        self.fed = 0  # chunks decrypted
+        self.plaintext = bytearray()
+
+    def feed(self, message):
+        """
+        Decrypt the chunks of message (reassembly.PartialMessage) received in order since the last call.
+        """
+        for packet_number in range(self.fed, message.cumulative):
+            self.plaintext += self.decryptor.update(message.chunk(packet_number))
+        self.fed = max(self.fed, message.cumulative)
+
+    def finish(self, data, chunk_size):
+        """
+        The whole plaintext once the message is complete, data being its reassembled bytes.
+        :raises cryptography.exceptions.InvalidTag: see StreamDecryptor.finalize().
+        """
+        self.plaintext += self.decryptor.update(memoryview(data)[self.fed * (chunk_size or 0):])
+        self.plaintext += self.decryptor.finalize()
+        return self.plaintext
+
+
+def open_chunks(session, data, chunk_size, src_addr, des_addr, options, message_id, total_packet, opened=None):
+    """
+    Plaintext (bytes-like) of a message sealed chunk by chunk, data being its reassembled ciphertext
+    of chunk_size byte sealed chunks, addresses and options those of its header, session its Session.
+    opened (OpenedChunks) holds the chunks already opened on arrival, only the others are opened here
+    (chunks rebuilt by forward error correction, or all of them).
+    :raises cryptography.exceptions.InvalidTag: see Session.open_chunk().
+    """
+    if opened is None:
+        opened = OpenedChunks(total_packet)
+    data = memoryview(data)
+    src_ip, des_ip = resolve(src_addr[0]), resolve(des_addr[0])
+    flag = CONTROL_FLAGS['data'] | options
+    for packet_number in range(total_packet):
+        if packet_number in opened.opened:
+            continue
+        offset = packet_number * (chunk_size or 0)
+        chunk = data[offset:offset + chunk_size] if packet_number < total_packet - 1 else data[offset:]
+        opened.add(packet_number, session.open_chunk(chunk, src_ip, src_addr[1], des_ip, des_addr[1], flag,
+                                                     packet_number, total_packet, message_id))
+    if opened.buffer is None:
+        return opened.tail
+    opened.buffer += opened.tail
+    return opened.buffer
+
+
+def open_message(binary_stream, options, keys=None):
+    """
+    Turn a reassembled message back into the bytes that were sent: decrypted (codec.OPTION_ENCRYPTED) with keys,
+    the Session of its source and destination, then decompressed (codec.OPTION_COMPRESSED). Messages may be
+    binary, decoding text is up to the receiver. An encrypted message is returned as it is when there are
+    no keys to open it, as is one sealed chunk by chunk (codec.OPTION_CHUNK_ENCRYPTED), which open_chunks() opens first.
+    :raises cryptography.exceptions.InvalidTag: the message was altered or sealed with another key.
+    :raises compression.DecompressionError: the message does not decompress.
+    """
+    if options & OPTION_CHUNK_ENCRYPTED:
+        return bytes(binary_stream)
+    if options & OPTION_ENCRYPTED:
+        if keys is None:
+            return bytes(binary_stream)
+        binary_stream = keys.decrypt(binary_stream)
+    if options & OPTION_COMPRESSED:
+        binary_stream = decompress(binary_stream)
+    return bytes(binary_stream)
@@ -0,0 +1,170 @@
+"""
+forward error correction for high-rtt lossy links
+every block of n data packets is followed by k repair packets ('repair' control flag, header packet number
+= first packet number of the block), the receiver rebuilds up to k lost chunks of a block without a round trip.
+xor: k = 1 parity packet. rs: Reed-Solomon style erasure code, systematic Cauchy matrix over GF(256),
+any k of the n + k packets of a block may be lost.
+repair payload: scheme(1) n(1) k(1) repair index(1) length of the last chunk of the block(2) coded bytes
+"""
+import math
+import struct
+import threading
+
+XOR = 0
+RS = 1
+SCHEMES = {'xor': XOR, 'rs': RS}
+REPAIR_HEADER = struct.Struct('!BBBBH')
+
+# assumed loss rate of a route before anything was measured
+DEFAULT_LOSS = 0.05
+# acceptable probability that a block cannot be rebuilt
+TARGET_BLOCK_FAILURE = 0.01
+
+
+def _build_tables():
+    # GF(256) with the primitive polynomial x^8 + x^4 + x^3 + x^2 + 1
+    exp = [0] * 512
+    log = [0] * 256
+    x = 1
+    for i in range(255):
+        exp[i] = x
+        log[x] = i
+        x <<= 1
+        if x & 0x100:
+            x ^= 0x11d
+    for i in range(255, 512):
+        exp[i] = exp[i - 255]
+    return exp, log
+
+
+EXP, LOG = _build_tables()
+
+
+def gf_mul(a, b):
+    if a == 0 or b == 0:
+        return 0
+    return EXP[LOG[a] + LOG[b]]
+
+
+def gf_inv(a):
+    return EXP[255 - LOG[a]]
+
+
+# MUL_TABLES[c] maps every byte x to c * x, so bytes.translate scales a whole chunk at C speed
+MUL_TABLES = [bytes(gf_mul(c, x) for x in range(256)) for c in range(256)]
+
+
+def _xor(a, b):
+    return (int.from_bytes(a, 'little') ^ int.from_bytes(b, 'little')).to_bytes(len(a), 'little')
+
+
+def _scale(data, c):
+    if c == 1:
+        return data
+    return data.translate(MUL_TABLES[c])
+
+
+def coefficient(scheme, row, col, n):
+    """
+    Weight of data chunk col in repair packet row.
+    rs uses the Cauchy matrix 1 / (x_row + y_col) with x_row = n + row, y_col = col,
+    every square sub-matrix of it is invertible.
+    """
+    if scheme == XOR:
+        return 1
+    return gf_inv((n + row) ^ col)
+
+
+def encode_block(chunks, k, scheme=RS):
+    """
+    :param chunks: payloads of the n data packets of a block, all but the last one of equal size.
+    :return: k repair payloads.
+    """
+    n = len(chunks)
+    if scheme == XOR:
+        k = 1
+    assert n + k <= 256, "a block holds at most 256 packets"
+    chunk_size = max(len(chunk) for chunk in chunks)
+    padded = [bytes(chunk).ljust(chunk_size, b'\0') for chunk in chunks]
+    repairs = []
+    for row in range(k):
+        coded = bytes(chunk_size)
+        for col, chunk in enumerate(padded):
+            coded = _xor(coded, _scale(chunk, coefficient(scheme, row, col, n)))
+        repairs.append(REPAIR_HEADER.pack(scheme, n, k, row, len(chunks[-1])) + coded)
+    return repairs
+
+
+def decode_block(chunks, repairs, n, scheme=RS):
+    """
+    Rebuild the lost chunks of a block.
+    :param chunks: {index in block: chunk} of the received data chunks, the last one may be shorter.
+    :param repairs: {repair index: coded bytes}.
+    :return: {index in block: chunk padded to the coded size}, empty if too many chunks are missing.
+    """
+    missing = [i for i in range(n) if i not in chunks]
+    if not missing or len(missing) > len(repairs):
+        return {}
+    rows = sorted(repairs)[:len(missing)]
+    chunk_size = len(repairs[rows[0]])
+    # syndromes: the repair packets minus the contribution of the chunks we have
+    syndromes = []
+    for row in rows:
+        coded = bytes(repairs[row])
+        for col, chunk in chunks.items():
+            coded = _xor(coded, _scale(bytes(chunk).ljust(chunk_size, b'\0'), coefficient(scheme, row, col, n)))
+        syndromes.append(coded)
+    matrix = [[coefficient(scheme, row, col, n) for col in missing] for row in rows]
+
+    # gaussian elimination over GF(256), the right hand sides are whole chunks
+    size = len(missing)
+    for col in range(size):
+        pivot = next(r for r in range(col, size) if matrix[r][col])
+        matrix[col], matrix[pivot] = matrix[pivot], matrix[col]
+        syndromes[col], syndromes[pivot] = syndromes[pivot], syndromes[col]
+        inv = gf_inv(matrix[col][col])
+        matrix[col] = [gf_mul(inv, a) for a in matrix[col]]
+        syndromes[col] = _scale(syndromes[col], inv)
+        for r in range(size):
+            factor = matrix[r][col]
+            if r != col and factor:
+                matrix[r] = [a ^ gf_mul(factor, b) for a, b in zip(matrix[r], matrix[col])]
+                syndromes[r] = _xor(syndromes[r], _scale(syndromes[col], factor))
+    return dict(zip(missing, syndromes))
+
+
+def repair_count(loss, block_size, scheme=RS, target=TARGET_BLOCK_FAILURE, max_repair=None):
+    """
+    Smallest number of repair packets keeping the chance that more than k of the
+    block_size + k packets of a block get lost below target.
+    """
+    if scheme == XOR:
+        return 1
+    if max_repair is None:
+        max_repair = block_size
+    for k in range(1, max_repair + 1):
+        total = block_size + k
+        failure = sum(math.comb(total, lost) * loss ** lost * (1 - loss) ** (total - lost)
+                      for lost in range(k + 1, total + 1))
+        if failure <= target:
+            return k
+    return max_repair
+
+
+# measured loss rate per route, exponentially weighted over transfers
+_loss_rates = {}
+_loss_lock = threading.Lock()
+
+
+def record_loss(router_addr, sent, lost, weight=0.25):
+    if not sent:
+        return
+    key = tuple(router_addr)
+    with _loss_lock:
+        previous = _loss_rates.get(key, DEFAULT_LOSS)
+        _loss_rates[key] = (1 - weight) * previous + weight * min(lost / sent, 1.)
+
+
+def loss_rate(router_addr):
+    with _loss_lock:
+        return _loss_rates.get(tuple(router_addr), DEFAULT_LOSS)
@@ -0,0 +1,272 @@
+"""
+flow-keyed forwarding at relay nodes
+a flow is one message, keyed by (header source address, message id). its path packet and its data may arrive
+in either order, both are joined on the flow:
+- path first (cut-through): the route is installed and the path passed on at once, data chunks are relayed
+  to the next hop as soon as they arrive instead of after the whole message was reassembled.
+- data first (store-and-forward): the reassembled message is held until its path arrives, then relayed.
+each hop still acknowledges its upstream and retransmits to its downstream (a streaming transfer.Transfer
+per flow), so a loss is repaired on the hop where it happened.
+flows are bounded in number and held bytes and dropped after flow_timeout seconds without activity,
+a flow whose path never comes cannot block any other.
+"""
+import time
+from collections import OrderedDict
+import metrics
+from cryptography.exceptions import InvalidTag
+from codec import CONTROL_FLAGS, OPTION_CHUNK_ENCRYPTED, OPTION_STRIPE, encode_packet
+from compression import DecompressionError
+from encryption import open_chunks, open_message
+from transfer import Transfer
+from multipath import StripeAssembler
+
+
+class Flow:
+    __slots__ = ('key', 'routed', 'next_hop', 'message', 'data', 'header', 'transfer', 'relayed',
+                 'delivered', 'last_activity')
+
+    def __init__(self, key):
+        self.key = key
+        self.routed = False
+        self.next_hop = None  # address of the next hop, None at the destination
+        self.message = None  # reassembly.PartialMessage of the data arriving here
+        self.data = None  # the reassembled message while it waits for its path
+        self.header = None  # (src_addr, des_addr, options, ttl) of the data packets
+        self.transfer = None  # relay towards next_hop
+        self.relayed = set()  # packet numbers handed to the transfer
+        self.delivered = False
+        self.last_activity = time.time()
+
+
+class ForwardingTable:
+    """
+    Forwarding state of one node, see the module docstring.
+    keys (encryption.KeyManager) opens the sealed messages delivered here; chunks sealed on their own
+    (codec.OPTION_CHUNK_ENCRYPTED) are relayed as they came, protocol.send_ack verified them.
+    """
+    def __init__(self, node_name, flow_timeout=60., max_flows=1024, max_held_bytes=64 * 1024 * 1024,
+                 timeout=1., window_size=32, congestion='aimd', keys=None):
+        self.node_name = node_name
+        self.flow_timeout = flow_timeout
+        self.max_flows = max_flows
+        self.max_held_bytes = max_held_bytes
+        self.timeout = timeout
+        self.window_size = window_size
+        self.congestion = congestion
+        self.keys = keys
+        self.flows = OrderedDict()  # flow key -> Flow, least recently active first
+        self.held_bytes = 0
+        # stripes of multipath messages delivered here
+        self.stripes = StripeAssembler(timeout=flow_timeout, keys=keys)
+        self.forwarded = metrics.counter('packets_forwarded', node=node_name)
+        self.dropped = metrics.counter('flows_dropped', node=node_name)
+        self.flow_gauge = metrics.gauge('flows', node=node_name)
+        self.held_gauge = metrics.gauge('flow_held_bytes', node=node_name)
+
+    def _flow(self, key):
+        flow = self.flows.get(key)
+        if flow is None:
+            flow = Flow(key)
+            self.flows[key] = flow
+            while len(self.flows) > self.max_flows:
+                self._drop(next(iter(self.flows)), "too many flows")
+        else:
+            self.flows.move_to_end(key)
+            flow.last_activity = time.time()
+        return flow
+
+    def install(self, key, next_hop):
+        """
+        Route the flow key to next_hop, an address, or None if this node is its destination.
+        Data that arrived before the route is relayed from here on.
+        :return: the message (bytes) to deliver if this node is the destination and it is already complete
+                 (and for a stripe, the other stripes too).
+        """
+        flow = self._flow(key)
+        flow.routed = True
+        flow.next_hop = tuple(next_hop) if next_hop is not None else None
+        if flow.next_hop is not None:
+            self._relay(flow)
+            return None
+        if flow.data is not None and not flow.delivered:
+            return self._deliverable(flow)
+        return None
+
+    def is_routed(self, key):
+        flow = self.flows.get(key)
+        return flow is not None and flow.routed
+
+    def is_destination(self, key):
+        flow = self.flows.get(key)
+        return flow is not None and flow.routed and flow.next_hop is None
+
+    def on_chunk(self, key, packet_view, message, data=None):
+        """
+        Register what arrived of a flow and relay it if the flow is routed.
+        :param message: the reassembly.PartialMessage the chunk was stored in.
+        :param data: the reassembled message once complete.
+        """
+        flow = self._flow(key)
+        flow.message = message
+        if flow.header is None:
+            flow.header = (packet_view.src_addr, packet_view.des_addr, packet_view.options, packet_view.ttl)
+        if data is not None:
+            # the message buffer is released on completion, keep the bytes until everything is relayed
+            flow.data = data
+            self.held_bytes += len(data)
+            for oldest in list(self.flows):
+                if self.held_bytes <= self.max_held_bytes:
+                    break
+                if oldest != key and self.flows[oldest].data is not None:
+                    self._drop(oldest, "held bytes over the limit")
+        if flow.routed and flow.next_hop is not None:
+            self._relay(flow, packet_view.packet_num if packet_view.control_flag == CONTROL_FLAGS['data'] else None)
+
+    def on_message(self, key, message):
+        """
+        A flow completed here, message is what protocol.send_ack returned.
+        :return: the message (bytes) to deliver if this node is its destination, None if it is relayed or held
+                 for its path, or if it is a stripe of a message whose other stripes are still missing.
+        """
+        flow = self.flows.get(key)
+        if flow is None or not flow.routed or flow.next_hop is not None or flow.delivered:
+            return None
+        flow.delivered = True
+        self._release(flow)
+        if flow.header[2] & OPTION_STRIPE:
+            return self.stripes.add(key[0], message, flow.header[1])
+        return message
+
+    def _deliverable(self, flow):
+        data = flow.data
+        src_addr, des_addr, options, _ = flow.header
+        flow.delivered = True
+        self._release(flow)
+        session = self.keys.session(src_addr, des_addr) if self.keys is not None else None
+        try:
+            if options & OPTION_CHUNK_ENCRYPTED and session is not None:
+                # held sealed while its path was unknown, the chunks were verified on arrival
+                message = flow.message
+                data = open_chunks(session, data, message.chunk_size, src_addr, des_addr, options, flow.key[1],
+                                   message.total_packet)
+                options &= ~OPTION_CHUNK_ENCRYPTED
+            if options & OPTION_STRIPE:
+                return self.stripes.add(flow.key[0], data, des_addr)
+            return open_message(data, options, session)
+        except InvalidTag:
+            metrics.counter('messages_dropped', node=self.node_name, reason='auth').inc()
+            return None
+        except DecompressionError:
+            metrics.counter('messages_dropped', node=self.node_name, reason='decompress').inc()
+            return None
+
+    def _release(self, flow):
+        if flow.data is not None:
+            self.held_bytes -= len(flow.data)
+            flow.data = None
+
+    def _relay(self, flow, packet_number=None):
+        # hand chunks which arrived to the relay transfer: packet_number, or every one not handed yet.
+        # after a handover upstream only part of the message may come this way, gaps are not waited for
+        message = flow.message
+        if message is None:
+            return
+        src_addr, des_addr, options, ttl = flow.header
+        if flow.transfer is None:
+            chunk_size = message.chunk_size if message.chunk_size is not None else len(flow.data or b'')
+            flow.transfer = Transfer(src_addr, des_addr, flow.next_hop, {}, flow.key[1], chunk_size,
+                                     timeout=self.timeout, debug_interval=0, window_size=self.window_size,
+                                     congestion=self.congestion, options=options,
+                                     total_packets=message.total_packet)
+        data = flow.data
+        total_packet = message.total_packet
+        if data is not None:
+            packet_numbers = range(total_packet)
+        elif packet_number is not None:
+            packet_numbers = (packet_number,)
+        else:
+            packet_numbers = [number for number in range(total_packet) if number in message]
+        for packet_number in packet_numbers:
+            if packet_number in flow.relayed:
+                continue
+            if data is None:
+                chunk = message.chunk(packet_number)
+            elif total_packet == 1:
+                chunk = data
+            else:
+                offset = packet_number * message.chunk_size
+                chunk = data[offset:offset + message.chunk_size] if packet_number < total_packet - 1 \
+                    else data[offset:]
+            packet = encode_packet(src_addr[0], src_addr[1], des_addr[0], des_addr[1], bytes(chunk), packet_number,
+                                   total_packet, flag='data', ttl=max(ttl - 1, 0), message_id=flow.key[1],
+                                   options=options)
+            flow.transfer.add_packet(packet_number, packet)
+            flow.relayed.add(packet_number)
+        if len(flow.relayed) == total_packet:
+            # every packet is in the transfer now
+            self._release(flow)
+
+    def on_ack(self, address, ack_view):
+        """
+        Hand a sack frame from address to the relay transfer it acknowledges.
+        :return: True if it belonged to one.
+        """
+        address = tuple(address)
+        for key, flow in self.flows.items():
+            if key[1] == ack_view.message_id and flow.transfer is not None and flow.next_hop == address:
+                if flow.transfer.on_ack(ack_view):
+                    flow.last_activity = time.time()
+                    self.flows.move_to_end(key)
+                return True
+        return False
+
+    def poll(self, sendto):
+        """
+        Send what the relay transfers may send now, resend their losses, retire finished flows
+        and drop the expired ones.
+        :param sendto: sendto(packet, address) of the node's socket or transport.
+        """
+        now = time.time()
+        for key, flow in list(self.flows.items()):
+            transfer = flow.transfer
+            if transfer is not None:
+                def send(packet, address=flow.next_hop):
+                    sendto(packet, address)
+                    self.forwarded.inc()
+                transfer.refill(send, now)
+                transfer.resend_lost(send, now)
+                if transfer.done:
+                    del self.flows[key]
+                    transfer.finish()
+                    if metrics.LOG_INFO:
+                        print(f"{self.node_name} relayed message {key[1]} to {flow.next_hop[0]}:{flow.next_hop[1]}: "
+                              f"{transfer.total_send} packets, {transfer.total_resend} resent, "
+                              f"{transfer.elapsed * 1000:.1f} ms")
+                    continue
+            elif flow.delivered:
+                del self.flows[key]
+                continue
+            if now - flow.last_activity > self.flow_timeout:
+                self._drop(key, "timed out" if flow.routed else "timed out waiting for its path")
+        self.flow_gauge.set(len(self.flows))
+        self.held_gauge.set(self.held_bytes)
+
+    def next_timeout(self):
+        """
+        Seconds until poll() is needed: the earliest relay timer, or the next flow expiry.
+        None without flows.
+        """
+        wakes = [wake for wake in (flow.transfer.wake_time() for flow in self.flows.values()
+                                   if flow.transfer is not None) if wake is not None]
+        if self.flows:
+            wakes.append(next(iter(self.flows.values())).last_activity + self.flow_timeout)
+        if not wakes:
+            return None
+        return max(min(wakes) - time.time(), 0.001)
+
+    def _drop(self, key, reason):
+        flow = self.flows.pop(key)
+        self._release(flow)
+        self.dropped.inc()
+        if metrics.LOG_INFO:
+            print(f"{self.node_name} dropped flow {key[1]} from {key[0]}: {reason}")
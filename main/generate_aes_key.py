@@ -6,6 +6,21 @@ from cryptography.hazmat.primitives import hashes
 import os
 import base64
 
+PBKDF2_ITERATIONS = 100000
+
+def derive_master_key(password, salt, iterations=PBKDF2_ITERATIONS):
+    """
+    The 256-bit master key of password and salt (PBKDF2-SHA256), derived once per key file.
+    Messages are sealed with session subkeys derived from it (encryption.KeyManager.session).
+    """
+    kdf = PBKDF2HMAC(
+        algorithm=hashes.SHA256(),
+        length=32,  # 256-bit key
+        salt=salt,
+        iterations=iterations,
+    )
+    return kdf.derive(password.encode('utf-8'))
+
 def generate_aes_key_and_save(password, output_file="aes_key_salt.txt"):
     """
     Generate an AES key and save it with the salt to a file.
@@ -14,13 +29,7 @@ def generate_aes_key_and_save(password, output_file="aes_key_salt.txt"):
     salt = os.urandom(16)
 
     # Generate a 256-bit AES key using PBKDF2 with SHA256
-    kdf = PBKDF2HMAC(
-        algorithm=hashes.SHA256(),
-        length=32,  # 256-bit key
-        salt=salt,
-        iterations=100000,
-    )
-    key = kdf.derive(password.encode('utf-8'))
+    key = derive_master_key(password, salt)
     aes_key = base64.urlsafe_b64encode(key)
     encoded_salt = base64.urlsafe_b64encode(salt)
 
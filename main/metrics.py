@@ -0,0 +1,242 @@
+"""
+low-overhead metrics registry and leveled logging
+counters, gauges and histograms are registered once per (name, labels) and then updated in place,
+hot paths keep the returned object instead of looking it up per packet.
+the registry is read by snapshot(), render_text()/render_json(), a local http scrape endpoint (serve)
+or a periodic dump (start_dump).
+
+logging: every hot-path message is guarded by a module flag, e.g.
+    if metrics.LOG_DEBUG:
+        print(f"Sent packet {n}")
+so nothing is formatted when the level is disabled. the level comes from the LOG_LEVEL environment
+variable (debug, info, warning, default info) or set_log_level().
+"""
+import bisect
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING}
+
+LOG_DEBUG = False
+LOG_INFO = True
+
+
+def set_log_level(level):
+    """
+    :param level: DEBUG, INFO, WARNING or their lowercase names.
+    """
+    global LOG_DEBUG, LOG_INFO
+    if isinstance(level, str):
+        level = LEVELS[level.lower()]
+    LOG_DEBUG = level <= DEBUG
+    LOG_INFO = level <= INFO
+
+
+set_log_level(os.environ.get("LOG_LEVEL", "info"))
+
+# histogram bucket upper bounds in milliseconds, roughly x2.5 apart from 0.1 ms to 1 minute
+MS_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 60000)
+
+
+class Counter:
+    __slots__ = ('value', 'lock')
+    kind = 'counter'
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def state(self):
+        return self.value
+
+
+class Gauge:
+    __slots__ = ('value',)
+    kind = 'gauge'
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        # a single attribute store, no lock needed
+        self.value = value
+
+    def state(self):
+        return self.value
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'count', 'sum', 'lock')
+    kind = 'histogram'
+
+    def __init__(self, buckets=MS_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one counts values above every bound
+        self.count = 0
+        self.sum = 0.
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket holding the q-quantile, None without observations.
+        """
+        with self.lock:
+            counts = list(self.counts)
+            count = self.count
+        if not count:
+            return None
+        rank = q * count
+        seen = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            seen += bucket_count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def state(self):
+        with self.lock:
+            res = {"count": self.count, "sum": self.sum,
+                   "buckets": dict(zip(self.buckets + (float('inf'),), self.counts))}
+        res["p50"] = self.quantile(0.5)
+        res["p99"] = self.quantile(0.99)
+        return res
+
+
+_metrics = {}  # (name, sorted label items) -> metric
+_metrics_lock = threading.Lock()
+
+
+def _get(cls, name, labels):
+    key = (name, tuple(sorted(labels.items())))
+    metric = _metrics.get(key)
+    if metric is None:
+        with _metrics_lock:
+            metric = _metrics.get(key)
+            if metric is None:
+                metric = cls()
+                _metrics[key] = metric
+    return metric
+
+
+def counter(name, **labels):
+    return _get(Counter, name, labels)
+
+
+def gauge(name, **labels):
+    return _get(Gauge, name, labels)
+
+
+def histogram(name, **labels):
+    return _get(Histogram, name, labels)
+
+
+def snapshot():
+    """
+    Every metric: {name: [{"labels": {...}, "type": kind, "value": state}]}.
+    """
+    with _metrics_lock:
+        items = list(_metrics.items())
+    res = {}
+    for (name, labels), metric in sorted(items, key=lambda item: item[0]):
+        res.setdefault(name, []).append({"labels": dict(labels), "type": metric.kind, "value": metric.state()})
+    return res
+
+
+def render_json():
+    return json.dumps({"time": time.time(), "metrics": snapshot()}, default=str)
+
+
+def _format_labels(labels, extra=None):
+    items = list(labels.items()) + (list(extra.items()) if extra else [])
+    if not items:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in items) + "}"
+
+
+def render_text():
+    """
+    Prometheus-style text exposition of the registry.
+    """
+    lines = []
+    for name, series in snapshot().items():
+        lines.append(f"# TYPE {name} {series[0]['type']}")
+        for entry in series:
+            labels, value = entry["labels"], entry["value"]
+            if entry["type"] != 'histogram':
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+                continue
+            cumulative = 0
+            for bound, bucket_count in value["buckets"].items():
+                cumulative += bucket_count
+                le = "+Inf" if bound == float('inf') else bound
+                lines.append(f"{name}_bucket{_format_labels(labels, {'le': le})} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {value['sum']}")
+            lines.append(f"{name}_count{_format_labels(labels)} {value['count']}")
+    return "\n".join(lines) + "\n"
+
+
+class _ScrapeHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/metrics':
+            body, content_type = render_text().encode('utf-8'), 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            body, content_type = render_json().encode('utf-8'), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # no stdout line per scrape
+        pass
+
+
+def serve(port=9464, host='127.0.0.1'):
+    """
+    Serve /metrics (text) and /metrics.json on a local http port from a daemon thread.
+    :return: the server, stop it with server.shutdown().
+    """
+    server = ThreadingHTTPServer((host, port), _ScrapeHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_dump(interval=10., path=None):
+    """
+    Dump the registry every interval seconds from a daemon thread, as json lines appended to path
+    or as text on stdout if path is None.
+    :return: an Event, set it to stop dumping.
+    """
+    stop = threading.Event()
+
+    def dump():
+        while not stop.wait(interval):
+            if path is None:
+                print(render_text(), end="")
+            else:
+                with open(path, 'a') as f:
+                    f.write(render_json() + "\n")
+
+    threading.Thread(target=dump, daemon=True).start()
+    return stop
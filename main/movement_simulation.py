@@ -1,6 +1,9 @@
 """
 satellites movement simulation: Ting
+Propagator moves a whole constellation at once: positions are an (N, 3) array of unit vectors and one tick
+is one matrix product per orbit, the rotation matrices of every orbit are computed once (orbit_rotation).
 """
+import functools
 import numpy as np
 
 
@@ -31,16 +34,27 @@ def rotation_matrix_with_angle(alpha, beta):
     return R
 
 
+@functools.lru_cache(maxsize=None)
+def orbit_rotation(alpha, beta):
+    """
+    (rotation, inverse) of the orbit with z-axis (alpha, beta), computed once per orbit.
+    The matrix is orthonormal, its inverse is its transpose.
+    """
+    rotation = rotation_matrix_with_angle(alpha, beta)
+    rotation.flags.writeable = False
+    return rotation, rotation.T
+
+
 def init_satellites(orbit_z_axis,num_sat):
     alpha, beta = orbit_z_axis
-    rotation = rotation_matrix_with_angle(alpha, beta)
+    rotation, inverse = orbit_rotation(alpha, beta)
     # we assume satellites are moving on an equator orbit
     # init satellites with equal distance between each other on the equator orbit
     lats = np.zeros((num_sat,))
     lons = np.arange(-180,180,360.0/num_sat)
     xs,ys,zs = ll_to_xyz(lats,lons)
     xyz_orbit = np.vstack((xs,ys,zs)) # the shape should be [3,num_sat]
-    xyz_world = np.linalg.inv(rotation).dot(xyz_orbit)
+    xyz_world = inverse.dot(xyz_orbit)
     x_world, y_world,z_world = xyz_world[0,:],xyz_world[1,:],xyz_world[2,:]
     lats_word, lons_word = xyz_to_ll(x_world,y_world,z_world)
     sat_ll_list = [list(item) for item in zip(lats_word, lons_word)]
@@ -57,8 +71,8 @@ def satellites_move(sat_ll, orbit_z_axis, velocity, time):
 
     # transform lat, lon to x,y,z
     x1,y1,z1 = ll_to_xyz(lat_start,lon_start)
-    # calculate rotation matrix for coordinates change
-    rotation = rotation_matrix_with_angle(alpha, beta)
+    # rotation matrix for coordinates change, and its inverse
+    rotation, inverse = orbit_rotation(alpha, beta)
     # calculate latitude and longitude relative to rotation axis
     [x2,y2,z2] = rotation.dot(np.array([x1,y1,z1])).tolist()
     lat_middle,lon_middle = xyz_to_ll(x2,y2,z2)
@@ -66,12 +80,66 @@ def satellites_move(sat_ll, orbit_z_axis, velocity, time):
     lon_middle += velocity*time
     x2,y2,z2 = ll_to_xyz(lat_middle,lon_middle)
     # transform the coordinate back to the original one
-    [x1,y1,z1] = np.linalg.inv(rotation).dot(np.array([x2,y2,z2]))
+    [x1,y1,z1] = inverse.dot(np.array([x2,y2,z2]))
     lat_end,lon_end = xyz_to_ll(x1,y1,z1)
 
     return lat_end,lon_end
 
 
+def z_rotation(angle):
+    """
+    Rotation matrices about the z-axis by angle degrees, an array of angles gives an array of matrices.
+    """
+    angle = np.radians(angle)
+    cos, sin = np.cos(angle), np.sin(angle)
+    zero, one = np.zeros_like(cos), np.ones_like(cos)
+    return np.stack([np.stack([cos, -sin, zero], -1),
+                     np.stack([sin, cos, zero], -1),
+                     np.stack([zero, zero, one], -1)], -2)
+
+
+class Propagator:
+    """
+    Batch form of satellites_move: the positions of N satellites (xyz, an (N, 3) array of unit vectors)
+    moved velocity degrees per second along their orbits.
+    orbit_z_axes is the (alpha, beta) of one orbit for all, or a list of them with orbit_ids the orbit index
+    of every satellite; velocity is one value or one per orbit.
+    A satellite moving along its orbit turns about the orbit's z-axis, a tick of t seconds is the rotation
+    inverse . z_rotation(velocity * t) . rotation of each orbit, applied to all its satellites at once.
+    """
+    def __init__(self, sat_ll, orbit_z_axes, velocity, orbit_ids=None):
+        lats, lons = np.asarray(sat_ll, dtype=np.float64).reshape(-1, 2).T
+        self.xyz = np.stack(ll_to_xyz(lats, lons), -1)
+        if orbit_ids is None:
+            orbit_z_axes = [orbit_z_axes]
+            orbit_ids = np.zeros(len(self.xyz), dtype=np.intp)
+        self.orbit_ids = np.asarray(orbit_ids, dtype=np.intp)
+        rotations = [orbit_rotation(alpha, beta) for alpha, beta in orbit_z_axes]
+        self.rotations = np.stack([rotation for rotation, _ in rotations])
+        self.inverses = np.stack([inverse for _, inverse in rotations])
+        self.velocity = np.broadcast_to(np.asarray(velocity, dtype=np.float64), (len(rotations),))
+
+    def step(self, time):
+        """
+        Move every satellite by time seconds.
+        """
+        # one (3, 3) matrix per orbit: to the orbit frame, along the orbit, back
+        moves = self.inverses @ z_rotation(self.velocity * time) @ self.rotations
+        if len(moves) == 1:
+            self.xyz = self.xyz @ moves[0].T
+        else:
+            self.xyz = np.einsum('nij,nj->ni', moves[self.orbit_ids], self.xyz)
+        return self
+
+    def lat_lon(self):
+        """
+        (N, 2) array of the latitudes and longitudes.
+        """
+        x, y, z = self.xyz.T
+        # rounding may push z a hair past 1
+        return np.stack(xyz_to_ll(x, y, np.clip(z, -1., 1.)), -1)
+
+
 def earth_sat_distance(earth_lat, earth_lon, sat_lat, sat_lon):
     # according to the starlink blog, https://blog.apnic.net/2024/05/17/a-transport-protocols-view-of-starlink/
     # the height of a satellite is about 550km
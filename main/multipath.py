@@ -0,0 +1,157 @@
+"""
+striped multipath transfer: one message is split into stripes sent at the same time through several
+satellites, every stripe is a message of its own (own message id, own path packet, own selective-repeat
+transfer), so the relays need nothing new. the destination joins the stripes (StripeAssembler, used by
+forwarding.ForwardingTable) and delivers the whole message.
+stripe sizes follow the expected goodput of each path: its measured (or else predicted) rtt and its
+measured loss rate.
+a stripe starts with its stripe header and its packets carry codec.OPTION_STRIPE:
+parent message id(4) stripe index(1) stripe count(1) option bits of the whole message(1)
+"""
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+from cryptography.exceptions import InvalidTag
+from codec import OPTION_COMPRESSED, OPTION_ENCRYPTED, OPTION_STRIPE, new_message_id
+from compression import SENSOR_DICTIONARY, DecompressionError, compress
+from encryption import open_message
+from fec import loss_rate
+from rtt_estimator import get_estimator
+from streaming import MessageSource, SealedView
+
+STRIPE = struct.Struct('!IBBB')
+
+
+def path_weights(router_addrs, predicted_latency=None):
+    """
+    Expected goodput of every path, relative: (1 - loss rate) / rtt.
+    The rtt is the smoothed rtt measured on the route, else its predicted latency in ms
+    (predicted_latency, one per router), else 1 s; the loss rate is measured on the route (fec.loss_rate).
+    """
+    weights = []
+    for i, router_addr in enumerate(router_addrs):
+        rtt = get_estimator(router_addr).srtt
+        if rtt is None:
+            rtt = predicted_latency[i] / 1000 if predicted_latency is not None else 1.
+        weights.append((1 - min(loss_rate(router_addr), 0.99)) / max(rtt, 0.001))
+    return weights
+
+
+def stripe_sizes(length, weights):
+    """
+    Split length bytes proportionally to weights, the rounding goes to the heaviest path.
+    """
+    total = sum(weights)
+    sizes = [int(length * weight / total) for weight in weights]
+    sizes[weights.index(max(weights))] += length - sum(sizes)
+    return sizes
+
+
+def send_striped(src_addr, des_addr, router_addrs, message, weights=None, message_ids=None, message_id=None,
+                 compression=None, compression_dict=SENSOR_DICTIONARY, encryption=None, packet_encryption=False,
+                 restart=None, **kwargs):
+    """
+    Send message striped over router_addrs, every stripe by protocol.send_packets in its own thread.
+    weights default to path_weights(router_addrs); message_ids are the ids of the stripes (one per router,
+    the path packets must carry them), message_id identifies the whole message.
+    compression compresses the whole message before striping, encryption (encryption.KeyManager) then seals it,
+    or with packet_encryption every chunk of the stripes on its own; other kwargs go to send_packets.
+    restart(index, message_id) is called when stripe index starts over under a new id (see send_packets).
+    :return: the message ids of the stripes.
+    """
+    # imported here, protocol.send_ack needs nothing of this module
+    from protocol import send_packets
+    # a str, bytes, a file path or an iterator of byte blocks (see streaming.py), the stripes are copies of it
+    source = MessageSource(message)
+    binary_stream = source.data
+    options = 0
+    if compression is not None:
+        binary_stream, _, _ = compress(binary_stream, compression, compression_dict)
+        options = OPTION_COMPRESSED
+    if encryption is not None and not packet_encryption:
+        # encrypted stripe by stripe as they are cut
+        binary_stream = SealedView(binary_stream, encryption.session(src_addr, des_addr).encryptor())
+        options |= OPTION_ENCRYPTED
+    if weights is None:
+        weights = path_weights(router_addrs)
+    # a stripe restarting with smaller chunks gets a new id
+    message_ids = list(message_ids) if message_ids is not None else [new_message_id() for _ in router_addrs]
+    if message_id is None:
+        message_id = new_message_id()
+    count = len(router_addrs)
+    stripes = []
+    offset = 0
+    # a stripe may be empty, its header still tells the destination it exists
+    for index, size in enumerate(stripe_sizes(len(binary_stream), weights)):
+        stripes.append(STRIPE.pack(message_id, index, count, options) + binary_stream[offset:offset + size])
+        offset += size
+    if metrics.LOG_INFO:
+        print(f"Striping message {message_id} ({len(binary_stream)} bytes) over "
+              + ", ".join(f"{router_addr[0]}:{router_addr[1]} {len(stripe) - STRIPE.size} bytes"
+                          for router_addr, stripe in zip(router_addrs, stripes)))
+    source.close()
+
+    def send(index):
+        def restarted(message_id):
+            message_ids[index] = message_id
+            if restart is not None:
+                restart(index, message_id)
+
+        send_packets(src_addr, des_addr, router_addrs[index], stripes[index], message_id=message_ids[index],
+                     options=OPTION_STRIPE, encryption=encryption if packet_encryption else None,
+                     packet_encryption=packet_encryption, restart=restarted, **kwargs)
+
+    with ThreadPoolExecutor(max_workers=count) as executor:
+        # list() re-raises the first exception of the threads
+        list(executor.map(send, range(count)))
+    return message_ids
+
+
+class StripeAssembler:
+    """
+    Stripes arrived at the destination, keyed by (header source address, parent message id).
+    Incomplete messages are dropped after timeout seconds and beyond max_messages,
+    keys (encryption.KeyManager) opens sealed messages.
+    """
+    def __init__(self, timeout=60., max_messages=256, keys=None):
+        self.timeout = timeout
+        self.keys = keys
+        self.max_messages = max_messages
+        self.partial = {}  # (source, message id) -> [first arrival, stripe count, options, {index: bytes}]
+        self.lock = threading.Lock()
+        self.dropped = metrics.counter('stripes_dropped')
+        self.undecompressed = metrics.counter('messages_dropped', reason='decompress')
+
+    def add(self, source, stripe, destination):
+        """
+        Register one reassembled stripe (bytes starting with its stripe header) sent from source to destination.
+        :return: the whole message (bytes) once its last stripe arrived, otherwise None
+                 (also when it fails authentication or does not decompress).
+        """
+        message_id, index, count, options = STRIPE.unpack_from(stripe)
+        key = (source, message_id)
+        now = time.time()
+        with self.lock:
+            for old_key, entry in list(self.partial.items()):
+                if now - entry[0] > self.timeout or len(self.partial) >= self.max_messages:
+                    del self.partial[old_key]
+                    self.dropped.inc(len(entry[3]))
+            entry = self.partial.setdefault(key, [now, count, options, {}])
+            entry[3][index] = stripe[STRIPE.size:]
+            if len(entry[3]) < count:
+                return None
+            del self.partial[key]
+        binary_stream = b''.join(entry[3][i] for i in range(count))
+        if metrics.LOG_INFO:
+            print(f"All {count} stripes of message {message_id} received")
+        try:
+            return open_message(binary_stream, options,
+                                self.keys.session(source, destination) if self.keys is not None else None)
+        except InvalidTag:
+            self.dropped.inc(count)
+            return None
+        except DecompressionError:
+            self.undecompressed.inc()
+            return None
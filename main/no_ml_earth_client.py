@@ -10,15 +10,13 @@ import numpy as np
 import threading
 import psutil
 import joblib
-import json
 import random
 from datetime import datetime
 from routing_table_manager_modified import RoutingTableManager
 import zlib
 from movement_simulation import earth_sat_distance
-from protocol import send_packets, send_path, create_udp_packet
-from s2s import calulate_routing_path
-from encryption import read_key_and_salt, aes_encrypt, aes_decrypt
+from earth_routes import send_over_satellites
+from encryption import get_key_manager
 
 # from packetrans import generate_sensor_data
 
@@ -57,6 +55,17 @@ def predict_latency(routing_table):
     return weather, list(routing_table.keys())[0], 1., 0
 
 
+def predict_latencies(routing_table):
+    """
+    The same latency for every satellite of the routing table without the model, in its order:
+    multipath weights then only come from what is measured on each route.
+    :return: weather, latencies (ms)
+    """
+    weather = np.zeros(4)
+    weather[np.random.randint(4)] = 1
+    return weather, np.ones(len(routing_table))
+
+
 # Example usage in clumsy_simulate or client function
 # satellites = [(15, 45, 'Satellite-1'), (30, 60, 'Satellite-2')]  # Satellite lat/lon with IDs
 # earth_lat, earth_lon = 10, 20  # Example Earth location
@@ -168,26 +177,24 @@ def clumsy_simulate(routing_manager, self_ll):
 
 
 def client(routing_manager, sat_addresses, receiver_ports, earth2_ll, buffer_size, timeout, debug_inter, chunk_size,
-           message, encryption=True):
+           message, encryption=True, compression=None, cut_through=True, multipath=1, packet_encryption=False):
+    keys = None
     if encryption:
-        # Read AES Key and Salt from File
+        # the key is read and decoded once, the senders seal the message with aes-gcm after compressing it,
+        # with packet_encryption every chunk on its own so each satellite verifies every datagram
         try:
-            AES_KEY, _ = read_key_and_salt("aes_key_salt.txt")
+            keys = get_key_manager("aes_key_salt.txt")
         except Exception as e:
             print(f"Failed to read AES key and salt: {e}")
             exit(1)
-        try:
-            message = aes_encrypt(message, AES_KEY)
-            print(f"Encrypted Message: {message}")
-        except Exception as e:
-            print(f"Failed to encrypt the message: {e}")
-            exit(1)
     # clean router table
     routing_manager.cleanup_routing_table()
     # get active sats
     active_satellites = routing_manager.get_active_satellites()
     # print(active_satellites)
-    weather, best_satellite, best_latency, best_sat_index = predict_latency(active_satellites)
+    weather, predictions = predict_latencies(active_satellites)
+    best_sat_index = np.argmin(predictions)
+    best_satellite, best_latency = list(active_satellites.keys())[best_sat_index], predictions[best_sat_index]
     print(
         f"Best satellite to use: {best_satellite}, Predicted latency: {best_latency:.2f} ms, Current weather: {WEATHER_CONDITIONS[np.argmax(weather)]}")
     # predeict best
@@ -200,43 +207,14 @@ def client(routing_manager, sat_addresses, receiver_ports, earth2_ll, buffer_siz
         satellite_positions[sat_name] = sat_ll
     satellite_positions['earth2'] = earth2_ll
 
-    destination = 'earth2'
-    satellite_id = f"sat{best_satellite}"
-    # print(satellite_id)
-    path = calulate_routing_path(satellite_positions, satellite_id, destination)
-    # sent path
     # src des address
     earth1_addr = ['127.0.0.1', 50099]  # dumpy earth1 addr
     earth2_addr = ['127.0.0.1', 50021]  # earth2 addr
-
-    # this server address should be decided by the rounting manager
-    server_addr = ['127.0.0.1',
-                   active_satellites[best_satellite]['address']]  # current receiver satellite(router) address
-
-    send_packets(earth1_addr, earth2_addr, server_addr, message,
-                 timeout=timeout, chunk_size=chunk_size, buffer_size=buffer_size,
-                 debug_interval=debug_inter)
-    time.sleep(1)
-    print("----Earth finish sending data-----------")
-    # Handle sending packets for A* (or use Dijkstra if desired)
-    if path and len(path) > 1:
-        next_hop = path[0]
-        payload = {
-            "sender": satellite_id,
-            "data": f"Hello from {satellite_id}!",
-            "path": path[1:]
-        }
-        payload_json = json.dumps(payload)
-        payload = payload_json.encode('utf-8')
-        dumpy_src_addr, dumpy_src_port = '127.0.0.1', 1234
-        dumpy_des_addr, dumpy_des_port = '127.0.0.1', 1235
-        packet = create_udp_packet(earth1_addr[0], earth1_addr[1], earth2_addr[0], earth2_addr[1], payload,
-                                   flag='path')
-        # print(f"Sending Packet via A*: {packet}")
-        send_path(satellite_id, next_hop, receiver_ports[next_hop], packet)
-        print("----Earth finish sending path-----------")
-    else:
-        print(f"No valid A* path to {destination} from {satellite_id}")
+    send_over_satellites(routing_manager, receiver_ports, satellite_positions, active_satellites, predictions,
+                         lambda routing_table: predict_latencies(routing_table)[1], message, earth1_addr, earth2_addr,
+                         keys=keys, compression=compression, cut_through=cut_through, multipath=multipath,
+                         packet_encryption=packet_encryption, timeout=timeout, chunk_size=chunk_size,
+                         buffer_size=buffer_size, debug_interval=debug_inter)
 
 
 if __name__ == "__main__":
@@ -262,7 +240,10 @@ if __name__ == "__main__":
     EARTH2_LL = (0, -40)  # des latitude, longitude
     TIMEOUT = 2  # 2s timeout for inquiry satellites latitude and longitude information
     DEBUG_INTER = 1  # 1s
-    CHUNK_SIZE = 32  # bit
+    CHUNK_SIZE = None  # bytes, None = chosen per satellite from the probed path mtu
+    COMPRESSION = 6  # zlib level, None = send uncompressed; the message is compressed before it is encrypted
+    MULTIPATH = 5  # satellites to stripe every message over, 1 = only the best one
+    PACKET_ENCRYPTION = True  # seal every chunk on its own instead of the whole message
     EARTH_NODE_NUM = 7
     WEATHER_CONDITIONS = { 0: 'Clear', 1: 'Cloudy', 2: 'Rain', 3: 'Storm' }
     # clumsy_thread = threading.Thread(target=clumsy_simulate,
@@ -306,7 +287,8 @@ if __name__ == "__main__":
         message = '{"packet_id": "42d62c0c-c0cf-4911-b00b-c40763ac5c80", "sensor_id": 1, "sensor_type": "humidity", "location": {"lat": -2.1595, "lon": -5.2991}, "timestamp": "2024-11-19T14:19:27.011346", "value": 68.45, "unit": "%", "status": "active"}, {"packet_id": "5bb15fa5-02ff-42ed-a4a7-4e3de975a572", "sensor_id": 2, "sensor_type": "humidity", "location": {"lat": -20.3431, "lon": -77.4995}, "timestamp": "2024-11-19T14:19:27.011346", "value": 73.61, "unit": "%", "status": "active"}'
         time.sleep(5)
         client(routing_manager, SAT_ADDR, receiver_ports, EARTH2_LL, BUFFER_SIZE, TIMEOUT, DEBUG_INTER, CHUNK_SIZE,
-               message)
+               message, compression=COMPRESSION, multipath=MULTIPATH,
+               packet_encryption=PACKET_ENCRYPTION)
         while True:
             time.sleep(3)
     except KeyboardInterrupt:
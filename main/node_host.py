@@ -0,0 +1,119 @@
+"""
+single-threaded host for many udp nodes: every node's socket is registered with one selectors loop
+(epoll on linux), readable sockets are drained into their node's handler and node timers are kept
+in one heap, so hundreds of simulated satellites cost no thread and no context switch each.
+
+a hosted node provides
+    socket                              a bound udp socket, the host makes it non-blocking
+    datagram_received(data, address)    called for every datagram
+    next_timeout()                      seconds until on_timeout() is due, None without timers
+    on_timeout()                        delayed acks, retransmissions, expiry
+"""
+import heapq
+import selectors
+import time
+import metrics
+
+# datagrams read from one socket before the other sockets get their turn
+DRAIN_LIMIT = 64
+
+
+class NodeHost:
+    def __init__(self, buffer_size=2048, drain_limit=DRAIN_LIMIT):
+        self.buffer_size = buffer_size
+        self.drain_limit = drain_limit
+        self.selector = selectors.DefaultSelector()
+        self.nodes = []
+        self.timers = []  # heap of (deadline, node index), stale entries are skipped
+        self.deadlines = {}  # node index -> its current deadline
+        self.running = False
+        self.received = metrics.counter('host_datagrams_received')
+        self.failed = metrics.counter('host_datagrams_failed')
+        self.loop_histogram = metrics.histogram('host_loop_ms')
+
+    def add(self, node):
+        node.socket.setblocking(False)
+        index = len(self.nodes)
+        self.nodes.append(node)
+        self.selector.register(node.socket, selectors.EVENT_READ, index)
+        self._schedule(index)
+        return node
+
+    def _schedule(self, index):
+        timeout = self.nodes[index].next_timeout()
+        if timeout is None:
+            self.deadlines.pop(index, None)
+            return
+        self.deadlines[index] = deadline = time.monotonic() + timeout
+        heapq.heappush(self.timers, (deadline, index))
+        if len(self.timers) > 4 * len(self.deadlines) + 64:
+            # mostly rescheduled entries, keep the heap small
+            self.timers = [(deadline, index) for index, deadline in self.deadlines.items()]
+            heapq.heapify(self.timers)
+
+    def _drain(self, index):
+        node = self.nodes[index]
+        recvfrom = node.socket.recvfrom
+        for _ in range(self.drain_limit):
+            try:
+                data, address = recvfrom(self.buffer_size)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                # e.g. ICMP port unreachable of a previous datagram, the timers deal with the loss
+                continue
+            self.received.inc()
+            try:
+                node.datagram_received(data, address)
+            except Exception as e:
+                # one bad datagram must not stop the host and every node it serves
+                self.failed.inc()
+                if metrics.LOG_INFO:
+                    print(f"Datagram from {address} dropped by its node: {e!r}")
+        self._schedule(index)
+
+    def _run_timers(self):
+        now = time.monotonic()
+        timers = self.timers
+        while timers and timers[0][0] <= now:
+            deadline, index = heapq.heappop(timers)
+            if self.deadlines.get(index) != deadline:
+                continue
+            del self.deadlines[index]
+            self.nodes[index].on_timeout()
+            self._schedule(index)
+
+    def run_once(self, timeout=None):
+        """
+        Wait for datagrams at most until the earliest node timer (or timeout seconds), then handle
+        what arrived and every due timer.
+        """
+        if self.timers:
+            wait = max(self.timers[0][0] - time.monotonic(), 0)
+            timeout = wait if timeout is None else min(timeout, wait)
+        events = self.selector.select(timeout)
+        start = time.perf_counter()
+        for key, _ in events:
+            self._drain(key.data)
+        self._run_timers()
+        if events:
+            self.loop_histogram.observe((time.perf_counter() - start) * 1000)
+
+    def run(self):
+        """
+        Serve every node until stop() is called, from any thread.
+        """
+        self.running = True
+        while self.running:
+            # wake up now and then to notice stop()
+            self.run_once(timeout=0.5)
+
+    def stop(self):
+        self.running = False
+
+    def close(self):
+        for node in self.nodes:
+            self.selector.unregister(node.socket)
+            node.socket.close()
+        self.selector.close()
+        self.nodes = []
@@ -0,0 +1,145 @@
+"""
+path-mtu-aware adaptive chunk sizing and per-route goodput
+probe: the sender fires one 'probe' datagram per candidate size (a few copies each, as the links are lossy),
+the receiver answers every intact probe with a 'probe_ack' whose packet number is the datagram size it got.
+a datagram truncated by a small receive buffer or dropped by the emulator is simply never answered,
+so the largest answered size is the usable datagram size of that route.
+"""
+import threading
+import time
+from codec import CONTROL_FLAGS, HEADER_SIZE, PacketView, encode_packet, new_message_id
+import socket_pool
+
+# candidate datagram sizes, the largest fits a 1500-byte ethernet mtu after the ip and udp headers
+PROBE_SIZES = (1472, 1400, 1200, 1024, 512, 256, 128)
+MIN_CHUNK_SIZE = 32
+# probed sizes are trusted for 10 minutes, then probed again (RFC 1191 uses the same interval)
+PROBE_INTERVAL = 600.
+# a transfer losing more than this share of its datagrams steps down to a smaller size
+FALLBACK_LOSS = 0.5
+
+
+class PathMtu:
+    """
+    Datagram size state of one route.
+    """
+    def __init__(self):
+        self.datagram_size = None
+        self.probed_at = 0
+        self.goodput = {}  # chunk size -> [payload bytes, seconds, transfers]
+
+    @property
+    def chunk_size(self):
+        return max(self.datagram_size - HEADER_SIZE, MIN_CHUNK_SIZE)
+
+    def step_down(self):
+        # jump to the largest candidate of at most half the size, a black hole rarely sits just below the mtu
+        smaller = [size for size in PROBE_SIZES if size <= self.datagram_size // 2]
+        self.datagram_size = smaller[0] if smaller else MIN_CHUNK_SIZE + HEADER_SIZE
+
+
+_paths = {}
+_paths_lock = threading.Lock()
+
+
+def _get_path(router_addr):
+    key = tuple(router_addr)
+    with _paths_lock:
+        path = _paths.get(key)
+        if path is None:
+            path = PathMtu()
+            _paths[key] = path
+        return path
+
+
+def probe(router_addr, timeout=1., sizes=PROBE_SIZES, copies=3):
+    """
+    Probe the largest datagram size router_addr answers.
+    :return: datagram size in bytes, the header plus MIN_CHUNK_SIZE if no probe was answered.
+    """
+    router_addr = tuple(router_addr)
+    message_id = new_message_id()
+    confirmed = 0
+    with socket_pool.lease() as probe_socket:
+        src_ip, src_port = '127.0.0.1', 0
+        for size in sizes:
+            packet = encode_packet(src_ip, src_port, router_addr[0], router_addr[1], bytes(size - HEADER_SIZE),
+                                   packet_number=size, flag='probe', message_id=message_id)
+            for _ in range(copies):
+                try:
+                    probe_socket.sendto(packet, router_addr)
+                except OSError:
+                    # e.g. EMSGSIZE above the local interface mtu
+                    break
+        deadline = time.time() + timeout
+        while confirmed < max(sizes):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            probe_socket.settimeout(remaining)
+            try:
+                reply, _ = probe_socket.recvfrom(2048)
+            except OSError:
+                break
+            reply_view = PacketView(reply)
+            if reply_view.control_flag == CONTROL_FLAGS['probe_ack'] and reply_view.message_id == message_id \
+                    and reply_view.verify():
+                confirmed = max(confirmed, reply_view.packet_num)
+    return confirmed or MIN_CHUNK_SIZE + HEADER_SIZE
+
+
+def chunk_size_for(router_addr, timeout=1.):
+    """
+    Payload size to use towards router_addr, probing the route first if its size is unknown or outdated.
+    """
+    path = _get_path(router_addr)
+    if path.datagram_size is None or time.time() - path.probed_at > PROBE_INTERVAL:
+        path.datagram_size = probe(router_addr, timeout=timeout)
+        path.probed_at = time.time()
+        print(f"Path MTU to {router_addr[0]}:{router_addr[1]}: {path.datagram_size} byte datagrams, "
+              f"{path.chunk_size} byte chunks")
+    return path.chunk_size
+
+
+def report_transfer(router_addr, chunk_size, payload_bytes, elapsed, sent, lost):
+    """
+    Record the outcome of one transfer: goodput per chunk size and loss based fall back.
+    """
+    path = _get_path(router_addr)
+    stats = path.goodput.setdefault(chunk_size, [0, 0., 0])
+    stats[0] += payload_bytes
+    stats[1] += elapsed
+    stats[2] += 1
+    if path.datagram_size is not None and sent and lost / sent > FALLBACK_LOSS \
+            and chunk_size + HEADER_SIZE >= path.datagram_size:
+        report_blackhole(router_addr, chunk_size)
+
+
+def report_blackhole(router_addr, chunk_size):
+    """
+    Datagrams carrying chunk_size bytes do not get through: use a smaller size.
+    """
+    path = _get_path(router_addr)
+    if path.datagram_size is None:
+        path.datagram_size = chunk_size + HEADER_SIZE
+        path.probed_at = time.time()
+    path.step_down()
+    print(f"Large datagrams lost towards {router_addr[0]}:{router_addr[1]}, "
+          f"falling back to {path.chunk_size} byte chunks")
+
+
+def route_stats():
+    """
+    Per-route datagram size and goodput (bytes per second) per chunk size used.
+    """
+    with _paths_lock:
+        paths = dict(_paths)
+    res = {}
+    for addr, path in paths.items():
+        res[addr] = {
+            "datagram_size": path.datagram_size,
+            "goodput": {chunk_size: nbytes / seconds if seconds else None
+                        for chunk_size, (nbytes, seconds, _) in path.goodput.items()},
+            "transfers": {chunk_size: transfers for chunk_size, (_, _, transfers) in path.goodput.items()},
+        }
+    return res
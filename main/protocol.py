@@ -5,8 +5,26 @@ import time
 import json
 import socket
 import zlib
-from queue import Queue
 import threading
+import metrics
+from codec import CONTROL_FLAGS, FLAG_MASK, HEADER_SIZE, OPTION_CHUNK_ENCRYPTED, OPTION_COMPRESSED, OPTION_ENCRYPTED, \
+    OPTION_STRIPE, PacketView, encode_packet, new_message_id
+from sack import AckCoalescer
+from reassembly import Reassembler
+from pmtu import chunk_size_for
+from compression import SENSOR_DICTIONARY, DecompressionError, compress
+from cryptography.exceptions import InvalidTag
+from encryption import OpenedChunks, OpenedStream, open_chunks, open_message
+from transfer import Transfer
+from streaming import MessageSource, PacketSource, SealedView
+import socket_pool
+
+# a sender asks its handover callback every HANDOVER_INTERVAL seconds, and at once after HANDOVER_ROUNDS
+# retransmission timer rounds without a new ack
+HANDOVER_INTERVAL = 0.5
+HANDOVER_ROUNDS = 3
+# timer rounds without a new ack before send_packets gives up, the rto doubles every round
+MAX_IDLE_ROUNDS = 12
 
 # our protocol details are as below
 # source_ip + port: 6byte
@@ -17,15 +35,11 @@ import threading
 # total packet number: 4byte
 # checksum: 4byte
 # total data length: 4byte
+# message id: 4byte
 # payload
 
-# global dictionary for control flag
-CONTROL_FLAGS = {
-    "data": 0,
-    "ack": 1,
-    "inquiry": 2,
-    "path": 3,
-}
+# the global dictionary for control flag lives in codec.py,
+# it is imported above so `from protocol import CONTROL_FLAGS` keeps working
 
 
 def calculate_checksum(data):
@@ -59,8 +73,8 @@ def create_ll_inquiry(src_addr,des_addr):
 
 def create_udp_packet(src_ip,src_port,des_ip,des_port,payload,
                       packet_number=0,total_packets=0,
-                      flag='data',ttl=64):
-    packet_len = len(payload) + 30
+                      flag='data',ttl=64,message_id=0):
+    packet_len = len(payload) + HEADER_SIZE
     checksum = calculate_checksum(payload)
     src_bytes = socket.inet_aton(socket.gethostbyname(src_ip)) + src_port.to_bytes(2, 'big')  # 6bytes
     des_bytes = socket.inet_aton(socket.gethostbyname(des_ip)) + des_port.to_bytes(2, 'big')  # 6bytes
@@ -70,21 +84,53 @@ def create_udp_packet(src_ip,src_port,des_ip,des_port,payload,
     total_packet_bytes = total_packets.to_bytes(4, 'big')
     crc_bytes = checksum.to_bytes(4, 'big')
     length_bytes = packet_len.to_bytes(4, 'big')
+    message_id_bytes = message_id.to_bytes(4, 'big')
     header = src_bytes + des_bytes + flag_bytes + ttl_bytes \
-             + packet_num_bytes + total_packet_bytes + crc_bytes + length_bytes
+             + packet_num_bytes + total_packet_bytes + crc_bytes + length_bytes + message_id_bytes
     packet = header + payload
     return packet
 
 
-def batch_udp_packets(src_ip,src_port,des_ip,des_port,message,chunk_size=32,ttl=64):
-    # encode the json message into binary data
-    binary_stream = message.encode('utf-8')
-    chunks = [binary_stream[i:i+chunk_size] for i in range(0,len(binary_stream),chunk_size)]
-    total_packets = len(chunks)
-    for packet_number, chunk in enumerate(chunks):
-        packet = create_udp_packet(src_ip, src_port, des_ip, des_port, chunk,
-                                    packet_number, total_packets,flag='data')
-        yield packet, packet_number,total_packets
+def batch_udp_packets(src_ip,src_port,des_ip,des_port,message,chunk_size=32,ttl=64,message_id=0,
+                      compression=None,compression_dict=SENSOR_DICTIONARY,options=0,encryption=None,
+                      packet_encryption=False):
+    # the message is a str, bytes, a file path or an iterator of byte blocks (see streaming.py),
+    # its chunks are memoryview slices, copied only into their packets and encrypted as they are yielded
+    with MessageSource(message) as source:
+        packets = message_packets(src_ip,src_port,des_ip,des_port,source.data,chunk_size=chunk_size,ttl=ttl,
+                                  message_id=message_id,compression=compression,
+                                  compression_dict=compression_dict,options=options,encryption=encryption,
+                                  packet_encryption=packet_encryption)
+        for packet_number, packet in packets.items():
+            yield packet, packet_number, packets.total_packets
+
+
+def message_packets(src_ip,src_port,des_ip,des_port,binary_stream,chunk_size=32,ttl=64,message_id=0,
+                    compression=None,compression_dict=SENSOR_DICTIONARY,options=0,encryption=None,
+                    packet_encryption=False):
+    """
+    The data packets of binary_stream (bytes-like) as a streaming.PacketSource, which encodes every packet
+    when it is sent; compression is the zlib level, the whole message is compressed before chunking,
+    encryption an encryption.KeyManager to seal it with afterwards (aes-gcm): as a whole, or with
+    packet_encryption every chunk on its own (codec.OPTION_CHUNK_ENCRYPTED, chunk_size includes its tag).
+    """
+    if compression is not None:
+        raw_length = len(binary_stream)
+        binary_stream, ratio, cpu = compress(binary_stream, compression, compression_dict)
+        options |= OPTION_COMPRESSED
+        if metrics.LOG_INFO:
+            print(f"Compressed message {message_id}: {raw_length} -> {len(binary_stream)} bytes "
+                  f"(ratio {ratio:.2f}, {cpu * 1000:.3f} ms cpu)")
+    session = None
+    if encryption is not None:
+        # sealed with the subkey of this source, destination and epoch
+        session = encryption.session((src_ip, src_port), (des_ip, des_port))
+    if session is not None and not packet_encryption:
+        # ciphertext does not compress, so it is sealed last, as its packets are built
+        binary_stream = SealedView(binary_stream, session.encryptor())
+        options |= OPTION_ENCRYPTED
+    return PacketSource(src_ip, src_port, des_ip, des_port, binary_stream, chunk_size, ttl=ttl,
+                        message_id=message_id, options=options, keys=session if packet_encryption else None)
 
 
 def decode_packet(packet):
@@ -93,13 +139,14 @@ def decode_packet(packet):
     src_port = int.from_bytes(packet[4:6],'big')
     des_ip = socket.inet_ntoa(packet[6:10])
     des_port = int.from_bytes(packet[10:12],'big')
-    control_flag = int.from_bytes(packet[12:13],'big')
+    control_flag = int.from_bytes(packet[12:13],'big') & FLAG_MASK
     ttl = int.from_bytes(packet[13:14], 'big')
     packet_num = int.from_bytes(packet[14:18], 'big')
     total_packet = int.from_bytes(packet[18:22], 'big')
     checksum = int.from_bytes(packet[22:26], 'big')
     length = int.from_bytes(packet[26:30], 'big')
-    payload = packet[30:]
+    message_id = int.from_bytes(packet[30:34], 'big')
+    payload = packet[HEADER_SIZE:]
     res = {
         "src_addr": (src_ip,src_port),
         "des_addr": (des_ip,des_port),
@@ -109,137 +156,286 @@ def decode_packet(packet):
         "total_packet": total_packet,
         "checksum":checksum,
         "packet_length":length,
+        "message_id":message_id,
         "payload":payload,
     }
     return res
 
 
-def send_packets(src_addr,des_addr,router_addr,message,timeout=1,chunk_size=32,buffer_size=1024,debug_interval=1,suppress_log=False):
+def send_packets(src_addr,des_addr,router_addr,message,timeout=1,chunk_size=None,buffer_size=1024,debug_interval=1,
+                 suppress_log=False,window_size=8,congestion='aimd',message_id=None,fec=None,fec_block=8,
+                 fec_repair=None,compression=None,compression_dict=SENSOR_DICTIONARY,options=0,handover=None,
+                 max_idle_rounds=MAX_IDLE_ROUNDS,encryption=None,packet_encryption=False,restart=None):
+    """
+    selective-repeat sender of message to des_addr through router_addr, the protocol is described in transfer.py.
+    :param message: str, bytes-like, file path (os.PathLike) or iterator of byte blocks, read with constant memory.
+    :param timeout: initial retransmission timeout, the adaptive rto of router_addr takes over.
+    :param chunk_size: payload bytes per packet, None probes the path mtu of router_addr (see pmtu.py).
+    :param buffer_size: receive buffer size for the acks.
+    :param debug_interval: pause between two window refills, acks are still read during it.
+    :param suppress_log: do not print the transfer statistics.
+    :param window_size: packets in flight, further limited by the congestion controller of router_addr.
+    :param congestion: name of the congestion controller (see congestion.py).
+    :param message_id: id of the message at the receiver, None draws a new one.
+    :param fec: None, 'xor' or 'rs' repair packets after every fec_block data packets (see fec.py).
+    :param fec_block: data packets per fec block.
+    :param fec_repair: repair packets per block, None derives it from the loss rate of router_addr.
+    :param compression: zlib level (0-9) to compress the message with, None sends it as is.
+    :param compression_dict: preset zlib dictionary, the receiver must know it (see compression.py).
+    :param options: further codec OPTION_* bits of the packets.
+    :param handover: handover(router_addr, stalled) returns the address of another router to go on through, or None.
+    :param max_idle_rounds: timer rounds without a new ack before TimeoutError, None retransmits forever.
+    :param encryption: encryption.KeyManager to seal the message with aes-gcm, None sends it in the clear.
+    :param packet_encryption: seal every chunk on its own (codec.OPTION_CHUNK_ENCRYPTED), not the whole message.
+    :param restart: restart(message_id) re-sends the path packet when the transfer starts over under a new id.
+    """
     src_ip, src_port = src_addr
     des_ip, des_port = des_addr
     router_ip, router_port = router_addr
-    udp_sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    udp_sender.settimeout(timeout)
-
-    print(f"\nSending packet from {src_ip}:{src_port} to {des_ip}:{des_port}\n")
-    print(f"\nRouting to {router_ip}:{router_port}\n")
-
-    # maintain a queue for retransmitting
-    total_packets = None
-    sending_queue = Queue()
-    total_send = 0
-    total_resend = 0
-    rtts = []
-    for packet,packet_number,total_packets in \
-            batch_udp_packets(src_ip,src_port,des_ip,des_port,message,
-                                         chunk_size=chunk_size):
-        # put packet into queue
-        total_packets = total_packets
-        sending_queue.put((packet_number, packet))
-
-    # send package from sending queue
-    while not sending_queue.empty():
-        packet_number, packet = sending_queue.get()
-        #print(f'Current queue size: {sending_queue.qsize()}')
-        print(f"Sent packet {packet_number+1}/{total_packets}")
-        try:
-            # send the packet
-            total_send += 1
-            start_time = time.time()
-            print(f"router_addr:{router_addr}")
-            udp_sender.sendto(packet, tuple(router_addr))
-            # Wait for acknowledgement
-            ack, _ = udp_sender.recvfrom(buffer_size)
-            end_time = time.time()
-            # round trip time
-            rtt = (end_time - start_time) * 1000  # convert to milliseconds
-            rtts.append(rtt)
-            # decode ack_message
-            decode_res = decode_packet(ack)
-            assert decode_res['control_flag'] == CONTROL_FLAGS['ack'], "ack flag error, resending..."
-            assert decode_res['packet_num'] == packet_number, "ack packet_number mismatch, resending..."
-            assert verify_checksum(decode_res['payload'], decode_res['checksum']), "ack checksum error, resending..."
-            print(f"Received ACK from {router_addr[0]}:{router_addr[1]}: packet_num={packet_number+1}, time={rtt:.2f} ms")
-        except socket.timeout:
-            print(f"Timeout: packet_num={packet_number+1}, resending...")
-            sending_queue.put((packet_number, packet))
-            total_resend += 1
-        except Exception:
-            sending_queue.put((packet_number, packet))
-            total_resend += 1
-        time.sleep(debug_interval)
+    router_addr = tuple(router_addr)
+    if message_id is None:
+        message_id = new_message_id()
+    auto_chunk = chunk_size is None
+    if auto_chunk:
+        chunk_size = chunk_size_for(router_addr, timeout=timeout)
+    # one memoryview of the message: files are memory-mapped, iterators spooled (see streaming.py)
+    source = MessageSource(message)
+    # a pooled socket, it keeps its port and binding from message to message
+    udp_sender = socket_pool.acquire()
+    try:
+        if metrics.LOG_INFO:
+            print(f"\nSending packet from {src_ip}:{src_port} to {des_ip}:{des_port}\n")
+            print(f"\nRouting to {router_ip}:{router_port}, {chunk_size} byte chunks\n")
+
+        # every packet is built from its chunk whenever it is (re)sent, until it is acknowledged
+        packets = message_packets(src_ip,src_port,des_ip,des_port,source.data,chunk_size=chunk_size,
+                                  message_id=message_id,compression=compression,compression_dict=compression_dict,
+                                  options=options,encryption=encryption,packet_encryption=packet_encryption)
+        transfer = Transfer(src_addr, des_addr, router_addr, packets, message_id, chunk_size, timeout=timeout,
+                            debug_interval=debug_interval, window_size=window_size, congestion=congestion,
+                            fec=fec, fec_block=fec_block, fec_repair=fec_repair, options=packets.options,
+                            auto_chunk=auto_chunk, payload_bytes=len(packets.data))
+
+        def send(packet):
+            udp_sender.sendto(packet, transfer.router_addr)
+
+        next_handover_check = time.time() + HANDOVER_INTERVAL
+        while not transfer.done:
+            if handover is not None and (transfer.idle_rounds >= HANDOVER_ROUNDS
+                                         or time.time() >= next_handover_check):
+                next_handover_check = time.time() + HANDOVER_INTERVAL
+                new_router = handover(transfer.router_addr, transfer.idle_rounds >= HANDOVER_ROUNDS)
+                if new_router is not None and tuple(new_router) != transfer.router_addr:
+                    if metrics.LOG_INFO:
+                        print(f"\nHandover of message {message_id} from "
+                              f"{transfer.router_addr[0]}:{transfer.router_addr[1]} to "
+                              f"{new_router[0]}:{new_router[1]}, "
+                              f"{len(transfer.acked)}/{transfer.total_packets} packets acknowledged\n")
+                    transfer.migrate(new_router)
+            if max_idle_rounds is not None and transfer.idle_rounds >= max_idle_rounds:
+                raise TimeoutError(f"message {message_id}: no ack from "
+                                   f"{transfer.router_addr[0]}:{transfer.router_addr[1]} "
+                                   f"in {transfer.idle_rounds} timer rounds")
+            transfer.refill(send)
+
+            # wait for acknowledgements until the earliest timer expires (or the refill pause ends),
+            # then drain whatever else is already queued on the socket
+            udp_sender.settimeout(max(transfer.wake_time() - time.time(), 0.001))
+            while True:
+                try:
+                    ack, _ = udp_sender.recvfrom(buffer_size)
+                except (socket.timeout, BlockingIOError):
+                    break
+                except OSError:
+                    # e.g. ICMP port unreachable reported on the next call
+                    break
+                finally:
+                    udp_sender.settimeout(0)
+                transfer.on_ack(PacketView(ack))
+
+            if transfer.resend_lost(send):
+                # large datagrams seem to vanish on this route, start over with smaller chunks; never under the
+                # same id, its packet numbers would seal other plaintext with the same nonces and the receiver
+                # still holds the chunks of the old size
+                message_id = new_message_id()
+                if restart is not None:
+                    restart(message_id)
+                # the view, an iterator cannot be read twice; it is closed once the restarted transfer returned
+                return send_packets(src_addr, des_addr, transfer.router_addr, source.data, timeout=timeout,
+                                    buffer_size=buffer_size, debug_interval=debug_interval,
+                                    suppress_log=suppress_log, window_size=window_size, congestion=congestion,
+                                    message_id=message_id, fec=fec,
+                                    fec_block=fec_block, fec_repair=fec_repair, compression=compression,
+                                    compression_dict=compression_dict, options=options, handover=handover,
+                                    max_idle_rounds=max_idle_rounds, encryption=encryption,
+                                    packet_encryption=packet_encryption, restart=restart)
+    finally:
+        socket_pool.release(udp_sender)
+        source.close()
+    transfer.finish()
     if not suppress_log:
-        print("----------------------------------------------------")
-        print(f"---UDP packets all sent: statistics below---\n")
-        packets_transmitted = total_send
-        packets_received = len(rtts)
-        packet_lost_count = packets_transmitted - packets_received
-        packet_loss = ((packets_transmitted - packets_received) / packets_transmitted) * 100
-        packet_loss_after_resend =((packets_transmitted + total_resend - packets_received) / packets_transmitted) * 100
-        print(f"{packets_transmitted} packets transmitted, "
-              f"{packets_received} received, "
-              f"{packet_lost_count} lost, "
-              f"{total_resend} resent.")
-        print(f"({packet_loss:.1f}% loss)\n")
-        print(f"({packet_loss_after_resend:.1f}% loss after resending)\n")
-        if rtts:
-            min_rtt = min(rtts)
-            max_rtt = max(rtts)
-            avg_rtt = sum(rtts) / len(rtts)
-            print(f"rtt min={min_rtt:.2f} ms, avg={avg_rtt:.2f} ms, max={max_rtt:.2f} ms\n")
-        else:
-            print("No RTT data available.\n")
-        print("----------------------------------------------------")
+        transfer.print_stats()
 
 
-def send_ack(server_addr,sending_address,server_socket,decode_res,received_packets,suppress_log=False):
+class _NodeCounters:
+    """
+    The receive counters of one node, looked up in the metrics registry once rather than per packet.
+    """
+    def __init__(self, node):
+        self.received = metrics.counter('packets_received', node=node)
+        self.duplicate = metrics.counter('packets_duplicate', node=node)
+        self.bad_checksum = metrics.counter('packets_dropped', node=node, reason='checksum')
+        self.bad_packet_auth = metrics.counter('packets_dropped', node=node, reason='auth')
+        self.reassembled = metrics.counter('messages_reassembled', node=node)
+        self.bad_message_auth = metrics.counter('messages_dropped', node=node, reason='auth')
+        self.undecompressed = metrics.counter('messages_dropped', node=node, reason='decompress')
+        self.reassembly_ms = metrics.histogram('reassembly_ms', node=node)
+
+
+_node_counters = {}  # (ip, port) -> _NodeCounters
+
+
+def _counters_of(server_addr):
+    key = (server_addr[0], server_addr[1])
+    counters = _node_counters.get(key)
+    if counters is None:
+        # a race creates two objects holding the same registry counters, either may stay
+        counters = _node_counters[key] = _NodeCounters(f"{server_addr[0]}:{server_addr[1]}")
+    return counters
+
+
+def send_ack(server_addr,sending_address,server_socket,packet_view,reassembler,suppress_log=False,coalescer=None,
+             forwarding=None,keys=None):
     """
     pure sending data acknowledgement function,
     since server thread might have other functions,
     it is possible server has multiple functions including this one.
+    what the receiver does with the packet options is described in codec.py.
+    :param server_addr: address of this node, the acks are sent from it.
+    :param sending_address: address the packet came from, the ack goes back to it.
+    :param server_socket: socket (or anything with sendto) the acks are sent through.
+    :param packet_view: codec.PacketView of a data or fec repair packet.
+    :param reassembler: reassembly.Reassembler storing the chunks under (header source address, message id).
+    :param suppress_log: do not print the reconstructed message.
+    :param coalescer: sack.AckCoalescer delaying and merging the acks, None acks every packet at once.
+    :param forwarding: forwarding.ForwardingTable of cut-through flows, the caller sends with forwarding.poll().
+    :param keys: encryption.KeyManager verifying sealed chunks and opening sealed messages.
+    :return: the message (bytes) once complete, otherwise None (also at a relay and when it is dropped);
+             a stripe (codec.OPTION_STRIPE) raw, a sealed message without keys as ciphertext.
     """
-    original_string = None
-    control_flag = decode_res['control_flag']
-    packet_number = decode_res['packet_num']
-    total_packet = decode_res['total_packet']
-    checksum = decode_res['checksum']
-    payload = decode_res['payload']
+    original_message = None
+    control_flag = packet_view.control_flag
+    packet_number = packet_view.packet_num
+    total_packet = packet_view.total_packet
+    repair = control_flag == CONTROL_FLAGS['repair']
+    counters = _counters_of(server_addr)
     # verify if it's a valid packet
-    if (control_flag==CONTROL_FLAGS['data']) and verify_checksum(payload,checksum):
-        # Store the packet content
-        if sending_address in received_packets.keys():
-            received_packets[sending_address][packet_number] = payload
+    if (control_flag==CONTROL_FLAGS['data'] or repair) and not packet_view.verify():
+        counters.bad_checksum.inc()
+    elif control_flag==CONTROL_FLAGS['data'] or repair:
+        key = (packet_view.src_addr, packet_view.message_id)
+        session = None
+        if keys is not None and packet_view.options & (OPTION_ENCRYPTED | OPTION_CHUNK_ENCRYPTED):
+            session = keys.session(packet_view.src_addr, packet_view.des_addr)
+        sealed = packet_view.options & OPTION_CHUNK_ENCRYPTED and session is not None
+        plaintext = None
+        if sealed and not repair:
+            # repair packets are parity of the sealed chunks, what they rebuild is verified when opened
+            try:
+                plaintext = session.open_packet(packet_view)
+            except InvalidTag:
+                counters.bad_packet_auth.inc()
+                return None
+        # Store the packet content, sealed chunks as they came: relays pass them on unchanged
+        message, duplicate, binary_stream = reassembler.add(key, packet_view.message_id, packet_number,
+                                                            total_packet, packet_view.payload, repair=repair)
+        if message is None:
+            # too large for the reassembly memory, dropped without an ack
+            return None
+        relayed = forwarding is not None and forwarding.is_routed(key) and not forwarding.is_destination(key)
+        if plaintext is not None and not duplicate and not relayed:
+            if message.opened is None:
+                message.opened = OpenedChunks(total_packet)
+            message.opened.add(packet_number, plaintext)
+        elif (packet_view.options & OPTION_ENCRYPTED and session is not None and not duplicate and not relayed
+              and binary_stream is None):
+            # sealed as a whole: decrypted as far as the chunks arrived in order
+            if message.opened is None:
+                message.opened = OpenedStream(session)
+            message.opened.feed(message)
+        if repair:
+            if not duplicate and metrics.LOG_DEBUG:
+                print(f"Rebuilt lost chunks of message {packet_view.message_id} from repair packets")
         else:
-            received_packets[sending_address] = {}
-            received_packets[sending_address][packet_number] = payload
-        print(f"Received packet {packet_number}/{total_packet} from {sending_address}")
-
-        # Send acknowledgment for the received packet
-        ack_message = create_udp_packet(server_addr[0], server_addr[1],
-                                        sending_address[0], sending_address[1], payload,
-                                        packet_number=packet_number,total_packets=0,flag='ack')
-        server_socket.sendto(ack_message, sending_address)
-
-        # If all packets are received, reassemble the binary stream
-        if len(received_packets[sending_address]) == total_packet:
-            print(f"All packets frome address {sending_address} received!")
-            # Reassemble and decode the original string
-            binary_stream = b''.join(received_packets[sending_address][i] for i in range(total_packet))
-            original_string = binary_stream.decode()
+            counters.received.inc()
+            if duplicate:
+                counters.duplicate.inc()
+            if metrics.LOG_DEBUG:
+                print(f"Received packet {packet_number}/{total_packet} of message {packet_view.message_id} "
+                      f"from {sending_address}")
+
+        if forwarding is not None and not duplicate:
+            forwarding.on_chunk(key, packet_view, message, binary_stream)
+
+        # Send (or schedule) the acknowledgment for the received packet,
+        # a repair packet is only worth an ack when it rebuilt something
+        if coalescer is None:
+            coalescer = AckCoalescer(server_addr, server_socket, ack_every=1)
+        if not (repair and duplicate):
+            coalescer.on_data(key, sending_address, message, packet_number, duplicate=duplicate, urgent=repair)
+
+        # If all packets are received, the reassembled binary stream is returned
+        if binary_stream is not None:
+            counters.reassembled.inc()
+            counters.reassembly_ms.observe((time.time() - message.first_seen) * 1000)
+            if metrics.LOG_INFO:
+                print(f"All packets of message {packet_view.message_id} from address {sending_address} received!")
+            opened, message.opened = message.opened, None
+            if relayed:
+                # relayed on as it is, only its destination opens it
+                return None
+            start = time.process_time()
+            options = packet_view.options
+            try:
+                if sealed:
+                    # only the chunks not opened on arrival are left (rebuilt by fec, or all without keys)
+                    binary_stream = open_chunks(session, binary_stream, message.chunk_size, packet_view.src_addr,
+                                                packet_view.des_addr, options, packet_view.message_id,
+                                                total_packet, opened)
+                    options &= ~OPTION_CHUNK_ENCRYPTED
+                elif opened is not None:
+                    binary_stream = opened.finish(binary_stream, message.chunk_size)
+                    options &= ~OPTION_ENCRYPTED
+                if options & OPTION_STRIPE:
+                    # one stripe of a multipath message, the forwarding table joins the stripes at the destination
+                    return bytes(binary_stream)
+                original_message = open_message(binary_stream, options, session)
+            except InvalidTag:
+                counters.bad_message_auth.inc()
+                if metrics.LOG_INFO:
+                    print(f"Message {packet_view.message_id} from {sending_address} failed authentication, dropped")
+                return None
+            except DecompressionError as e:
+                counters.undecompressed.inc()
+                if metrics.LOG_INFO:
+                    print(f"Message {packet_view.message_id} from {sending_address} dropped: {e}")
+                return None
+            opened_options = OPTION_COMPRESSED | OPTION_ENCRYPTED | OPTION_CHUNK_ENCRYPTED
+            if metrics.LOG_INFO and packet_view.options & opened_options:
+                print(f"Opened message {packet_view.message_id}: {len(binary_stream)} -> "
+                      f"{len(original_message)} bytes ({(time.process_time() - start) * 1000:.3f} ms cpu)")
             if not suppress_log:
-                print("Reconstructed String:", original_string)
-    return original_string
+                print("Reconstructed String:", original_message.decode('utf-8', 'replace'))
+    return original_message
 
 def send_path(sender_id, receiver_id, receiver_port, packet):
     # if random.random() < PACKET_LOSS_PROBABILITY:
     #     print(f"Packet {packet['packet_num']} from {sender_id} to {receiver_id} lost in transmission.")
     #     return
-    decode_res = decode_packet(packet)
-    packet_json = decode_res['payload']
-    path_info = json.loads(packet_json)
+    # the packet is sent as it is, json or source routed (codec.OPTION_SOURCE_ROUTE)
     try:
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client_socket:
-            client_socket.sendto(packet, ("localhost", receiver_port))
+        socket_pool.sendto(packet, socket_pool.peer_addr("localhost", receiver_port))
+        if metrics.LOG_INFO:
             print(f"Packet is sent from {sender_id} to {receiver_id} at {receiver_port}")
     except Exception as e:
         print(f"Error sending packet to {receiver_id}: {e}")
@@ -256,18 +452,38 @@ def answer_inquiry(server_addr,sending_address,server_socket,lat,lon):
     server_socket.sendto(ack, sending_address)
 
 
+def answer_probe(server_addr,sending_address,server_socket,packet_view):
+    """
+    answer a path mtu probe with the size of the datagram that arrived intact
+    """
+    if packet_view.verify():
+        reply = encode_packet(server_addr[0],server_addr[1],sending_address[0],sending_address[1],b'',
+                              packet_number=len(packet_view.packet),flag='probe_ack',
+                              message_id=packet_view.message_id)
+        server_socket.sendto(reply, sending_address)
+
+
 def test_server(host, port):
     # create local server to listen for incoming messages.
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     server_socket.bind((host, port))
     print(f"Server is listening on {host}:{port}")
-    received_packets = {}
+    reassembler = Reassembler()
+    coalescer = AckCoalescer((host, port), server_socket)
     while True:
-        # Receive a packet
-        packet, sending_address = server_socket.recvfrom(1024)
-        # Decode the packet
-        decode_res = decode_packet(packet)
-        send_ack((host,port),sending_address,server_socket,decode_res,received_packets)
+        # Receive a packet, wake up in time for the delayed acks
+        server_socket.settimeout(coalescer.next_timeout())
+        try:
+            packet, sending_address = server_socket.recvfrom(65535)
+        except socket.timeout:
+            coalescer.flush()
+            continue
+        packet_view = PacketView(packet)
+        if packet_view.control_flag == CONTROL_FLAGS['probe']:
+            answer_probe((host,port),sending_address,server_socket,packet_view)
+            continue
+        send_ack((host,port),sending_address,server_socket,packet_view,reassembler,coalescer=coalescer)
+        coalescer.flush()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,239 @@
+"""
+bounded, stream-aware message reassembly for satellite servers
+messages are keyed by (header source address, message id), every partial message owns a
+preallocated bytearray sized from total_packet and a received-bitmap.
+"""
+import time
+import metrics
+from collections import OrderedDict
+from fec import REPAIR_HEADER, decode_block
+
+
+class PartialMessage:
+    """
+    One message being reassembled. All chunks except the last one have the same size,
+    the buffer is allocated from the first of them as chunk_size * total_packet bytes.
+    `packet_number in message` tells whether that chunk has been received.
+    """
+    __slots__ = ('message_id', 'total_packet', 'chunk_size', 'buffer', 'bitmap', 'received_count',
+                 'cumulative', 'tail', 'first_seen', 'last_seen', 'complete', 'repairs', 'recovered', 'opened')
+
+    def __init__(self, message_id, total_packet):
+        self.message_id = message_id
+        self.total_packet = total_packet
+        self.chunk_size = None
+        self.buffer = None
+        self.bitmap = bytearray((total_packet + 7) // 8)
+        self.received_count = 0
+        self.cumulative = 0  # next packet number expected in order
+        self.tail = None  # last chunk, it is shorter than the others
+        self.first_seen = self.last_seen = time.time()
+        self.complete = False
+        self.repairs = None  # first packet number of a block -> {repair index: repair payload}
+        self.recovered = 0  # chunks rebuilt by forward error correction
+        self.opened = None  # plaintext of chunks sealed on their own, see encryption.OpenedChunks
+
+    def __contains__(self, packet_number):
+        if self.complete:
+            return 0 <= packet_number < self.total_packet
+        return bool(self.bitmap[packet_number >> 3] & (1 << (packet_number & 7)))
+
+    @property
+    def size(self):
+        return len(self.buffer) if self.buffer is not None else 0
+
+    def add(self, packet_number, payload):
+        """
+        Store one chunk. :return: False for a duplicate or an inconsistent chunk, True otherwise.
+        """
+        if packet_number >= self.total_packet or packet_number in self:
+            return False
+        if packet_number == self.total_packet - 1:
+            self.tail = bytes(payload)
+        else:
+            if self.buffer is None:
+                self.chunk_size = len(payload)
+                self.buffer = bytearray(self.chunk_size * self.total_packet)
+            elif len(payload) != self.chunk_size:
+                return False
+            offset = packet_number * self.chunk_size
+            self.buffer[offset:offset + self.chunk_size] = payload
+        self.bitmap[packet_number >> 3] |= 1 << (packet_number & 7)
+        self.received_count += 1
+        self.last_seen = time.time()
+        while self.cumulative < self.total_packet and self.cumulative in self:
+            self.cumulative += 1
+        return True
+
+    def chunk(self, packet_number):
+        """
+        View of a received chunk.
+        """
+        if packet_number == self.total_packet - 1:
+            return self.tail
+        offset = packet_number * self.chunk_size
+        return memoryview(self.buffer)[offset:offset + self.chunk_size]
+
+    def add_repair(self, block_start, repair):
+        """
+        Store a repair packet and rebuild what it allows.
+        :return: number of chunks rebuilt.
+        """
+        if self.repairs is None:
+            self.repairs = {}
+        _, _, _, index, _ = REPAIR_HEADER.unpack_from(repair)
+        self.repairs.setdefault(block_start, {})[index] = repair
+        return self.recover(block_start)
+
+    def recover(self, block_start):
+        """
+        Rebuild the lost chunks of the block starting at block_start from its repair packets.
+        :return: number of chunks rebuilt.
+        """
+        repairs = self.repairs.get(block_start) if self.repairs else None
+        if not repairs:
+            return 0
+        scheme, n, _, _, last_length = REPAIR_HEADER.unpack_from(next(iter(repairs.values())))
+        chunks = {i: self.chunk(block_start + i) for i in range(n) if block_start + i in self}
+        if len(chunks) == n:
+            del self.repairs[block_start]
+            return 0
+        coded = {index: memoryview(repair)[REPAIR_HEADER.size:] for index, repair in repairs.items()}
+        rebuilt = decode_block(chunks, coded, n, scheme)
+        for i, chunk in rebuilt.items():
+            if i == n - 1:
+                chunk = chunk[:last_length]
+            self.add(block_start + i, chunk)
+        if rebuilt:
+            self.recovered += len(rebuilt)
+            del self.repairs[block_start]
+        return len(rebuilt)
+
+    def assemble(self):
+        """
+        Join the chunks of a complete message and release the buffer.
+        """
+        if self.total_packet == 1:
+            data = self.tail
+        else:
+            length = self.chunk_size * (self.total_packet - 1)
+            self.buffer[length:length + len(self.tail)] = self.tail
+            data = bytes(memoryview(self.buffer)[:length + len(self.tail)])
+        self.buffer = None
+        self.tail = None
+        self.repairs = None
+        self.complete = True
+        return data
+
+
+class Reassembler:
+    """
+    Reassembly of every message arriving at one node.
+    Partial messages idle for stale_timeout seconds are evicted, and the oldest ones are evicted
+    to make room before a buffer is preallocated, a message larger than memory_cap bytes is dropped.
+    The ids of the last completed_history finished messages are remembered so late retransmissions
+    are acked but not delivered twice.
+    """
+    def __init__(self, stale_timeout=30., memory_cap=64 * 1024 * 1024, completed_history=1024,
+                 sweep_interval=1.):
+        self.stale_timeout = stale_timeout
+        self.memory_cap = memory_cap
+        self.completed_history = completed_history
+        self.sweep_interval = sweep_interval
+        self.partial = OrderedDict()  # key -> PartialMessage, least recently active first
+        self.completed = OrderedDict()  # key -> finished PartialMessage without buffer
+        self.memory = 0
+        self.evicted = 0
+        self.last_sweep = time.time()
+        self.dropped = metrics.counter('messages_dropped', reason='memory')
+
+    def add(self, key, message_id, packet_number, total_packet, payload, repair=False):
+        """
+        Store one chunk of the message identified by key. With repair=True payload is a
+        forward error correction repair packet of the block starting at packet_number.
+        :return: (message, duplicate, data). message is the PartialMessage the chunk belongs to,
+                 duplicate tells the chunk was already there (or the repair packet rebuilt nothing)
+                 and data is the reassembled bytes once the message completed, otherwise None.
+                 message is None if the message does not fit in memory_cap, nothing of it is stored.
+        """
+        self._sweep()
+        message = self.completed.get(key)
+        if message is not None:
+            return message, True, None
+        message = self.partial.get(key)
+        if message is None or message.buffer is None:
+            # the buffer will be chunk size * total_packet bytes (a repair packet is as long as a chunk,
+            # the last chunk no longer), make room for it before anything is allocated
+            chunk_size = len(payload) - REPAIR_HEADER.size if repair else len(payload)
+            needed = max(chunk_size, 1) * total_packet
+            if needed > self.memory_cap:
+                if message is not None:
+                    del self.partial[key]
+                self.dropped.inc()
+                if metrics.LOG_INFO:
+                    print(f"Message {message_id} from {key[0]} dropped, {total_packet} packets of "
+                          f"{chunk_size} bytes exceed the reassembly memory")
+                return None, True, None
+            if self.memory + needed > self.memory_cap:
+                self._evict_oldest(keep=key, needed=needed)
+        if message is None:
+            message = PartialMessage(message_id, total_packet)
+            self.partial[key] = message
+        else:
+            self.partial.move_to_end(key)
+        size = message.size
+        if repair:
+            stored = message.add_repair(packet_number, bytes(payload)) > 0
+        else:
+            stored = message.add(packet_number, payload)
+            if stored and message.repairs:
+                # a late data chunk may complete what a waiting repair packet of its block needs
+                block_starts = [block_start for block_start in message.repairs if block_start <= packet_number]
+                if block_starts:
+                    message.recover(max(block_starts))
+        self.memory += message.size - size
+        if not stored:
+            return message, True, None
+        if message.received_count < message.total_packet:
+            return message, False, None
+
+        # complete: move it to the history of finished messages
+        del self.partial[key]
+        self.memory -= message.size
+        data = message.assemble()
+        self.completed[key] = message
+        if len(self.completed) > self.completed_history:
+            self.completed.popitem(last=False)
+        return message, False, data
+
+    def evict_stale(self):
+        """
+        Drop partial messages which did not receive a chunk for stale_timeout seconds.
+        """
+        deadline = time.time() - self.stale_timeout
+        while self.partial:
+            key, message = next(iter(self.partial.items()))
+            if message.last_seen > deadline:
+                break
+            self._drop(key)
+
+    def _sweep(self):
+        now = time.time()
+        if now - self.last_sweep >= self.sweep_interval:
+            self.last_sweep = now
+            self.evict_stale()
+
+    def _evict_oldest(self, keep, needed):
+        for key in list(self.partial):
+            if self.memory + needed <= self.memory_cap:
+                break
+            if key != keep:
+                self._drop(key)
+
+    def _drop(self, key):
+        message = self.partial.pop(key)
+        self.memory -= message.size
+        self.evicted += 1
+        metrics.counter('messages_evicted').inc()
+        print(f"Partial message {message.message_id} from {key[0]} evicted "
+              f"({message.received_count}/{message.total_packet} packets)")
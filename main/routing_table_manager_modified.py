@@ -5,7 +5,9 @@ import socket
 import time
 import json
 import threading
-from protocol import create_ll_inquiry,decode_packet
+from protocol import create_ll_inquiry
+from codec import CONTROL_FLAGS, PacketView
+import socket_pool
 
 class RoutingTableManager:
     def __init__(self, server_addr, buffer_size, timeout, update_interval=15, inactive_timeout=30):
@@ -15,6 +17,8 @@ class RoutingTableManager:
         self.update_interval = update_interval
         self.inactive_timeout = inactive_timeout
         self.routing_table = { }
+        # satellites whose last inquiry timed out, out of range until they answer again
+        self.unreachable = set()
         self.lock = threading.Lock()
 
     def update_routing_table(self, self_node_num):
@@ -24,20 +28,28 @@ class RoutingTableManager:
         """
         while True:
             try:
-                inquire_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                # a pooled socket, the same one cycle after cycle
+                inquire_socket = socket_pool.acquire()
                 inquire_socket.settimeout(self.timeout)
 
                 for id, ports in self.server_addr.items():
                     dummy_src_addr = ('127.0.0.1', 1234)
+                    sat_addr = socket_pool.peer_addr('127.0.0.1', ports['receive'])
                     # Send inquiry to server
-                    inquiry = create_ll_inquiry(dummy_src_addr, ('127.0.0.1', ports['receive']))
-                    inquire_socket.sendto(inquiry, ('127.0.0.1', ports['receive']))
+                    inquiry = create_ll_inquiry(dummy_src_addr, sat_addr)
+                    inquire_socket.sendto(inquiry, sat_addr)
 
                     # Wait for satellite response
                     try:
                         ack, node_addr = inquire_socket.recvfrom(self.buffer_size)
-                        decode_ack = decode_packet(ack)
-                        ll_info = json.loads(decode_ack['payload'])
+                        ack_view = PacketView(ack)
+                        # a late answer of a satellite that timed out before, or a late sack frame
+                        # of a message the pooled socket sent before
+                        while node_addr != sat_addr or ack_view.control_flag != CONTROL_FLAGS['ack'] \
+                                or not ack_view.verify():
+                            ack, node_addr = inquire_socket.recvfrom(self.buffer_size)
+                            ack_view = PacketView(ack)
+                        ll_info = json.loads(bytes(ack_view.payload))
                         sat_lat = ll_info['lat']
                         sat_lon = ll_info['lon']
                         #node_id = f"Satellite-{int.from_bytes(ack[4:8], 'big')}"
@@ -50,15 +62,18 @@ class RoutingTableManager:
                                 "last_updated": time.time(),
                                 "address": ports['receive']
                             }
+                            self.unreachable.discard(id)
                         #print(f"Satellite {node_id} added/updated in the routing table.")
                         # print(f"Satellite {node_addr} added/updated in the routing table.")
 
                     except socket.timeout:
                         print("Satellite inquiry timed out.")
+                        with self.lock:
+                            self.unreachable.add(id)
             except Exception as e:
                 print(f"Error updating routing table: {e}")
             finally:
-                inquire_socket.close()
+                socket_pool.release(inquire_socket)
             # for item in self.routing_table.items():
             #     print(item)
             # Sleep for the update interval
@@ -78,6 +93,13 @@ class RoutingTableManager:
                 del self.routing_table[sat_id]
                 print(f"Satellite {sat_id} removed from the routing table (inactive).")
 
+    def in_range(self, sat_id):
+        """
+        Whether sat_id is in the routing table and answered its last inquiry.
+        """
+        with self.lock:
+            return sat_id in self.routing_table and sat_id not in self.unreachable
+
     def get_active_satellites(self):
         """
         Retrieve a list of active satellites from the routing table.
@@ -0,0 +1,111 @@
+"""
+adaptive retransmission timeout (RFC 6298 style) per destination
+"""
+import threading
+
+# smoothing gains from RFC 6298
+ALPHA = 1 / 8
+BETA = 1 / 4
+K = 4
+
+
+class RttEstimator:
+    """
+    Smoothed RTT/RTTVAR estimator driving the retransmission timeout of one destination.
+    All times are in seconds.
+    """
+    def __init__(self, initial_rto=1., min_rto=0.05, max_rto=60., clock_granularity=0.001):
+        self.initial_rto = initial_rto
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.clock_granularity = clock_granularity
+        self.srtt = None
+        self.rttvar = None
+        self.backoff_count = 0
+        self.samples = 0
+        self.lock = threading.Lock()
+        self._rto = initial_rto
+
+    @property
+    def rto(self):
+        with self.lock:
+            return self._rto
+
+    def sample(self, rtt):
+        """
+        Feed a measured round trip time.
+        Karn's rule: callers must only pass samples of packets that were never retransmitted.
+        """
+        with self.lock:
+            if self.srtt is None:
+                self.srtt = rtt
+                self.rttvar = rtt / 2
+            else:
+                self.rttvar = (1 - BETA) * self.rttvar + BETA * abs(self.srtt - rtt)
+                self.srtt = (1 - ALPHA) * self.srtt + ALPHA * rtt
+            self.samples += 1
+            # a valid sample collapses any exponential backoff
+            self.backoff_count = 0
+            self._rto = self._clamp(self.srtt + max(self.clock_granularity, K * self.rttvar))
+
+    def backoff(self):
+        """
+        Double the retransmission timeout after a timer expired.
+        """
+        with self.lock:
+            self.backoff_count += 1
+            self._rto = self._clamp(self._rto * 2)
+
+    def reset_backoff(self):
+        """
+        Undo the backoff of timeouts that were not caused by congestion, e.g. oversized datagrams.
+        """
+        with self.lock:
+            self.backoff_count = 0
+            if self.srtt is None:
+                self._rto = self.initial_rto
+            else:
+                self._rto = self._clamp(self.srtt + max(self.clock_granularity, K * self.rttvar))
+
+    def state(self):
+        """
+        Snapshot of the estimator for inspection.
+        """
+        with self.lock:
+            return {
+                "srtt": self.srtt,
+                "rttvar": self.rttvar,
+                "rto": self._rto,
+                "backoff_count": self.backoff_count,
+                "samples": self.samples,
+            }
+
+    def _clamp(self, rto):
+        return min(max(rto, self.min_rto), self.max_rto)
+
+
+# estimators survive across send_packets calls, keyed by router address
+_estimators = {}
+_estimators_lock = threading.Lock()
+
+
+def get_estimator(router_addr, initial_rto=1.):
+    """
+    Return the estimator for router_addr, creating it with initial_rto on first use.
+    """
+    key = tuple(router_addr)
+    with _estimators_lock:
+        estimator = _estimators.get(key)
+        if estimator is None:
+            estimator = RttEstimator(initial_rto=initial_rto)
+            _estimators[key] = estimator
+        return estimator
+
+
+def estimator_states():
+    """
+    Inspect the state of every known destination: {router_addr: state dict}.
+    """
+    with _estimators_lock:
+        estimators = dict(_estimators)
+    return {addr: estimator.state() for addr, estimator in estimators.items()}
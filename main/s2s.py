@@ -12,6 +12,7 @@ import sys
 from time import perf_counter
 sys.stdout.reconfigure(encoding='utf-8')
 from protocol import create_udp_packet, CONTROL_FLAGS,decode_packet
+import socket_pool
 
 
 # Satellite configuration
@@ -137,9 +138,8 @@ def send_packet(sender_id, receiver_id, receiver_port, packet):
     packet_json = decode_res['payload']
     path_info = json.loads(packet_json)
     try:
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client_socket:
-            client_socket.sendto(packet, ("localhost", receiver_port))
-            print(f"Packet {path_info['packet_num']} is sent from {sender_id} to {receiver_id} at {receiver_port}")
+        socket_pool.sendto(packet, socket_pool.peer_addr("localhost", receiver_port))
+        print(f"Packet {path_info['packet_num']} is sent from {sender_id} to {receiver_id} at {receiver_port}")
     except Exception as e:
         print(f"Error sending packet {path_info['packet_num']} to {receiver_id}: {e}")
 
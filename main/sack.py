@@ -0,0 +1,107 @@
+"""
+compact cumulative/selective acknowledgements with delayed ack coalescing
+sack frame: control flag 'sack', the header packet number carries the cumulative ack
+(the next packet number expected in order), the header total packet number and message id echo
+the acknowledged message and the payload is the number of chunks the receiver rebuilt by forward error correction
+(2 bytes) followed by a little-endian bitmap, bit i set means packet cumulative+1+i was received.
+"""
+import struct
+import time
+from codec import encode_packet
+
+RECOVERED = struct.Struct('!H')
+
+# the bitmap covers at most this many packets after the cumulative ack
+SACK_BITMAP_BITS = 256
+
+
+def encode_sack(server_addr, sending_address, cumulative, total_packet, received, message_id=0, recovered=0):
+    """
+    Build a sack frame for the packet numbers in received (any container supporting `in`).
+    """
+    bitmap = 0
+    end = min(total_packet, cumulative + 1 + SACK_BITMAP_BITS)
+    for packet_number in range(cumulative + 1, end):
+        if packet_number in received:
+            bitmap |= 1 << (packet_number - cumulative - 1)
+    payload = RECOVERED.pack(min(recovered, 0xFFFF)) + bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little')
+    return encode_packet(server_addr[0], server_addr[1], sending_address[0], sending_address[1], payload,
+                         packet_number=cumulative, total_packets=total_packet, flag='sack',
+                         message_id=message_id)
+
+
+def decode_sack(packet_view):
+    """
+    :param packet_view: codec.PacketView of a sack frame.
+    :return: cumulative ack, the set of selectively acknowledged packet numbers above it
+             and the number of chunks rebuilt by forward error correction so far.
+    """
+    cumulative = packet_view.packet_num
+    payload = packet_view.payload
+    recovered, = RECOVERED.unpack_from(payload)
+    bitmap = int.from_bytes(payload[RECOVERED.size:], 'little')
+    sacked = set()
+    i = 0
+    while bitmap:
+        if bitmap & 1:
+            sacked.add(cumulative + 1 + i)
+        bitmap >>= 1
+        i += 1
+    return cumulative, sacked, recovered
+
+
+class AckCoalescer:
+    """
+    Delayed acknowledgements of one receiving socket.
+    An ack is sent after every ack_every data packets of a message or once the oldest
+    unacknowledged packet waited ack_delay seconds, whichever comes first.
+    Out-of-order packets, duplicates and the last packet of a message are acknowledged at once.
+    """
+    def __init__(self, server_addr, server_socket, ack_every=2, ack_delay=0.02):
+        self.server_addr = server_addr
+        self.server_socket = server_socket
+        self.ack_every = ack_every
+        self.ack_delay = ack_delay
+        self.pending = {}  # message key -> [packets not yet acked, first arrival time, reply address, message]
+
+    def on_data(self, key, reply_address, message, packet_number, duplicate=False, urgent=False):
+        """
+        Register an arrived data packet of message (a reassembly.PartialMessage) identified by key,
+        acks go to reply_address. urgent acknowledges at once, e.g. chunks rebuilt from repair packets.
+        """
+        entry = self.pending.get(key)
+        if entry is None:
+            entry = [0, time.time(), reply_address, message]
+            self.pending[key] = entry
+        entry[0] += 1
+        entry[2], entry[3] = reply_address, message
+        # the packet closed the in-order prefix unless it landed beyond a gap
+        in_order = packet_number < message.cumulative
+        if urgent or duplicate or not in_order or message.cumulative >= message.total_packet or entry[0] >= self.ack_every:
+            self._send(key)
+
+    def flush(self):
+        """
+        Send every delayed ack whose ack_delay expired.
+        """
+        now = time.time()
+        for key, entry in list(self.pending.items()):
+            if now - entry[1] >= self.ack_delay:
+                self._send(key)
+
+    def next_timeout(self):
+        """
+        Seconds until the next delayed ack is due, None if nothing is pending.
+        """
+        if not self.pending:
+            return None
+        oldest = min(entry[1] for entry in self.pending.values())
+        # never 0, that would switch the socket to non-blocking mode
+        return max(oldest + self.ack_delay - time.time(), 0.001)
+
+    def _send(self, key):
+        _, _, reply_address, message = self.pending.pop(key)
+        cumulative = message.total_packet if message.complete else message.cumulative
+        ack = encode_sack(self.server_addr, reply_address, cumulative, message.total_packet,
+                          message, message_id=message.message_id, recovered=message.recovered)
+        self.server_socket.sendto(ack, reply_address)
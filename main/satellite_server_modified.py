@@ -5,16 +5,24 @@ satellite to satellite logic: Karthik
 message encryption: Sanjiv
 satellite movement simulation: Ting
 """
+import asyncio
 from collections import deque
 import json
 import socket
 import threading
 import time
-from movement_simulation import init_satellites, satellites_move
+import metrics
+from movement_simulation import Propagator, init_satellites
 import zlib
-from protocol import decode_packet,send_packets,send_ack,send_path,answer_inquiry, CONTROL_FLAGS, create_udp_packet
-from queue import Queue
-from encryption import read_key_and_salt,aes_decrypt
+from protocol import send_ack,answer_inquiry,answer_probe, CONTROL_FLAGS, create_udp_packet
+from codec import OPTION_SOURCE_ROUTE, PacketView, advance_route
+from aio_transport import open_node
+from sack import AckCoalescer
+from reassembly import Reassembler
+from forwarding import ForwardingTable
+from node_host import NodeHost
+from constellation import Constellation
+from encryption import get_key_manager
 
 def calculate_checksum(data):
     """
@@ -35,110 +43,269 @@ def verify_checksum(data, checksum):
     return calculate_checksum(data) == checksum
 
 
-def keep_moving(global_dequeue, orbit_z_axis, num_sats, velocity, sat_index):
-    sat_ll_list = init_satellites(orbit_z_axis, num_sats)
-    # initial lat, lon of the satellite
-    lat_lon = sat_ll_list
+def keep_moving(global_dequeue, orbit_z_axis, num_sats, velocity, sat_index, tick=1.):
+    # every satellite moves in the same tick, one numpy call for the whole constellation
+    propagator = Propagator(init_satellites(orbit_z_axis, num_sats), orbit_z_axis, velocity)
     start_time = time.time()
     while True:
+        time.sleep(tick)
+        end_time = time.time()
+        t = end_time - start_time
+        start_time = end_time
+        lat_lon = propagator.step(t).lat_lon().tolist()
         for i in range(num_sats):
-            time.sleep(1)
-            end_time = time.time()
-            t = end_time - start_time
-            start_time = end_time
-            lat_lon[i][0], lat_lon[i][1] = satellites_move((lat_lon[i][0], lat_lon[i][1]), orbit_z_axis, velocity, t)
-            print(f"Satellite {i+1} keeps moving: time slaps {t}, latitude {lat_lon[i][0]}, longitude {lat_lon[i][1]}")
+            if metrics.LOG_DEBUG:
+                print(f"Satellite {i+1} keeps moving: time slaps {t}, latitude {lat_lon[i][0]}, longitude {lat_lon[i][1]}")
             # update data in global queue for multi-threading data share
             global_dequeue[i].append((lat_lon[i][0], lat_lon[i][1]))
 
 
-def server(global_dequeue, server_addr, receiver_ports, buffer_size, satellite_id,sat_node_number,encryption=True):
-    # create udp satellite server
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    server_socket.bind(('127.0.0.1', server_addr))
+def deliver(message, satellite_id):
+    """
+    last hop: print the message (bytes), it was decrypted on reassembly with the node's keys (encryption.open_message)
+    """
+    print("-----------------------------------------------------------")
+    print(f"{satellite_id} has no more hops. Packet delivered.")
+    # messages may be binary, what is not utf-8 text is printed as replacement characters
+    print("Reconstructed String:", message.decode('utf-8', 'replace'))
+    print("------------------------P2P NET SUCCESS!--------------------")
 
-    print(f"{satellite_id} is listening on {server_addr} for recieving...")
-    received_packets = {}
-    message_queue = Queue()
-    while True:
-        # Receive a packet
+
+def path_packet(path_info, packet_view):
+    """
+    the path packet for the next hop, same addresses and message id
+    """
+    src_ip, src_port = packet_view.src_addr
+    des_ip, des_port = packet_view.des_addr
+    return create_udp_packet(src_ip, src_port, des_ip, des_port, json.dumps(path_info).encode('utf-8'),
+                             flag='path', message_id=packet_view.message_id)
+
+
+def handle_path(forwarding, path_info, packet_view, receiver_ports, satellite_id, sendto):
+    """
+    join a path packet with its flow (header source address, message id): route the flow to the next hop
+    and pass the path on at once, or deliver the message if this satellite is the destination
+    """
+    if metrics.LOG_INFO:
+        print(f"{satellite_id} received path of message {packet_view.message_id} from {path_info['sender']}")
+    if not packet_view.message_id:
+        print(f"{satellite_id} ignored a path without message id")
+        return
+    key = (packet_view.src_addr, packet_view.message_id)
+    # Check if there are more hops in the path
+    if path_info.get("path"):
+        next_hop = path_info["path"].pop(0)  # Get the next hop from the path
+        if next_hop not in receiver_ports:
+            print(f"Unknown next hop {next_hop} for message {packet_view.message_id}")
+            return
+        next_addr = ('127.0.0.1', receiver_ports[next_hop])
+        forwarding.install(key, next_addr)
+        sendto(path_packet(path_info, packet_view), next_addr)
+        if metrics.LOG_INFO:
+            print(f"Path is sent from {satellite_id} to {next_hop} at {receiver_ports[next_hop]}")
+    else:
+        message = forwarding.install(key, None)
+        if message is not None:
+            deliver(message, satellite_id)
+
+
+class SatelliteNode:
+    """
+    one satellite's packet handling, independent of how its socket is read:
+    server() drives a node from its own thread, node_host.NodeHost drives any number from one selector loop
+    """
+    def __init__(self, global_dequeue, server_addr, receiver_ports, satellite_id, sat_node_number, encryption=True):
+        # create udp satellite server
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(('127.0.0.1', server_addr))
+        self.server_addr = ('127.0.0.1', server_addr)
+        self.global_dequeue = global_dequeue
+        self.receiver_ports = receiver_ports
+        # source routes name the nodes by their position in receiver_ports
+        self.node_addrs = [('127.0.0.1', port) for port in receiver_ports.values()]
+        self.satellite_id = satellite_id
+        self.sat_node_number = sat_node_number
+        # the key is read once, messages are opened with it as they complete
+        self.keys = get_key_manager() if encryption else None
+        self.reassembler = Reassembler()
+        # delayed/coalesced sack frames of this satellite, sent through self.sendto
+        self.coalescer = AckCoalescer(self.server_addr, self)
+        # flows passing this satellite, keyed by (source, message id)
+        self.forwarding = ForwardingTable(satellite_id, keys=self.keys)
+        self.reassembly_partial = metrics.gauge('reassembly_partial_messages', node=satellite_id)
+        self.reassembly_bytes = metrics.gauge('reassembly_buffer_bytes', node=satellite_id)
+        self.send_dropped = metrics.counter('packets_dropped', node=satellite_id, reason='send_buffer')
+        if metrics.LOG_INFO:
+            print(f"{satellite_id} is listening on {server_addr} for recieving...")
+
+    def sendto(self, packet, address):
         try:
-            data, client_address = server_socket.recvfrom(buffer_size)
-        except Exception as e:
-            #print(e)
-            #print(f"minor_error: server_addr:{server_addr}")
-            pass
-        print(f"Packet received on {satellite_id}")
-        # Decode the packet
-        decode_res = decode_packet(data)
-        if(decode_res['control_flag'] == CONTROL_FLAGS['path']) and verify_checksum(decode_res['payload'],decode_res['checksum']):
-            packet_json = decode_res['payload']
-            path_info = json.loads(packet_json)
-            print(f"{satellite_id} received path from {path_info['sender']}")
-
-            # Check if there are more hops in the path
-            if path_info.get("path") and len(path_info["path"]) > 0:
-                # print(f"----path:{path_info['path']}-----")
-                next_hop = path_info["path"].pop(0)  # Get the next hop from the path
-                payload_json = json.dumps(path_info)
-                payload = payload_json.encode('utf-8')
-                dumpy_src_addr, dumpy_src_port = decode_res['src_addr'][0],decode_res['src_addr'][1]
-                dumpy_des_addr, dumpy_des_port = decode_res['des_addr'][0],decode_res['des_addr'][1]
-                print(dumpy_src_addr)
-                print(dumpy_src_port)
-                packet = create_udp_packet(dumpy_src_addr, dumpy_src_port, dumpy_des_addr, dumpy_des_port, payload,
-                                           flag='path')
-
-                if next_hop in receiver_ports:
-                    # send out message ot the top of the queue
-                    # this server address should be decided by the rounting manager
-                    router_addr = ['127.0.0.1', receiver_ports[next_hop]]  # current receiver satellite(router) address
-                    message = message_queue.get()
-                    send_packets(decode_res['src_addr'], decode_res['des_addr'], router_addr, message, suppress_log=True)
-
-                    time.sleep(1)
-                    send_path(
-                        satellite_id,  # Current satellite
-                        next_hop,  # Next satellite in the path
-                        receiver_ports[next_hop],  # Next satellite's receiving port
-                        packet  # Packet to be sent
-                    )
+            self.socket.sendto(packet, address)
+        except BlockingIOError:
+            # full socket buffer of a hosted (non-blocking) node, lost like on the link
+            self.send_dropped.inc()
 
+    def next_timeout(self):
+        """
+        seconds until the delayed acks or the relay timers are due, None if nothing is pending
+        """
+        timeouts = [timeout for timeout in (self.coalescer.next_timeout(), self.forwarding.next_timeout())
+                    if timeout is not None]
+        return min(timeouts) if timeouts else None
+
+    def on_timeout(self):
+        self.coalescer.flush()
+        self.forwarding.poll(self.sendto)
+
+    def datagram_received(self, data, client_address):
+        self.coalescer.flush()
+        if metrics.LOG_DEBUG:
+            print(f"Packet received on {self.satellite_id}")
+        forwarding = self.forwarding
+        # Decode the packet header, the payload is not copied
+        packet_view = PacketView(data)
+        if(packet_view.control_flag == CONTROL_FLAGS['path']) and packet_view.verify():
+            if packet_view.options & OPTION_SOURCE_ROUTE:
+                # a path packet is small, a writable copy to advance the hop index in
+                handle_route(forwarding, bytearray(data), self.node_addrs, self.satellite_id, self.sendto)
             else:
-                print("-----------------------------------------------------------")
-                print(f"{satellite_id} has no more hops. Packet delivered.")
-                message = message_queue.get()
-                if encryption:
-                    # Read AES Key and Salt from File
-                    try:
-                        AES_KEY, _ = read_key_and_salt("aes_key_salt.txt")
-                    except Exception as e:
-                        print(f"Failed to read AES key and salt: {e}")
-                        exit(1)
-                        # Decrypt the data
-                    try:
-                        message = aes_decrypt(message, AES_KEY)
-                    except Exception as e:
-                        print(f"Failed to decrypt the message: {e}")
-                        exit(1)
-                print("Reconstructed String:", message)
-                print("------------------------P2P NET SUCCESS!--------------------")
-
-        elif (decode_res['control_flag'] == CONTROL_FLAGS['data']) and verify_checksum(decode_res['payload'], decode_res['checksum']):
-            message = send_ack(('127.0.0.1', server_addr),client_address,server_socket,decode_res,received_packets,suppress_log=True)
+                path_info = json.loads(bytes(packet_view.payload))
+                handle_path(forwarding, path_info, packet_view, self.receiver_ports, self.satellite_id,
+                            self.sendto)
+
+        elif packet_view.control_flag in (CONTROL_FLAGS['data'], CONTROL_FLAGS['repair']) and packet_view.verify():
+            message = send_ack(self.server_addr,client_address,self,packet_view,self.reassembler,
+                               suppress_log=True,coalescer=self.coalescer,forwarding=forwarding,keys=self.keys)
             if message is not None:
-                message_queue.put(message)
+                message = forwarding.on_message((packet_view.src_addr, packet_view.message_id), message)
+                if message is not None:
+                    deliver(message, self.satellite_id)
+            self.reassembly_partial.set(len(self.reassembler.partial))
+            self.reassembly_bytes.set(self.reassembler.memory)
 
-        elif (decode_res['control_flag'] == CONTROL_FLAGS['inquiry']) and verify_checksum(decode_res['payload'],decode_res['checksum']):
+        elif (packet_view.control_flag == CONTROL_FLAGS['inquiry']) and packet_view.verify():
             try:
-                lat, lon = global_dequeue[sat_node_number-1].pop()
+                lat, lon = self.global_dequeue[self.sat_node_number-1].pop()
             except IndexError:
                 # give a out of range latitude(it should be from -90 to 90) to imply error
                 lat, lon = -800, -800
-            #print(f"server_addr:{server_addr}")
-            answer_inquiry(('127.0.0.1', server_addr),client_address,server_socket,lat,lon)
+            answer_inquiry(self.server_addr,client_address,self,lat,lon)
+        elif packet_view.control_flag == CONTROL_FLAGS['probe']:
+            answer_probe(self.server_addr,client_address,self,packet_view)
+        elif packet_view.control_flag == CONTROL_FLAGS['sack']:
+            # acknowledgement from the next hop of a relayed message
+            forwarding.on_ack(client_address, packet_view)
         else:
-            print(f"Checksum mismatch for packet {decode_res['packet_num']}. Packet discarded.")
+            metrics.counter('packets_dropped', node=self.satellite_id, reason='checksum').inc()
+            if metrics.LOG_INFO:
+                print(f"Checksum mismatch for packet {packet_view.packet_num}. Packet discarded.")
+        forwarding.poll(self.sendto)
+
+
+def handle_route(forwarding, packet, node_addrs, satellite_id, sendto):
+    """
+    the same for a binary source routed path packet (codec.OPTION_SOURCE_ROUTE): the hop index is advanced
+    in place and the packet passed on as it is, nothing is parsed or serialised again
+    :param packet: bytearray of the received packet
+    :param node_addrs: address of every node id, the node ids are the positions in receiver_ports
+    """
+    packet_view = PacketView(packet)
+    if metrics.LOG_INFO:
+        print(f"{satellite_id} received path of message {packet_view.message_id} from "
+              f"{packet_view.src_addr[0]}:{packet_view.src_addr[1]}")
+    if not packet_view.message_id:
+        print(f"{satellite_id} ignored a path without message id")
+        return
+    key = (packet_view.src_addr, packet_view.message_id)
+    next_node = advance_route(packet)
+    if next_node is None:
+        message = forwarding.install(key, None)
+        if message is not None:
+            deliver(message, satellite_id)
+        return
+    if next_node >= len(node_addrs):
+        print(f"Unknown next hop {next_node} for message {packet_view.message_id}")
+        return
+    next_addr = node_addrs[next_node]
+    forwarding.install(key, next_addr)
+    sendto(packet, next_addr)
+    if metrics.LOG_INFO:
+        print(f"Path is sent from {satellite_id} to node {next_node} at {next_addr[1]}")
+
+
+def server(global_dequeue, server_addr, receiver_ports, buffer_size, satellite_id,sat_node_number,encryption=True):
+    node = SatelliteNode(global_dequeue, server_addr, receiver_ports, satellite_id, sat_node_number, encryption)
+    server_socket = node.socket
+    while True:
+        # Receive a packet, wake up in time for the delayed acks and the relay timers
+        server_socket.settimeout(node.next_timeout())
+        try:
+            data, client_address = server_socket.recvfrom(buffer_size)
+        except socket.timeout:
+            node.on_timeout()
+            continue
+        except Exception as e:
+            #print(e)
+            #print(f"minor_error: server_addr:{server_addr}")
+            continue
+        node.datagram_received(data, client_address)
+
+
+def host_nodes(global_dequeue, receiver_ports, buffer_size, encryption=True):
+    """
+    every satellite node of receiver_ports in one selector loop of the calling thread, see node_host.py
+    """
+    host = NodeHost(buffer_size)
+    for node_id, (node_name, port) in enumerate(receiver_ports.items()):
+        host.add(SatelliteNode(global_dequeue, port, receiver_ports, node_name, node_id, encryption))
+    try:
+        host.run()
+    finally:
+        host.close()
+
+
+async def async_server(global_dequeue, server_addr, receiver_ports, satellite_id, sat_node_number, encryption=True):
+    """
+    the same node as server(), as a coroutine: all nodes share one event loop (see aio_transport.py)
+    """
+    def locate():
+        try:
+            return global_dequeue[sat_node_number-1].pop()
+        except IndexError:
+            # give a out of range latitude(it should be from -90 to 90) to imply error
+            return -800, -800
+
+    def on_message(message, packet_view, address):
+        message = forwarding.on_message((packet_view.src_addr, packet_view.message_id), message)
+        if message is not None:
+            deliver(message, satellite_id)
+
+    def on_path(path_info, packet_view, address):
+        # synchronous, the route is installed before the next datagram is handled
+        if path_info is None:
+            handle_route(forwarding, bytearray(packet_view.packet), node_addrs, satellite_id, node.sendto)
+        else:
+            handle_path(forwarding, path_info, packet_view, receiver_ports, satellite_id, node.sendto)
+        node.poll_forwarding()
+
+    node_addrs = [('127.0.0.1', port) for port in receiver_ports.values()]
+    keys = get_key_manager() if encryption else None
+    forwarding = ForwardingTable(satellite_id, keys=keys)
+    node = await open_node(('127.0.0.1', server_addr), on_message=on_message, on_path=on_path, locate=locate,
+                           forwarding=forwarding, keys=keys)
+    if metrics.LOG_INFO:
+        print(f"{satellite_id} is listening on {server_addr} for recieving...")
+    return node
+
+
+async def run_async_nodes(global_dequeue, receiver_ports):
+    nodes = [await async_server(global_dequeue, port, receiver_ports, node_name, node_id)
+             for node_id, (node_name, port) in enumerate(receiver_ports.items())]
+    try:
+        await asyncio.Event().wait()
+    finally:
+        for node in nodes:
+            node.transport.close()
 
 
 if __name__ == "__main__":
@@ -160,20 +327,32 @@ if __name__ == "__main__":
         "earth2": 50021
     }
     EARTH2_LL = (0, -40)
-    BUFFER_SIZE = 1024
+    BUFFER_SIZE = 2048  # room for the largest probed datagram (1472 bytes)
     NUM_SATS = 5
     SAT_INDEX = 5 #0 to 4= 5 sats
     # SAT_NODE_NUM=0
     ORBIT_Z_AXIS = (0, 0)
+    # "selectors": all satellite nodes in one selector loop, "asyncio": in one asyncio event loop,
+    # "threads": a thread per node, "processes": shards of nodes in WORKERS processes (see constellation.py)
+    NODE_HOST = "selectors"
+    WORKERS = None  # processes of the "processes" host, None = one per core
+    METRICS_PORT = 9464  # http://127.0.0.1:9464/metrics (text) and /metrics.json, None = no scrape endpoint
     server_threads = []
     # from the starlink article, https://blog.apnic.net/2024/05/17/a-transport-protocols-view-of-starlink/
     # the satellite's speed is about 27000km/hour on with the height of 550km
     # on the equator of earth surface, 1 degree of longitude is about 111.3km
     VELOCITY = 27000 / 111.3 / (60 * 60)
     print(f"velocity:{VELOCITY}")
-    global_dequeue = []#deque(maxlen=10)
-    for i in range(NUM_SATS):
-        global_dequeue.append(deque(maxlen=10))
+    constellation = None
+    if NODE_HOST == "processes":
+        # the workers read the positions from shared memory, their metrics are on METRICS_PORT + 1 + worker
+        constellation = Constellation(receiver_ports, NUM_SATS, workers=WORKERS, buffer_size=BUFFER_SIZE,
+                                      metrics_port=None if METRICS_PORT is None else METRICS_PORT + 1)
+        global_dequeue = constellation.positions
+    else:
+        global_dequeue = []#deque(maxlen=10)
+        for i in range(NUM_SATS):
+            global_dequeue.append(deque(maxlen=10))
 
     simulation_thread = threading.Thread(target=keep_moving,
                                          args=(global_dequeue, ORBIT_Z_AXIS, NUM_SATS, VELOCITY, SAT_INDEX),
@@ -186,12 +365,22 @@ if __name__ == "__main__":
 
     # start the threads
     simulation_thread.start()
-    for i in range(0, len(receiver_ports.keys())):
-        server_threads[i].start()
+    if METRICS_PORT is not None:
+        metrics.serve(METRICS_PORT)
+    if NODE_HOST == "threads":
+        for i in range(0, len(receiver_ports.keys())):
+            server_threads[i].start()
 
     # keep the main program alive
     try:
+        if NODE_HOST == "selectors":
+            host_nodes(global_dequeue, receiver_ports, BUFFER_SIZE)
+        elif NODE_HOST == "asyncio":
+            asyncio.run(run_async_nodes(global_dequeue, receiver_ports))
         while True:
             time.sleep(1)
     except KeyboardInterrupt:
         print("Exiting..")
+    finally:
+        if constellation is not None:
+            constellation.stop()
@@ -0,0 +1,116 @@
+"""
+shared udp sockets and resolved peer addresses, so sending a message or a path costs no socket setup
+and no name lookup once the process is warm.
+- sendto(): one socket for fire-and-forget datagrams (path packets), shared by every thread.
+- acquire()/release() or lease(): a socket of its own for an exchange that reads replies (a transfer,
+  probes, inquiries), returned to the pool afterwards. nothing is reset in between, the exchanges tell
+  their replies apart by message id or sender address and set their own timeouts.
+- peer_addr(): (ip, port) of a host name, resolved once.
+"""
+import socket
+import threading
+from contextlib import contextmanager
+import metrics
+from codec import ntoa, resolve
+
+# idle sockets kept for reuse, more are closed on release
+MAX_IDLE = 16
+
+_peers = {}  # (host, port) -> (ip, port)
+
+
+def peer_addr(host, port):
+    """
+    Resolved address of host:port, cached per destination.
+    """
+    addr = _peers.get((host, port))
+    if addr is None:
+        addr = (ntoa(resolve(host)), port)
+        _peers[(host, port)] = addr
+    return addr
+
+
+class SocketPool:
+    def __init__(self, max_idle=MAX_IDLE):
+        self.max_idle = max_idle
+        self.idle = []
+        self.lock = threading.Lock()
+        self._send_socket = None
+        self.created = metrics.counter('pool_sockets_created')
+        self.reused = metrics.counter('pool_sockets_reused')
+
+    def _new_socket(self):
+        self.created.inc()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # bind now, the port stays the same for the socket's whole life
+        sock.bind(('', 0))
+        return sock
+
+    def sendto(self, packet, address):
+        """
+        Send one datagram from the shared sending socket, safe from any thread.
+        """
+        sock = self._send_socket
+        if sock is None:
+            with self.lock:
+                if self._send_socket is None:
+                    self._send_socket = self._new_socket()
+                sock = self._send_socket
+        sock.sendto(packet, address)
+
+    def acquire(self):
+        """
+        A socket for the caller's exclusive use, give it back with release().
+        It may still be in the timeout mode of its last user and hold late replies of its last exchange,
+        callers set their own timeout and tell their replies apart (message id, sender address).
+        """
+        with self.lock:
+            sock = self.idle.pop() if self.idle else None
+        if sock is None:
+            return self._new_socket()
+        self.reused.inc()
+        return sock
+
+    def release(self, sock):
+        with self.lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append(sock)
+                return
+        sock.close()
+
+    @contextmanager
+    def lease(self):
+        sock = self.acquire()
+        try:
+            yield sock
+        finally:
+            self.release(sock)
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+            send_socket, self._send_socket = self._send_socket, None
+        for sock in idle + ([send_socket] if send_socket is not None else []):
+            sock.close()
+
+
+_pool = SocketPool()
+
+
+def sendto(packet, address):
+    _pool.sendto(packet, address)
+
+
+def acquire():
+    return _pool.acquire()
+
+
+def release(sock):
+    _pool.release(sock)
+
+
+def lease():
+    """
+    with socket_pool.lease() as sock: ... -- see SocketPool.acquire().
+    """
+    return _pool.lease()
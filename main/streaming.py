@@ -0,0 +1,196 @@
+"""
+zero-copy message sources for the senders: a message may be a str, bytes-like, a file path (os.PathLike)
+or an iterator of byte blocks, MessageSource turns any of them into one memoryview without a second copy:
+files from MMAP_THRESHOLD bytes on are memory-mapped, iterators are spooled to an anonymous temporary
+file once they grow past it.
+PacketSource is the packet number -> data packet mapping of transfer.Transfer over such a memoryview,
+a packet is built from its chunk slice when it is (re)sent, so a transfer holds no copy of the message and
+multi-megabyte dumps are sent with constant memory. with keys every chunk is sealed on its own as its
+packet is built (codec.OPTION_CHUNK_ENCRYPTED).
+SealedView is a message sealed as a whole (codec.OPTION_ENCRYPTED) the same way: it is encrypted as its
+packets are built, the first send of a chunk runs it through the stream encryptor, a resend encrypts it
+again from its offset, nothing of the ciphertext is kept.
+"""
+import mmap
+import os
+import tempfile
+from collections.abc import Mapping
+from codec import CONTROL_FLAGS, OPTION_CHUNK_ENCRYPTED, encode_packet, resolve
+from encryption import NONCE_SIZE, TAG_SIZE
+
+# files and spooled iterators from this size on are memory-mapped instead of read into memory
+MMAP_THRESHOLD = 1024 * 1024
+
+
+class MessageSource:
+    """
+    The bytes of one message as a memoryview (data), valid until close().
+    A str is encoded as utf-8, bytes-like objects are viewed as they are, an os.PathLike is a file
+    to read and anything else an iterable of byte blocks.
+    """
+    def __init__(self, message):
+        self._mapped = None
+        if isinstance(message, str):
+            data = message.encode('utf-8')
+        elif isinstance(message, (bytes, bytearray, memoryview)):
+            data = message
+        elif isinstance(message, os.PathLike):
+            with open(message, 'rb') as file:
+                data = self._map(file)
+        else:
+            data = self._spool(message)
+        self.data = memoryview(data).cast('B')
+
+    def _map(self, file):
+        file.flush()
+        if os.fstat(file.fileno()).st_size < MMAP_THRESHOLD:
+            file.seek(0)
+            return file.read()
+        # the mapping stays valid after the file is closed
+        self._mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mapped
+
+    def _spool(self, blocks):
+        buffer = bytearray()
+        spool = None
+        for block in blocks:
+            if spool is None and len(buffer) + len(block) >= MMAP_THRESHOLD:
+                spool = tempfile.TemporaryFile()
+                spool.write(buffer)
+                buffer = None
+            if spool is None:
+                buffer += block
+            else:
+                spool.write(block)
+        if spool is None:
+            return buffer
+        with spool:
+            return self._map(spool)
+
+    def __len__(self):
+        return self.data.nbytes
+
+    def close(self):
+        self.data.release()
+        if self._mapped is not None:
+            try:
+                self._mapped.close()
+            except BufferError:
+                # a slice is still alive (e.g. held by a traceback), the mapping is closed with it
+                pass
+            self._mapped = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class SealedView:
+    """
+    nonce + ciphertext + tag of data (bytes-like) sealed by encryptor (encryption.StreamEncryptor), sliced like
+    bytes; a slice is encrypted when it is read. Reads are cheapest in order, the tag is there once every
+    byte before it went through the encryptor.
+    """
+    def __init__(self, data, encryptor):
+        # the very view of a MessageSource, so closing the source releases it
+        self.data = data if isinstance(data, memoryview) else memoryview(data)
+        self.encryptor = encryptor
+        self.size = len(self.data)
+        self.encrypted = 0  # plaintext bytes that went through the encryptor
+
+    def __len__(self):
+        return NONCE_SIZE + self.size + TAG_SIZE
+
+    def __getitem__(self, index):
+        start, stop, _ = index.indices(len(self))
+        pieces = []
+        if start < NONCE_SIZE:
+            pieces.append(self.encryptor.nonce[start:stop])
+        body_start, body_stop = max(start - NONCE_SIZE, 0), min(stop - NONCE_SIZE, self.size)
+        if body_start < body_stop:
+            pieces.append(self._ciphertext(body_start, body_stop))
+        if stop > NONCE_SIZE + self.size:
+            pieces.append(self._tag()[max(start - NONCE_SIZE - self.size, 0):stop - NONCE_SIZE - self.size])
+        return b''.join(pieces)
+
+    def _ciphertext(self, start, stop):
+        head = b''
+        if start < self.encrypted:
+            # sent before: encrypted again from its offset
+            again = min(stop, self.encrypted)
+            head = self.encryptor.encrypt_at(start, self.data[start:again])
+            start = again
+            if start == stop:
+                return head
+        if start > self.encrypted:
+            # skipped ahead, the tag still needs what lies between
+            self.encryptor.update(self.data[self.encrypted:start])
+        self.encrypted = stop
+        return head + self.encryptor.update(self.data[start:stop])
+
+    def _tag(self):
+        if self.encryptor.tag is None:
+            self.encryptor.update(self.data[self.encrypted:])
+            self.encrypted = self.size
+            self.encryptor.finalize()
+        return self.encryptor.tag
+
+
+class PacketSource(Mapping):
+    """
+    packet number -> data packet of the message data (bytes-like or a SealedView), encoded from its chunk
+    on every access.
+    The arguments are those of codec.encode_packet; keys (encryption.KeyManager) seals every chunk,
+    chunk_size is then the sealed size on the wire and holds TAG_SIZE bytes less of the message.
+    """
+    def __init__(self, src_ip, src_port, des_ip, des_port, data, chunk_size, ttl=64, message_id=0, options=0,
+                 keys=None):
+        self.src_ip = src_ip
+        self.src_port = src_port
+        self.des_ip = des_ip
+        self.des_port = des_port
+        # the very view of a MessageSource, so closing the source releases it
+        self.data = data if isinstance(data, (memoryview, SealedView)) else memoryview(data)
+        self.chunk_size = chunk_size
+        self.ttl = ttl
+        self.message_id = message_id
+        self.keys = keys
+        if keys is not None:
+            options |= OPTION_CHUNK_ENCRYPTED
+            self._src, self._des = resolve(src_ip), resolve(des_ip)
+            chunk_size -= TAG_SIZE
+            if chunk_size < 1:
+                raise ValueError(f"chunks of {chunk_size + TAG_SIZE} bytes cannot hold a {TAG_SIZE} byte tag")
+        self.options = options
+        self.plain_chunk_size = chunk_size
+        self.total_packets = -(-len(self.data) // chunk_size)
+
+    def chunk(self, packet_number):
+        """
+        Message bytes of a packet, before sealing.
+        """
+        offset = packet_number * self.plain_chunk_size
+        return self.data[offset:offset + self.plain_chunk_size]
+
+    def __getitem__(self, packet_number):
+        if not 0 <= packet_number < self.total_packets:
+            raise KeyError(packet_number)
+        chunk = self.chunk(packet_number)
+        if self.keys is not None:
+            chunk = self.keys.seal_chunk(chunk, self._src, self.src_port, self._des, self.des_port,
+                                         CONTROL_FLAGS['data'] | self.options, packet_number, self.total_packets,
+                                         self.message_id)
+        return encode_packet(self.src_ip, self.src_port, self.des_ip, self.des_port, chunk,
+                             packet_number, self.total_packets, flag='data', ttl=self.ttl,
+                             message_id=self.message_id, options=self.options)
+
+    def __contains__(self, packet_number):
+        return isinstance(packet_number, int) and 0 <= packet_number < self.total_packets
+
+    def __len__(self):
+        return self.total_packets
+
+    def __iter__(self):
+        return iter(range(self.total_packets))
@@ -0,0 +1,68 @@
+"""
+a route that loses every large datagram makes send_packets start over with smaller chunks,
+with packet encryption the restarted transfer must not seal other chunks under the nonces of the first one.
+"""
+import base64
+import os
+import socket
+import threading
+import metrics
+from codec import CONTROL_FLAGS, PacketView
+from encryption import KeyManager
+from protocol import answer_probe, send_ack, send_packets
+from reassembly import Reassembler
+
+# datagrams above this size vanish, the probes of every size are still answered
+BLACKHOLE_SIZE = 1100
+
+
+def receive(server_socket, keys, delivered, sealed, stop):
+    server_addr = server_socket.getsockname()
+    reassembler = Reassembler()
+    while not stop.is_set():
+        try:
+            data, address = server_socket.recvfrom(65535)
+        except socket.timeout:
+            continue
+        packet_view = PacketView(data)
+        if packet_view.control_flag == CONTROL_FLAGS['probe']:
+            answer_probe(server_addr, address, server_socket, packet_view)
+        elif packet_view.control_flag == CONTROL_FLAGS['data']:
+            # the chunk nonce is (source ip, message id, packet number)
+            sealed.setdefault((packet_view.message_id, packet_view.packet_num), set()).add(bytes(packet_view.payload))
+            if len(data) > BLACKHOLE_SIZE:
+                continue
+            message = send_ack(server_addr, address, server_socket, packet_view, reassembler, suppress_log=True,
+                               keys=keys)
+            if message is not None:
+                delivered.append(message)
+
+
+def test_blackhole_restart_with_chunk_encryption(tmp_path):
+    metrics.set_log_level('warning')
+    key_file = tmp_path / 'aes_key_salt.txt'
+    key_file.write_text(f"AES Key: {base64.urlsafe_b64encode(os.urandom(32)).decode()}\n"
+                        f"Salt: {base64.urlsafe_b64encode(os.urandom(16)).decode()}\n")
+    keys = KeyManager(str(key_file))
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server_socket.bind(('127.0.0.1', 0))
+    server_socket.settimeout(0.05)
+    delivered, sealed, stop = [], {}, threading.Event()
+    receiver = threading.Thread(target=receive, args=(server_socket, keys, delivered, sealed, stop), daemon=True)
+    receiver.start()
+    message = os.urandom(20000)
+    first_id = 1234
+    restarts = []
+    try:
+        send_packets(('127.0.0.1', 50100), ('127.0.0.1', 50021), server_socket.getsockname(), message,
+                     timeout=0.2, debug_interval=0, suppress_log=True, message_id=first_id, max_idle_rounds=50,
+                     encryption=keys, packet_encryption=True, restart=restarts.append)
+    finally:
+        stop.set()
+        receiver.join()
+        server_socket.close()
+    assert restarts and first_id not in restarts
+    assert {message_id for message_id, _ in sealed} == {first_id, *restarts}
+    # a retransmission repeats its chunk, no nonce ever sealed two different ones
+    assert all(len(chunks) == 1 for chunks in sealed.values())
+    assert delivered == [message]
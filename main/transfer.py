@@ -0,0 +1,314 @@
+"""
+sans-io state of one selective-repeat message transfer
+the blocking sender (protocol.send_packets) and the asyncio sender (aio_transport.py) only move datagrams,
+every decision about what to send, when to wake up and what is lost is taken here.
+
+up to window_size packets are in flight, every one with its own timer from the adaptive rto of the router.
+acks are cumulative + selective (see sack.py), only the gaps they reveal and the packets whose timer expired
+are resent. the window is further limited by the congestion controller of the router and new packets are
+paced by its token bucket. with fec, repair packets follow every block of data packets (see fec.py).
+an automatically sized transfer with nothing acknowledged after BLACKHOLE_ROUNDS timeouts starts over with
+smaller chunks under a new message id (see pmtu.py). the sender asks for a handover every HANDOVER_INTERVAL
+seconds and at once after HANDOVER_ROUNDS timer rounds without a new ack (see protocol.py); it moves the
+transfer to another router without starting again (Transfer.migrate), the new route keeps the message id.
+"""
+import heapq
+import time
+import metrics
+from codec import CONTROL_FLAGS, HEADER_SIZE, encode_packet
+from rtt_estimator import get_estimator
+from congestion import get_controller
+from sack import decode_sack
+from pmtu import MIN_CHUNK_SIZE, report_blackhole, report_transfer
+from fec import SCHEMES, encode_block, loss_rate, record_loss, repair_count
+
+# expiry rounds without any ack before an automatically sized transfer assumes a black hole
+BLACKHOLE_ROUNDS = 2
+
+
+class Transfer:
+    """
+    One message on its way to router_addr.
+    packets maps packet number -> encoded data packet (a dict, or a streaming.PacketSource building them on demand),
+    options are the codec option bits of the message, repeated on its repair packets.
+    Callers pass a send(packet) callable to refill() and resend_lost() and feed every
+    received datagram of the message to on_ack() until done.
+    With total_packets given, packets may start empty and be completed with add_packet() while
+    the transfer runs (cut-through relaying), they are sent in packet number order as they come,
+    gaps (packets taking another route after a handover) do not hold the others back.
+    migrate() moves the rest of a running transfer to another router.
+    """
+    def __init__(self, src_addr, des_addr, router_addr, packets, message_id, chunk_size, timeout=1,
+                 debug_interval=1, window_size=8, congestion='aimd', fec=None, fec_block=8, fec_repair=None,
+                 options=0, auto_chunk=False, total_packets=None, payload_bytes=None):
+        self.src_addr = tuple(src_addr)
+        self.des_addr = tuple(des_addr)
+        self.router_addr = tuple(router_addr)
+        self.packets = packets
+        self.total_packets = len(packets) if total_packets is None else total_packets
+        self.payload_bytes = payload_bytes  # summed from the packets at the end if None
+        self.message_id = message_id
+        self.chunk_size = chunk_size
+        self.auto_chunk = auto_chunk
+        self.debug_interval = debug_interval
+        self.window_size = window_size
+        self.fec = fec
+        self.fec_block = fec_block
+        self.scheme = SCHEMES[fec] if fec else None
+        self.repair_k = None
+        if self.scheme is not None:
+            self.repair_k = fec_repair if fec_repair is not None \
+                else repair_count(loss_rate(self.router_addr), fec_block, self.scheme)
+        self.options = options
+        self.timeout = timeout
+        self.congestion = congestion
+        self._bind_route()
+
+        self.total_send = 0
+        self.total_resend = 0
+        self.total_repair = 0
+        self.recovered = 0  # chunks the receiver rebuilt from repair packets
+        self.rtts = []
+        self.start_time = time.time()
+        self.elapsed = None
+        self.silent_rounds = 0  # expiry rounds before the first ack
+        self.idle_rounds = 0  # expiry rounds since the last newly acknowledged packet
+        self.handovers = 0
+        self.next_packet = 0  # one past the highest packet number sent so far
+        self.unsent = list(packets) if total_packets is None else []  # heap of packet numbers never sent
+        heapq.heapify(self.unsent)
+        self.complete = False  # the receiver reported the whole message
+        self.sent_times = {}  # packet number -> last sending time
+        self.deadlines = {}  # packet number -> retransmission deadline
+        self.send_order = {}  # packet number -> transmission counter of its last sending
+        self.send_count = 0
+        self.latest_acked_order = 0
+        self.fence = {}  # first packet of a fec block -> transmission counter of its last repair packet
+        self.retransmitted = set()
+        self.acked = set()
+        self.pause_until = 0
+        self.window = window_size
+
+    def _bind_route(self):
+        self.estimator = get_estimator(self.router_addr, initial_rto=self.timeout)
+        self.controller = get_controller(self.router_addr, self.congestion)
+        route = f"{self.router_addr[0]}:{self.router_addr[1]}"
+        self.sent_counter = metrics.counter('packets_sent', route=route)
+        self.acked_counter = metrics.counter('packets_acked', route=route)
+        self.resent_counter = metrics.counter('packets_retransmitted', route=route)
+        self.repair_counter = metrics.counter('repair_packets_sent', route=route)
+        self.rtt_histogram = metrics.histogram('rtt_ms', route=route)
+
+    @property
+    def done(self):
+        return self.complete or len(self.acked) >= self.total_packets
+
+    def add_packet(self, packet_number, packet):
+        self.packets[packet_number] = packet
+        heapq.heappush(self.unsent, packet_number)
+
+    def _sendable(self):
+        return bool(self.unsent) and len(self.deadlines) < self.window
+
+    def refill(self, send, now=None):
+        """
+        Fill the window with packets which have never been sent.
+        """
+        now = time.time() if now is None else now
+        self.window = min(self.window_size, self.controller.window())
+        if now < self.pause_until or not self._sendable():
+            return
+        rto = self.estimator.rto
+        self.pause_until = now + self.debug_interval
+        while self._sendable():
+            pacing_wait = self.controller.pacer.reserve()
+            if pacing_wait > 0:
+                self.pause_until = max(self.pause_until, now + pacing_wait)
+                break
+            packet_number = heapq.heappop(self.unsent)
+            if metrics.LOG_DEBUG:
+                print(f"Sent packet {packet_number+1}/{self.total_packets}")
+            send(self.packets[packet_number])
+            self.send_count += 1
+            self.send_order[packet_number] = self.send_count
+            self.sent_times[packet_number] = now
+            self.deadlines[packet_number] = now + rto
+            self.total_send += 1
+            self.sent_counter.inc()
+            if packet_number < self.next_packet:
+                # a late gap of a relay, or sent again after a handover: its fec block is closed already
+                continue
+            self.next_packet = next_packet = packet_number + 1
+            if self.scheme is not None and (next_packet % self.fec_block == 0 or next_packet == self.total_packets):
+                self._send_repairs(send, (next_packet - 1) // self.fec_block * self.fec_block)
+
+    def _send_repairs(self, send, block_start):
+        # the block is complete, follow it with its repair packets
+        src_ip, src_port = self.src_addr
+        des_ip, des_port = self.des_addr
+        chunks = [memoryview(self.packets[packet_number])[HEADER_SIZE:]
+                  for packet_number in range(block_start, self.next_packet)]
+        for repair in encode_block(chunks, self.repair_k, self.scheme):
+            send(encode_packet(src_ip, src_port, des_ip, des_port, repair, block_start, self.total_packets,
+                               flag='repair', message_id=self.message_id, options=self.options))
+            self.send_count += 1
+            self.total_repair += 1
+            self.repair_counter.inc()
+        self.fence[block_start] = self.send_count
+
+    def wake_time(self):
+        """
+        Time to stop waiting for acks: the earliest retransmission deadline, or the end of the
+        refill pause while the window has room. None while everything sent is acknowledged and
+        the next packet has not been added yet.
+        """
+        wake = list(self.deadlines.values())
+        if self._sendable():
+            wake.append(self.pause_until)
+        return min(wake) if wake else None
+
+    def on_ack(self, ack_view, ack_time=None):
+        """
+        Process a received datagram (codec.PacketView), anything but a valid sack frame of this
+        message is ignored. :return: True if it acknowledged new packets.
+        """
+        if ack_view.control_flag != CONTROL_FLAGS['sack'] or ack_view.message_id != self.message_id \
+                or not ack_view.verify():
+            return False
+        cumulative, sacked, rebuilt = decode_sack(ack_view)
+        self.recovered = max(self.recovered, rebuilt)
+        if cumulative >= self.total_packets:
+            # everything arrived, also what a previous route or another relay delivered
+            self.complete = True
+        newly_acked = [packet_number for packet_number in self.deadlines
+                       if packet_number < cumulative or packet_number in sacked]
+        if not newly_acked:
+            return self.complete
+        self.idle_rounds = 0
+        ack_time = time.time() if ack_time is None else ack_time
+        # one rtt sample per ack frame, from the most recently sent packet it covers;
+        # Karn's rule: an ack of a retransmitted packet is ambiguous, do not sample it
+        newest = max(newly_acked, key=self.send_order.get)
+        rtt = ack_time - self.sent_times[newest]
+        sample = None if newest in self.retransmitted else rtt
+        if sample is not None:
+            self.estimator.sample(sample)
+        self.rtts.append(rtt * 1000)  # convert to milliseconds
+        self.rtt_histogram.observe(rtt * 1000)
+        self.acked_counter.inc(len(newly_acked))
+        self.latest_acked_order = max(self.latest_acked_order, self.send_order[newest])
+        for packet_number in newly_acked:
+            del self.deadlines[packet_number]
+            del self.sent_times[packet_number]
+            self.acked.add(packet_number)
+            self.controller.on_ack(sample, self.estimator.srtt)
+        if metrics.LOG_DEBUG:
+            print(f"Received SACK from {self.router_addr[0]}:{self.router_addr[1]}: cumulative={cumulative}, "
+                  f"acked={len(newly_acked)}, time={rtt * 1000:.2f} ms")
+        return True
+
+    def resend_lost(self, send, now=None):
+        """
+        Resend the gaps: a packet is lost once a packet sent after it has been acknowledged,
+        or when its own timer expired; only those packet numbers are resent.
+        :return: True if large datagrams seem to vanish on this route and the caller should
+                 start over with smaller chunks (only with auto_chunk), nothing is resent then.
+        """
+        now = time.time() if now is None else now
+        # with fec a first transmission only counts as sent once its block's repair packets are out,
+        # the receiver may still rebuild it until then
+        gaps = [packet_number for packet_number in self.deadlines
+                if (self.send_order[packet_number] if self.scheme is None or packet_number in self.retransmitted
+                    else self.fence.get(packet_number // self.fec_block * self.fec_block, self.send_count + 1))
+                < self.latest_acked_order]
+        expired = [packet_number for packet_number, deadline in self.deadlines.items()
+                   if now >= deadline and packet_number not in gaps]
+        if expired:
+            # exponential backoff once per expiry round, not once per packet
+            self.estimator.backoff()
+            self.idle_rounds += 1
+            if not self.acked:
+                self.silent_rounds += 1
+                if self.auto_chunk and self.silent_rounds >= BLACKHOLE_ROUNDS and self.chunk_size > MIN_CHUNK_SIZE:
+                    report_blackhole(self.router_addr, self.chunk_size)
+                    self.estimator.reset_backoff()
+                    return True
+        rto = self.estimator.rto
+        for packet_number in gaps + expired:
+            self.controller.on_loss(self.sent_times[packet_number])
+            if metrics.LOG_DEBUG:
+                print(f"Lost: packet_num={packet_number+1}, resending...")
+            send(self.packets[packet_number])
+            self.send_count += 1
+            self.send_order[packet_number] = self.send_count
+            self.sent_times[packet_number] = now
+            self.deadlines[packet_number] = now + rto
+            self.retransmitted.add(packet_number)
+            self.total_send += 1
+            self.total_resend += 1
+            self.sent_counter.inc()
+            self.resent_counter.inc()
+        return False
+
+    def migrate(self, router_addr):
+        """
+        Hand the rest of the transfer over to router_addr, e.g. when the satellite leaves range:
+        acknowledged packets stay acknowledged, the ones in flight are sent again through the new route
+        ahead of those never sent, the message id stays the same.
+        """
+        self.router_addr = tuple(router_addr)
+        self._bind_route()
+        for packet_number in self.deadlines:
+            heapq.heappush(self.unsent, packet_number)
+            # acks of the old route may still come in, those rtts are ambiguous
+            self.retransmitted.add(packet_number)
+            del self.sent_times[packet_number]
+        self.deadlines.clear()
+        self.window = min(self.window_size, self.controller.window())
+        self.pause_until = 0
+        self.silent_rounds = 0
+        self.idle_rounds = 0
+        self.handovers += 1
+
+    def finish(self):
+        """
+        Record the outcome of the completed transfer for the route.
+        """
+        self.elapsed = time.time() - self.start_time
+        if self.payload_bytes is None:
+            self.payload_bytes = sum(len(packet) for packet in self.packets.values()) - HEADER_SIZE * len(self.packets)
+        report_transfer(self.router_addr, self.chunk_size, self.payload_bytes, self.elapsed,
+                        self.total_send, self.total_resend)
+        record_loss(self.router_addr, self.total_send + self.total_repair, self.total_resend + self.recovered)
+
+    def print_stats(self):
+        print("----------------------------------------------------")
+        print(f"---UDP packets all sent: statistics below---\n")
+        packets_transmitted = self.total_send
+        packets_received = len(self.acked)
+        packet_lost_count = packets_transmitted - packets_received
+        packet_loss = ((packets_transmitted - packets_received) / packets_transmitted) * 100
+        packet_loss_after_resend = ((packets_transmitted + self.total_resend - packets_received)
+                                    / packets_transmitted) * 100
+        print(f"{packets_transmitted} packets transmitted, "
+              f"{packets_received} received, "
+              f"{packet_lost_count} lost, "
+              f"{self.total_resend} resent.")
+        if self.scheme is not None:
+            print(f"{self.total_repair} fec repair packets ({self.fec}, {self.repair_k} per {self.fec_block}), "
+                  f"{self.recovered} chunks rebuilt without retransmission.")
+        if self.handovers:
+            print(f"{self.handovers} handover(s), finished via {self.router_addr[0]}:{self.router_addr[1]}.")
+        print(f"({packet_loss:.1f}% loss)\n")
+        print(f"({packet_loss_after_resend:.1f}% loss after resending)\n")
+        if self.rtts:
+            min_rtt = min(self.rtts)
+            max_rtt = max(self.rtts)
+            avg_rtt = sum(self.rtts) / len(self.rtts)
+            print(f"rtt min={min_rtt:.2f} ms, avg={avg_rtt:.2f} ms, max={max_rtt:.2f} ms\n")
+        else:
+            print("No RTT data available.\n")
+        if self.elapsed:
+            print(f"goodput {self.payload_bytes / self.elapsed / 1000:.2f} kB/s with {self.chunk_size} byte chunks "
+                  f"via {self.router_addr[0]}:{self.router_addr[1]}\n")
+        print("----------------------------------------------------")